@@ -23,19 +23,26 @@ from collections import defaultdict, Counter, deque
 import io
 from datetime import datetime
 import math
+import heapq
+import itertools
 import copy
 import webbrowser
 from waitress import serve
 from threading import Timer
 from ortools.sat.python import cp_model
+from ortools.graph.python import min_cost_flow
 import queue
 from flask import stream_with_context, Response
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+import multiprocessing
+import numpy as np
 import signal
 import threading
 import time
 import uuid
 import sqlite3
+import hashlib
+import zlib
 
 # --- إضافة جديدة: لاستيراد مكتبة التعامل مع اكسل ---
 from openpyxl import Workbook
@@ -55,9 +62,14 @@ import uuid
 
 # ================== الجزء الثاني: الإعدادات الأولية والدوال المساعدة ==================
 
-log_queue = queue.Queue()
-executor = ThreadPoolExecutor(max_workers=1)
-STOP_EVENT = threading.Event()
+# عدد عمليات إنشاء الجداول التي تعمل في نفس الوقت؛ البقية تنتظر دورها بالترتيب (انظر JobManager)
+MAX_CONCURRENT_JOBS = max(1, int(os.environ.get('MAX_CONCURRENT_JOBS', '1')))
+# عدد الرسائل التي يحتفظ بها سجل كل مهمة لإعادة إرسالها عند إعادة الاتصال
+JOB_EVENT_BUFFER_SIZE = 5000
+# أقل فاصل زمني (بالثواني) بين رسالتي تقدم متتاليتين، أي 10 رسائل في الثانية كحد أقصى
+PROGRESS_MIN_INTERVAL = 0.1
+# عدد عمليات CP-SAT عند إعادة المحاولة إذا لم يجد المُحلل التلقائي (عملية لكل نواة) أي حل على جهاز قليل الأنوية
+CP_SOLVER_RETRY_WORKERS = 8
 
 def get_correct_path(relative_path):
     try:
@@ -148,10 +160,84 @@ def init_db():
         key TEXT PRIMARY KEY,
         value TEXT NOT NULL
     )''')
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS runs (
+        id TEXT PRIMARY KEY,
+        created_at REAL NOT NULL,
+        started_at REAL,
+        finished_at REAL NOT NULL,
+        status TEXT NOT NULL,
+        strategy TEXT,
+        settings_fingerprint TEXT NOT NULL,
+        cost TEXT,
+        message TEXT,
+        reports TEXT,
+        schedule BLOB
+    )''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_runs_finished_at ON runs (finished_at)')
     conn.commit()
     conn.close()
     print("Database initialized successfully.")
 
+# --- نتائج عمليات إنشاء الجداول (جدول runs) ---
+# مفاتيح رسالة DONE التي تُحفظ كتقارير (الجدول نفسه يُحفظ مضغوطاً في عمود منفصل)
+RUN_REPORT_KEYS = ('failures', 'scheduling_report', 'prof_report', 'chart_data', 'balance_report', 'stats_dashboard')
+
+def settings_fingerprint(settings):
+    """بصمة ثابتة للإعدادات: نفس الإعدادات تعطي نفس البصمة بغض النظر عن ترتيب المفاتيح."""
+    canonical = json.dumps(settings or {}, sort_keys=True, ensure_ascii=False, separators=(',', ':'), default=str)
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+def save_run(run_id, created_at, started_at, status, strategy, fingerprint, payload):
+    """حفظ نتيجة عملية منتهية؛ الجدول يُخزن JSON مضغوطاً (zlib) والتقارير JSON عادياً."""
+    schedule = payload.get('schedule')
+    schedule_blob = zlib.compress(json.dumps(schedule, ensure_ascii=False, separators=(',', ':')).encode('utf-8')) if schedule else None
+    reports = {key: payload[key] for key in RUN_REPORT_KEYS if key in payload}
+    conn = get_db_connection()
+    conn.execute(
+        'INSERT OR REPLACE INTO runs (id, created_at, started_at, finished_at, status, strategy, settings_fingerprint, cost, message, reports, schedule) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+        (run_id, created_at, started_at, time.time(), status, strategy, fingerprint,
+         json.dumps(payload.get('cost')) if payload.get('cost') is not None else None, payload.get('message'),
+         json.dumps(reports, ensure_ascii=False) if reports else None, schedule_blob))
+    conn.commit()
+    conn.close()
+
+def _run_row_to_dict(row):
+    started_at, finished_at = row['started_at'], row['finished_at']
+    return {
+        "runId": row['id'], "status": row['status'], "success": row['status'] == 'done',
+        "strategy": row['strategy'], "settingsFingerprint": row['settings_fingerprint'],
+        "cost": json.loads(row['cost']) if row['cost'] else None, "message": row['message'],
+        "createdAt": row['created_at'], "startedAt": started_at, "finishedAt": finished_at,
+        "duration": round(finished_at - started_at, 2) if started_at is not None else None,
+    }
+
+def list_runs(limit=50):
+    conn = get_db_connection()
+    rows = conn.execute('SELECT id, created_at, started_at, finished_at, status, strategy, settings_fingerprint, cost, message FROM runs ORDER BY finished_at DESC LIMIT ?', (limit,)).fetchall()
+    conn.close()
+    return [_run_row_to_dict(row) for row in rows]
+
+def load_run(run_id):
+    """يعيد بيانات العملية ومعها الجدول والتقارير بنفس مفاتيح رسالة DONE، أو None إن لم توجد."""
+    conn = get_db_connection()
+    row = conn.execute('SELECT * FROM runs WHERE id = ?', (run_id,)).fetchone()
+    conn.close()
+    if row is None:
+        return None
+    run = _run_row_to_dict(row)
+    run['schedule'] = json.loads(zlib.decompress(row['schedule']).decode('utf-8')) if row['schedule'] else None
+    run.update(json.loads(row['reports']) if row['reports'] else {})
+    return run
+
+def load_run_schedule(run_id):
+    conn = get_db_connection()
+    row = conn.execute('SELECT schedule FROM runs WHERE id = ?', (run_id,)).fetchone()
+    conn.close()
+    if row is None or not row['schedule']:
+        return None
+    return json.loads(zlib.decompress(row['schedule']).decode('utf-8'))
+
 # --- دوال مساعدة أخرى ---
 
 def clean_string_for_matching(text):
@@ -175,6 +261,183 @@ def apply_styles_to_cell(cell, font, alignment, border, fill=None):
     cell.border = border
     if fill: cell.fill = fill
 
+# ===================================================================
+# --- START: النسخة المُجمَّعة من المسألة (ProblemInstance) ---
+# ===================================================================
+PATTERN_CODES = {'one_day_only': 1, 'flexible_2_days': 2, 'flexible_3_days': 3, 'consecutive_strict': 4}
+# الحد الأقصى لعدد أيام الحراسة الحالية قبل منع يوم جديد، مفهرس برمز النمط (is_assignment_valid)
+ASSIGN_PATTERN_DAY_LIMITS = np.array([np.inf, 1, 2, 3, 2])
+
+def parse_shift_limit(value, default='0'):
+    """تحويل قيمة سقف الحصص كما تأتي من الإعدادات ('0' = بلا سقف) إلى عدد صحيح أو ما لا نهاية."""
+    if value is None: value = default
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        value = float(default)
+    if value == 0 or math.isinf(value):
+        return float('inf')
+    return int(value)
+
+class ProblemInstance:
+    """
+    نسخة مُجمَّعة من المسألة تُبنى مرة واحدة لكل تشغيل.
+    - معرفات عددية متتالية للأساتذة والأيام والخانات الزمنية والامتحانات.
+    - الحقائق المشتقة لكل امتحان (عدد الحراس المطلوب، القاعة الكبيرة، وزن المهمة) تُحسب مرة واحدة
+      وتُخزَّن حسب الـ UUID، لذلك تبقى صالحة لكل النسخ العميقة من نفس الجدول.
+    - أنماط الحراسة وأيام الغياب والسقوف محوَّلة إلى رموز عددية بدل النصوص.
+    """
+    def __init__(self, settings, all_professors, duty_patterns, date_map):
+        # --- 1. الأساتذة ---
+        self.prof_names = list(all_professors)
+        self.num_professors = len(self.prof_names)
+        self.prof_index = {name: i for i, name in enumerate(self.prof_names)}
+
+        # --- 2. الأيام والخانات الزمنية ---
+        self.date_map = dict(date_map)
+        self.dates = sorted(self.date_map, key=self.date_map.get)
+        self.num_dates = len(self.dates)
+        self.slots, self.slot_index, self.slot_date_idx = [], {}, []
+        exam_schedule_settings = settings.get('examSchedule', {}) or {}
+        for date in self.dates:
+            for slot in sorted(exam_schedule_settings.get(date, []), key=lambda s: s.get('time', '')):
+                self.slot_id(date, slot.get('time'))
+
+        # --- 3. الأوزان والسقوف (تُقرأ مرة واحدة بدل كل استدعاء) ---
+        self.large_hall_weight = float(settings.get('largeHallWeight', 3.0))
+        self.other_hall_weight = float(settings.get('otherHallWeight', 1.0))
+        self.guards_large_hall = int(settings.get('guardsLargeHall', 4))
+        self.guards_medium_hall = int(settings.get('guardsMediumHall', 2))
+        self.guards_small_hall = int(settings.get('guardsSmallHall', 1))
+        self.max_shifts = parse_shift_limit(settings.get('maxShifts', '0'), '0')
+        self.max_large_hall_shifts = parse_shift_limit(settings.get('maxLargeHallShifts', '2'), '2')
+
+        # --- 4. الأنماط والغياب (مفهرسة بمعرف الأستاذ) ---
+        self.duty_patterns = duty_patterns or {}
+        self.unavailable_days = settings.get('unavailableDays', {}) or {}
+        self.pattern_codes, self.assign_pattern_codes = [], []
+        self.unavailable_dates, self.unavailable_date_idx = [], []
+        for name in self.prof_names:
+            self._add_prof_facts(name)
+
+        # --- 5. أزواج الأساتذة والأهداف المخصصة ---
+        self.partner_pairs = []
+        for pair in settings.get('professorPartnerships', []) or []:
+            if len(pair) == 2:
+                self.partner_pairs.append((self.prof_id(pair[0]), self.prof_id(pair[1])))
+        custom_target_patterns = settings.get('customTargetPatterns', []) or []
+        self.custom_target_counts = Counter((p['large'], p['other']) for p in custom_target_patterns for _ in range(p.get('count', 0)))
+        self.use_custom_targets = bool(settings.get('enableCustomTargets', False) and custom_target_patterns)
+
+        # --- 6. سجل الامتحانات (يُملأ عند أول مصادفة لكل UUID) ---
+        self.exam_ids = {}
+        self.exam_date, self.exam_time, self.exam_date_idx, self.exam_slot = [], [], [], []
+        self.exam_is_large, self.exam_demand, self.exam_large_demand, self.exam_weight = [], [], [], []
+
+        # --- 7. عمليات تقييم البحث المحظور المتوازي: تُنشأ عند أول حاجة وتُعاد لكل استدعاءات المهمة ---
+        self.tabu_scoring_pool = None
+
+    # ---------------- الأساتذة ----------------
+    def _add_prof_facts(self, name):
+        # pattern_codes: كما يقرأها is_schedule_valid (0 = بلا نمط)
+        # assign_pattern_codes: كما يقرأها is_assignment_valid (الافتراضي يومان مرنان)
+        self.pattern_codes.append(PATTERN_CODES.get(self.duty_patterns.get(name), 0))
+        self.assign_pattern_codes.append(PATTERN_CODES.get(self.duty_patterns.get(name, 'flexible_2_days'), 0))
+        unavailable = set(self.unavailable_days.get(name, []))
+        self.unavailable_dates.append(unavailable)
+        self.unavailable_date_idx.append({self.date_map[d] for d in unavailable if d in self.date_map})
+
+    def prof_id(self, name):
+        """معرف الأستاذ؛ الأسماء غير الموجودة في قائمة الأساتذة تُسجَّل بمعرف إضافي (>= num_professors)."""
+        p_id = self.prof_index.get(name)
+        if p_id is None:
+            p_id = self.prof_index[name] = len(self.prof_names)
+            self.prof_names.append(name)
+            self._add_prof_facts(name)
+        return p_id
+
+    # ---------------- الخانات الزمنية ----------------
+    def slot_id(self, date, time):
+        key = (date, time)
+        s_id = self.slot_index.get(key)
+        if s_id is None:
+            s_id = self.slot_index[key] = len(self.slots)
+            self.slots.append(key)
+            self.slot_date_idx.append(self.date_map.get(date, -1))
+        return s_id
+
+    # ---------------- الامتحانات ----------------
+    def exam_id(self, exam):
+        """معرف الامتحان (يُضاف UUID إذا لم يكن موجوداً، كما تفعل بقية الدوال)."""
+        exam_uuid = exam.get('uuid')
+        if exam_uuid is None:
+            exam_uuid = exam['uuid'] = str(uuid.uuid4())
+        e_id = self.exam_ids.get(exam_uuid)
+        if e_id is None:
+            e_id = self.exam_ids[exam_uuid] = len(self.exam_date)
+            for column in (self.exam_date, self.exam_time, self.exam_date_idx, self.exam_slot,
+                           self.exam_is_large, self.exam_demand, self.exam_large_demand, self.exam_weight):
+                column.append(None)
+            self._compile_exam(e_id, exam)
+        return e_id
+
+    def refresh_exam(self, exam):
+        """إعادة حساب حقائق امتحان تغيرت قاعاته (مثلاً بعد تبديل المواد)."""
+        e_id = self.exam_id(exam)
+        self._compile_exam(e_id, exam)
+        return e_id
+
+    def _compile_exam(self, e_id, exam):
+        halls = exam.get('halls', [])
+        num_large = sum(1 for h in halls if h.get('type') == 'كبيرة')
+        num_medium = sum(1 for h in halls if h.get('type') == 'متوسطة')
+        num_small = sum(1 for h in halls if h.get('type') == 'صغيرة')
+        self.exam_date[e_id], self.exam_time[e_id] = exam['date'], exam['time']
+        self.exam_date_idx[e_id] = self.date_map.get(exam['date'], -1)
+        self.exam_slot[e_id] = self.slot_id(exam['date'], exam['time'])
+        self.exam_is_large[e_id] = num_large > 0
+        self.exam_large_demand[e_id] = num_large * self.guards_large_hall
+        self.exam_demand[e_id] = num_large * self.guards_large_hall + num_medium * self.guards_medium_hall + num_small * self.guards_small_hall
+        self.exam_weight[e_id] = self.large_hall_weight if num_large > 0 else self.other_hall_weight
+
+    def is_large(self, exam): return self.exam_is_large[self.exam_id(exam)]
+    def guards_needed(self, exam): return self.exam_demand[self.exam_id(exam)]
+    def large_guards_needed(self, exam): return self.exam_large_demand[self.exam_id(exam)]
+    def duty_weight(self, exam): return self.exam_weight[self.exam_id(exam)]
+
+    def flat_exams(self, schedule):
+        """قائمة مسطحة بامتحانات الجدول بعد تسجيلها في السجل."""
+        exams = [exam for day in schedule.values() for slot in day.values() for exam in slot]
+        for exam in exams:
+            self.exam_id(exam)
+        return exams
+
+    def duty_slots(self, exams):
+        """قائمة المهام (معرف الامتحان، ترتيب الحارس) بالترتيب؛ موقع كل مهمة في القائمة هو معرفها."""
+        return [(e_id, g_idx) for e_id in (self.exam_id(exam) for exam in exams) for g_idx in range(self.exam_demand[e_id])]
+
+    def build_assignment_maps(self, schedule):
+        """بناء prof_assignments / prof_large_counts / prof_workload من الجدول (الصيغة التي تتوقعها الدوال القديمة)."""
+        prof_assignments, prof_large_counts, prof_workload = defaultdict(list), defaultdict(int), defaultdict(float)
+        for exam in self.flat_exams(schedule):
+            e_id = self.exam_ids[exam['uuid']]
+            is_large, weight = self.exam_is_large[e_id], self.exam_weight[e_id]
+            for guard in exam.get('guards', []):
+                if guard != "**نقص**":
+                    prof_assignments[guard].append(exam)
+                    prof_workload[guard] += weight
+                    if is_large: prof_large_counts[guard] += 1
+        return prof_assignments, prof_large_counts, prof_workload
+
+def get_problem_instance(instance, settings, all_professors, duty_patterns, date_map):
+    """إرجاع النسخة المُجمَّعة الممررة، أو بناء واحدة للاستدعاءات القديمة التي لا تمررها."""
+    if instance is not None:
+        return instance
+    return ProblemInstance(settings, all_professors, duty_patterns or settings.get('dutyPatterns', {}), date_map)
+# ===================================================================
+# --- END: النسخة المُجمَّعة من المسألة ---
+# ===================================================================
+
 # ================== دوال الخوارزمية (المنطق الأساسي) ==================
 # الصق محتوى الدوال الأصلية هنا
 
@@ -254,22 +517,34 @@ def calculate_schedule_balance_score(schedule, all_professors, settings, num_pro
     balance_report = generate_balance_report(prof_stats, prof_targets_map)
     return balance_report.get('balance_score', 0.0)
 
-def is_assignment_valid(prof, exam, prof_assignments, prof_large_counts, settings, date_map):
+def is_assignment_valid(prof, exam, prof_assignments, prof_large_counts, settings, date_map, instance=None):
     """
     دالة مركزية للتحقق مما إذا كان تعيين حارس لامتحان معين صالحاً أم لا.
+    عند تمرير النسخة المُجمَّعة (instance) تُستخدم الحقائق المحسوبة مسبقاً بدل إعادة تحليل الإعدادات.
     """
     # استخلاص الإعدادات من القاموس
-    duty_patterns = settings.get('dutyPatterns', {})
-    unavailable_days = settings.get('unavailableDays', {})
-    max_shifts = int(settings.get('maxShifts', '0')) if settings.get('maxShifts', '0') != '0' else float('inf')
-    max_large_hall_shifts = int(settings.get('maxLargeHallShifts', '2')) if settings.get('maxLargeHallShifts', '2') != '0' else float('inf')
+    if instance is not None:
+        p_id = instance.prof_id(prof)
+        max_shifts = instance.max_shifts
+        max_large_hall_shifts = instance.max_large_hall_shifts
+        is_unavailable = exam['date'] in instance.unavailable_dates[p_id]
+        is_large_hall_exam = instance.is_large(exam)
+        pattern_code = instance.assign_pattern_codes[p_id]
+    else:
+        duty_patterns = settings.get('dutyPatterns', {})
+        unavailable_days = settings.get('unavailableDays', {})
+        max_shifts = parse_shift_limit(settings.get('maxShifts', '0'), '0')
+        max_large_hall_shifts = parse_shift_limit(settings.get('maxLargeHallShifts', '2'), '2')
+        is_unavailable = exam['date'] in unavailable_days.get(prof, [])
+        is_large_hall_exam = any(h['type'] == 'كبيرة' for h in exam['halls'])
+        pattern_code = PATTERN_CODES.get(duty_patterns.get(prof, 'flexible_2_days'), 0)
     
     # 1. التحقق من التزامن (مشغول في نفس الوقت)
     if any(e['date'] == exam['date'] and e['time'] == exam['time'] for e in prof_assignments.get(prof, [])):
         return False
 
     # 2. التحقق من أيام الغياب
-    if exam['date'] in unavailable_days.get(prof, []):
+    if is_unavailable:
         return False
 
     # 3. التحقق من سقف الحصص الإجمالي
@@ -277,25 +552,21 @@ def is_assignment_valid(prof, exam, prof_assignments, prof_large_counts, setting
         return False
 
     # 4. التحقق من سقف حصص القاعة الكبيرة
-    is_large_hall_exam = any(h['type'] == 'كبيرة' for h in exam['halls'])
     if is_large_hall_exam and prof_large_counts.get(prof, 0) >= max_large_hall_shifts:
         return False
 
     # 5. التحقق من نمط الحراسة
-    # --- بداية: أسطر التعريفات التي كانت مفقودة ---
-    prof_pattern = duty_patterns.get(prof, 'flexible_2_days')
     duties_dates = {d['date'] for d in prof_assignments.get(prof, [])}
     is_new_day = exam['date'] not in duties_dates
     num_duty_days = len(duties_dates)
-    # --- نهاية: أسطر التعريفات التي كانت مفقودة ---
 
     if is_new_day:
-        if (prof_pattern == 'one_day_only' and num_duty_days >= 1) or \
-           (prof_pattern == 'flexible_2_days' and num_duty_days >= 2) or \
-           (prof_pattern == 'flexible_3_days' and num_duty_days >= 3) or \
-           (prof_pattern == 'consecutive_strict' and num_duty_days >= 2):
+        if (pattern_code == PATTERN_CODES['one_day_only'] and num_duty_days >= 1) or \
+           (pattern_code == PATTERN_CODES['flexible_2_days'] and num_duty_days >= 2) or \
+           (pattern_code == PATTERN_CODES['flexible_3_days'] and num_duty_days >= 3) or \
+           (pattern_code == PATTERN_CODES['consecutive_strict'] and num_duty_days >= 2):
             return False
-        elif prof_pattern == 'consecutive_strict' and num_duty_days == 1:
+        elif pattern_code == PATTERN_CODES['consecutive_strict'] and num_duty_days == 1:
             idx1 = date_map.get(list(duties_dates)[0])
             idx2 = date_map.get(exam['date'])
             if idx1 is None or idx2 is None or abs(idx1 - idx2) != 1:
@@ -304,33 +575,42 @@ def is_assignment_valid(prof, exam, prof_assignments, prof_large_counts, setting
     # إذا نجح في كل الاختبارات، يكون التعيين صالحاً
     return True
 
-def is_schedule_valid(schedule, settings, all_professors, duty_patterns, date_map):
+def is_schedule_valid(schedule, settings, all_professors, duty_patterns, date_map, instance=None):
     """
     النسخة المحدثة: مع إضافة التحقق من قيد "أزواج الأساتذة".
     """
-    unavailable_days = settings.get('unavailableDays', {})
-    max_shifts = int(settings.get('maxShifts', '0')) if settings.get('maxShifts', '0') != '0' else float('inf')
-    max_large_hall_shifts = int(settings.get('maxLargeHallShifts', '2')) if settings.get('maxLargeHallShifts', '2') != '0' else float('inf')
+    if instance is not None:
+        max_shifts, max_large_hall_shifts = instance.max_shifts, instance.max_large_hall_shifts
+        is_unavailable = lambda guard, date: date in instance.unavailable_dates[instance.prof_id(guard)]
+        is_large_exam_of = instance.is_large
+    else:
+        unavailable_days = settings.get('unavailableDays', {})
+        max_shifts = parse_shift_limit(settings.get('maxShifts', '0'), '0')
+        max_large_hall_shifts = parse_shift_limit(settings.get('maxLargeHallShifts', '2'), '2')
+        is_unavailable = lambda guard, date: date in unavailable_days.get(guard, [])
+        is_large_exam_of = lambda exam: any(h['type'] == 'كبيرة' for h in exam.get('halls', []))
 
     prof_assignments = defaultdict(list)
+    prof_busy_slots = defaultdict(set)
     prof_large_counts = defaultdict(int)
     
     all_exams = [exam for date_slots in schedule.values() for time_slots in date_slots.values() for exam in time_slots]
 
     # التحقق من القيود الأساسية (حصص متزامنة، غياب، عدد أقصى للحصص)
     for exam in all_exams:
-        is_large_exam = any(h['type'] == 'كبيرة' for h in exam.get('halls', []))
+        is_large_exam = is_large_exam_of(exam)
+        slot_key = (exam['date'], exam['time'])
         for guard in exam.get('guards', []):
             if guard == "**نقص**":
                 return False 
             
-            for other_exam in prof_assignments.get(guard, []):
-                if other_exam['date'] == exam['date'] and other_exam['time'] == exam['time']:
-                    return False 
+            if slot_key in prof_busy_slots[guard]:
+                return False 
                     
-            if exam['date'] in unavailable_days.get(guard, []):
+            if is_unavailable(guard, exam['date']):
                 return False 
             
+            prof_busy_slots[guard].add(slot_key)
             prof_assignments[guard].append(exam)
             if is_large_exam:
                 prof_large_counts[guard] += 1
@@ -560,110 +840,77 @@ def run_subject_optimization_phase(schedule, assignments, all_levels_list, subje
 # --- END: المرحلة 1.5 ---
 # ===================================================================
 
-def run_post_processing_swaps(schedule, prof_assignments, prof_workload, prof_large_counts, settings, all_professors, date_map, swap_attempts, locked_guards=set(), stop_event=None, log_q=None):
-    large_hall_weight = float(settings.get('largeHallWeight', 3.0))
-    other_hall_weight = float(settings.get('otherHallWeight', 1.0))
-    duty_patterns = settings.get('dutyPatterns', {})
-    unavailable_days = settings.get('unavailableDays', {})
-    max_shifts = int(settings.get('maxShifts', '0')) if settings.get('maxShifts', '0') != '0' else float('inf')
-    max_large_hall_shifts = int(settings.get('maxLargeHallShifts', '2')) if settings.get('maxLargeHallShifts', '2') != '0' else float('inf')
+def run_post_processing_swaps(schedule, prof_assignments, prof_workload, prof_large_counts, settings, all_professors, date_map, swap_attempts, locked_guards=set(), stop_event=None, log_q=None, instance=None):
+    """
+    موازنة بسيطة: في كل محاولة تنتقل مهمة من الأستاذ الأكثر عبئاً إلى الأقل عبئاً إن كان التعيين صالحاً.
+    - الأكثر والأقل عبئاً من كومتين (heapq) بحذف كسول: كل محاولة O(log P) بدل max/min على كل الأساتذة.
+    - الصلاحية من FeasibilityTracker (الإشغال بالخانة، الأيام، السقوف) لكل مهام المتبرع دفعة واحدة
+      بدل مسح قوائم التعيينات في is_assignment_valid.
+    """
+    instance = get_problem_instance(instance, settings, all_professors, settings.get('dutyPatterns', {}), date_map)
     
     temp_schedule = copy.deepcopy(schedule)
     
     # بناء/تحديث القواميس المساعدة من الجدول الحالي لضمان دقتها
-    temp_assignments = defaultdict(list)
-    temp_large_counts = defaultdict(int)
-    temp_workload = defaultdict(float)
-    all_exams_flat = [exam for day in temp_schedule.values() for slot in day.values() for exam in slot]
-    for exam in all_exams_flat:
-        is_large = any(h['type'] == 'كبيرة' for h in exam.get('halls', []))
-        duty_weight = large_hall_weight if is_large else other_hall_weight
-        for g in exam.get('guards', []):
-            if g != "**نقص**":
-                temp_assignments[g].append(exam)
-                temp_workload[g] += duty_weight
-                if is_large:
-                    temp_large_counts[g] += 1
-
-    for _ in range(swap_attempts):
+    temp_assignments, temp_large_counts, temp_workload = instance.build_assignment_maps(temp_schedule)
+    feasibility = FeasibilityTracker(instance, instance.flat_exams(temp_schedule))
+
+    # كومتان للعبء: العنصر قديم (يُتجاهل) إذا لم يعد عبؤه يساوي العبء الحالي للأستاذ
+    max_heap = [(-load, prof) for prof, load in temp_workload.items()]
+    min_heap = [(load, prof) for prof, load in temp_workload.items()]
+    heapq.heapify(max_heap); heapq.heapify(min_heap)
+
+    def heap_top(heap, sign):
+        while heap and sign * heap[0][0] != temp_workload[heap[0][1]]:
+            heapq.heappop(heap)
+        return heap[0][1] if heap else None
+
+    for attempt in range(swap_attempts):
         if stop_event and stop_event.is_set():
-            if i > 0: log_q.put(f"... [الصقل] تم الإيقاف بعد {i} محاولة تبديل.")
+            if attempt > 0 and log_q: log_q.put(f"... [الصقل] تم الإيقاف بعد {attempt} محاولة تبديل.")
             break
         if not temp_workload or len(temp_workload) < 2: break
         
-        most_burdened_prof = max(temp_workload, key=temp_workload.get)
-        least_burdened_prof = min(temp_workload, key=temp_workload.get)
+        most_burdened_prof = heap_top(max_heap, -1)
+        least_burdened_prof = heap_top(min_heap, 1)
 
         if most_burdened_prof == least_burdened_prof or temp_workload[most_burdened_prof] <= temp_workload[least_burdened_prof]:
             break 
             
-        swap_found = False
-        
         possible_swaps = [
-            exam for exam in temp_assignments.get(most_burdened_prof, [])
+            (i, exam) for i, exam in enumerate(temp_assignments.get(most_burdened_prof, []))
             if (exam.get('uuid'), most_burdened_prof) not in locked_guards
         ]
         random.shuffle(possible_swaps)
+        if not possible_swaps: break
 
-        for exam in possible_swaps:
-            date, time = exam['date'], exam['time']
-            is_large_hall_exam = any(h['type'] == 'كبيرة' for h in exam.get('halls', []))
-            # تجميع الإعدادات في قاموس واحد
-            settings_for_validation = {
-                'dutyPatterns': duty_patterns,
-                'unavailableDays': unavailable_days,
-                'maxShifts': max_shifts,
-                'maxLargeHallShifts': max_large_hall_shifts
-            }
-
-            # استدعاء واحد يحل محل كل الشروط السابقة
-            # لاحظ أننا نتحقق من صلاحية التعيين للأستاذ الأقل عبئاً (least_burdened_prof)
-            if is_assignment_valid(least_burdened_prof, exam, temp_assignments, temp_large_counts, settings_for_validation, date_map):
-                # --- بداية التعديل الشامل والمقترح ---
-                exam_in_schedule = next((e for e in temp_schedule[date][time] if e.get('uuid') == exam.get('uuid')), None)
-                if not exam_in_schedule: continue
-
-                # الخطوة 1: الحذف الآمن للحارس القديم من قائمة الحراس
-                try:
-                    # نجد أول ظهور للحارس ونحذفه. هذا أكثر أمانًا من .remove()
-                    guard_index_to_remove = exam_in_schedule['guards'].index(most_burdened_prof)
-                    del exam_in_schedule['guards'][guard_index_to_remove]
-                    exam_in_schedule['guards'].append(least_burdened_prof)
-                except ValueError:
-                    # إذا لم يتم العثور على الحارس، نتجاهل هذا التبديل وننتقل للتالي
-                    # هذا يعالج الخطأ مباشرة "list.remove(x): x not in list"
-                    continue
-
-                # الخطوة 2: تحديث إحصائيات عبء العمل
-                duty_weight = large_hall_weight if is_large_hall_exam else other_hall_weight
-                temp_workload[most_burdened_prof] -= duty_weight
-                temp_workload[least_burdened_prof] += duty_weight
-                if is_large_hall_exam:
-                    temp_large_counts[most_burdened_prof] -= 1
-                    temp_large_counts[least_burdened_prof] = temp_large_counts.get(least_burdened_prof, 0) + 1
-                
-                # الخطوة 3: الحذف الآمن للامتحان من قائمة مهام الحارس القديم
-                exam_to_remove_index = -1
-                for i, assigned_exam in enumerate(temp_assignments[most_burdened_prof]):
-                    if assigned_exam.get('uuid') == exam.get('uuid'):
-                        exam_to_remove_index = i
-                        break
-                
-                if exam_to_remove_index != -1:
-                    del temp_assignments[most_burdened_prof][exam_to_remove_index]
-                else:
-                    # هذا لا يفترض أن يحدث، ولكنه إجراء احترازي لمنع أخطاء مستقبلية
-                    continue 
-
-                # الخطوة 4: إضافة الامتحان لقائمة مهام الحارس الجديد
-                temp_assignments[least_burdened_prof].append(exam)
-                
-                swap_found = True
-                break
-                # --- نهاية التعديل الشامل والمقترح ---
-        
-        if not swap_found:
-            break 
+        # لاحظ أننا نتحقق من صلاحية التعيين للأستاذ الأقل عبئاً (least_burdened_prof)، لكل المرشحين دفعة واحدة
+        eligible = feasibility.prof_eligible_mask(instance.prof_id(least_burdened_prof), feasibility.exam_columns([exam for _, exam in possible_swaps]))
+        if not eligible.any():
+            break
+        exam_to_remove_index, exam = possible_swaps[int(np.argmax(eligible))]
+
+        # الخطوة 1: نقل الحارس في قائمة حراس الامتحان (قوائم التعيينات تشير لامتحانات temp_schedule نفسها)
+        guard_index_to_remove = exam['guards'].index(most_burdened_prof)
+        del exam['guards'][guard_index_to_remove]
+        exam['guards'].append(least_burdened_prof)
+        feasibility.add_duty(exam, most_burdened_prof, -1)
+        feasibility.add_duty(exam, least_burdened_prof, 1)
+
+        # الخطوة 2: تحديث إحصائيات عبء العمل والكومتين
+        duty_weight = instance.duty_weight(exam)
+        temp_workload[most_burdened_prof] -= duty_weight
+        temp_workload[least_burdened_prof] += duty_weight
+        if instance.is_large(exam):
+            temp_large_counts[most_burdened_prof] -= 1
+            temp_large_counts[least_burdened_prof] = temp_large_counts.get(least_burdened_prof, 0) + 1
+        for prof in (most_burdened_prof, least_burdened_prof):
+            heapq.heappush(max_heap, (-temp_workload[prof], prof))
+            heapq.heappush(min_heap, (temp_workload[prof], prof))
+
+        # الخطوة 3: نقل الامتحان من قائمة مهام الحارس القديم إلى الجديد
+        del temp_assignments[most_burdened_prof][exam_to_remove_index]
+        temp_assignments[least_burdened_prof].append(exam)
             
     return temp_schedule, temp_assignments, temp_workload, temp_large_counts
 
@@ -671,91 +918,76 @@ def run_post_processing_swaps(schedule, prof_assignments, prof_workload, prof_la
 # START: FINAL BALANCER V3 (Simulated Annealing for Global Optimization)
 # =====================================================================================
 
-def run_simulated_annealing_balancer(schedule, settings, all_professors, duty_patterns, date_map, locked_guards=set(), stop_event=None, log_q=None):
+def run_simulated_annealing_balancer(schedule, settings, all_professors, duty_patterns, date_map, locked_guards=set(), stop_event=None, log_q=None, instance=None):
     """
     (النسخة النهائية V3)
     تستخدم خوارزمية "التلدين المحاكي" للهروب من الحلول المثلى المحلية وتحقيق أفضل توازن ممكن.
     تضمن هذه النسخة عدم خرق أي قيود صارمة على الإطلاق.
+    - الحالة تزايدية بالكامل عبر CostEvaluator: عدد (كبيرة، أخرى) لكل أستاذ ومدرج الأنماط الفعلي مقابل الهدف
+      يُحدَّثان مع كل حركة، فيُحسب فرق الانحراف من خانات الأستاذين المعنيين فقط بدل إعادة عدّ الجدول.
+    - لذلك عدد الدورات أكبر بكثير، ومعدل التبريد يُشتق منه ليغطي نفس مدى الحرارة.
     """
     if log_q: log_q.put("... [صقل نهائي] تشغيل موازنة التلدين المحاكي الذكية...")
 
     # --- 1. استخلاص الإعدادات والتحقق ---
-    custom_target_patterns = settings.get('customTargetPatterns', [])
-    if not custom_target_patterns:
+    instance = get_problem_instance(instance, settings, all_professors, duty_patterns, date_map)
+    if not instance.custom_target_counts:
         return schedule # لا يمكن التشغيل بدون أهداف مخصصة
 
-    iterations = int(settings.get('swapAttempts', 100)) * 5 # زيادة كبيرة في المحاولات لهذه الخوارزمية القوية
+    iterations = int(settings.get('saIterations', int(settings.get('swapAttempts', 100)) * 500))
     initial_temp = 10.0
-    cooling_rate = 0.995 # معدل تبريد بطيء لاستكشاف أفضل
-    
-    target_counts = Counter((p['large'], p['other']) for p in custom_target_patterns for _ in range(p.get('count', 0)))
+    final_temp = 0.01
+    cooling_rate = (final_temp / initial_temp) ** (1.0 / max(iterations, 1)) # تبريد بطيء يصل للحرارة الدنيا مع آخر دورة
 
     # --- 2. الإعدادات الأولية للبحث ---
+    # الحركات تُطبَّق على الحل الحالي مباشرة ويُتراجع عنها عند الرفض
     current_solution = copy.deepcopy(schedule)
     best_solution_so_far = copy.deepcopy(schedule)
-    
-    # دالة مساعدة داخلية لحساب الحالة الحالية
-    def get_current_stats(sch):
-        prof_stats = {prof: {'large': 0, 'other': 0} for prof in all_professors}
-        guards_large_hall = int(settings.get('guardsLargeHall', 4))
-        for exam in (e for day in sch.values() for slot in day.values() for e in slot):
-            guards_copy = [g for g in exam.get('guards', []) if g != "**نقص**"]
-            large_guards_needed = sum(guards_large_hall for h in exam.get('halls', []) if h.get('type') == 'كبيرة')
-            for idx, guard in enumerate(guards_copy):
-                if guard in prof_stats:
-                    if idx < large_guards_needed: prof_stats[guard]['large'] += 1
-                    else: prof_stats[guard]['other'] += 1
-        return prof_stats
-
-    # حساب الانحراف
-    def get_deviation(stats):
-        actual_counts = Counter((s['large'], s['other']) for s in stats.values())
-        all_p = set(target_counts.keys()) | set(actual_counts.keys())
-        # ✅ توحيد الحساب ليطابق دالة التكلفة الرئيسية
-        return sum(abs(actual_counts.get(p, 0) - target_counts.get(p, 0)) for p in all_p) * 2.0
-
-    current_stats = get_current_stats(current_solution)
-    current_deviation = get_deviation(current_stats)
+    evaluator = CostEvaluator(instance, current_solution)
+    feasibility = evaluator.feasibility
+
+    # مواقع المهام القابلة للنقل ثابتة: الحركة تستبدل الحارس في موقعه، ومواقع النقص والمهام المقفلة لا تُلمس
+    duty_positions = [(exam, idx) for exam in evaluator.exams for idx, g in enumerate(exam['guards'])
+                      if g != "**نقص**" and (exam.get('uuid'), g) not in locked_guards]
+    if not duty_positions or not all_professors:
+        return best_solution_so_far
+
+    current_deviation = evaluator.pattern_abs_dev * 2.0
     best_deviation_so_far = current_deviation
-    
     temp = initial_temp
+    last_percent = -1
 
     # --- 3. حلقة التلدين المحاكي الرئيسية ---
     for i in range(iterations):
-        if log_q: log_q.put(f"PROGRESS:{int(((i + 1) / iterations) * 100)}")
-        if stop_event and stop_event.is_set(): break
-        if temp < 0.01: break # توقف إذا بردت الحرارة تماماً
+        percent_complete = int(((i + 1) / iterations) * 100)
+        if percent_complete != last_percent:
+            last_percent = percent_complete
+            report_progress(log_q, percent_complete, phase='SA', iteration=i + 1)
+            if stop_event and stop_event.is_set(): break
+        if temp < final_temp: break # توقف إذا بردت الحرارة تماماً
 
-        # --- 4. إنشاء "حركة" أو "تبديل" عشوائي ---
-        # هذا يجعل البحث غير متوقع ويساعد على استكشاف الحلول بشكل أفضل
-        all_duties = [(exam, g, idx) for exam in (exam for day in current_solution.values() for slot in day.values() for exam in slot) for idx, g in enumerate(exam.get('guards',[])) if g != "**نقص**" and (exam.get('uuid'), g) not in locked_guards]
-        if not all_duties: break
-        
-        exam_to_swap, prof_donor, guard_idx = random.choice(all_duties)
-        
-        possible_recipients = [p for p in all_professors if p != prof_donor and p not in exam_to_swap.get('guards',[])]
-        if not possible_recipients: continue
-        prof_recipient = random.choice(possible_recipients)
-
-        # --- 5. التحقق الشامل من صحة التبديل (حل المشكلة الأولى) ---
-        neighbor_solution = copy.deepcopy(current_solution)
-        # العثور على نسخة الامتحان في الحل الجديد وتطبيق التغيير
-        exam_in_neighbor = next(e for e in neighbor_solution[exam_to_swap['date']][exam_to_swap['time']] if e.get('uuid') == exam_to_swap.get('uuid'))
-        exam_in_neighbor['guards'][guard_idx] = prof_recipient
-        
-        # ✅ الضمانة المطلقة: التحقق من الجدول بأكمله بعد التبديل
-        if not is_schedule_valid(neighbor_solution, settings, all_professors, duty_patterns, date_map):
+        # --- 4. إنشاء "حركة" عشوائية: نقل مهمة من حارسها إلى أستاذ آخر ليس في نفس الامتحان ---
+        exam_to_swap, guard_idx = random.choice(duty_positions)
+        prof_recipient = random.choice(all_professors)
+        if prof_recipient in exam_to_swap['guards']:
+            temp *= cooling_rate
+            continue
+
+        # --- 5. التحقق من صحة التبديل (نفس شروط is_schedule_valid، تزايدياً) ---
+        undo_move = evaluator.apply([(exam_to_swap, guard_idx, prof_recipient)])
+        if not feasibility.is_valid():
+            evaluator.undo(undo_move)
+            temp *= cooling_rate
             continue # إذا كان التبديل يخرق أي قيد، تجاهله تماماً وابدأ محاولة جديدة
 
-        # --- 6. تقييم الحركة وقبولها (حل المشكلة الثانية) ---
-        neighbor_stats = get_current_stats(neighbor_solution)
-        neighbor_deviation = get_deviation(neighbor_stats)
-        
+        # --- 6. تقييم الحركة وقبولها: فرق الانحراف من المدرج المُحدَّث ---
+        neighbor_deviation = evaluator.pattern_abs_dev * 2.0
         delta = neighbor_deviation - current_deviation
 
         # معيار القبول: إما أن يكون الحل أفضل، أو يتم قبوله باحتمالية تعتمد على الحرارة
-        if delta < 0 or random.random() < (math.exp(-delta / temp) if temp > 0 else 0):
-            current_solution = neighbor_solution
+        if not (delta < 0 or random.random() < (math.exp(-delta / temp) if temp > 0 else 0)):
+            evaluator.undo(undo_move)
+        else:
             current_deviation = neighbor_deviation
             
             # تحديث أفضل حل تم العثور عليه على الإطلاق
@@ -778,86 +1010,108 @@ def run_simulated_annealing_balancer(schedule, settings, all_professors, duty_pa
 # START: V2 - Advanced Polisher with more powerful moves
 # =====================================================================================
 
-def run_advanced_polisher(schedule, settings, all_professors, duty_patterns, date_map, locked_guards=set(), stop_event=None, log_q=None):
+def run_advanced_polisher(schedule, settings, all_professors, duty_patterns, date_map, locked_guards=set(), stop_event=None, log_q=None, instance=None):
     """
     (النسخة V2 - المحسنة)
     تستخدم نوعين من الحركات: تبديل مهمة واحدة (للتحسين الدقيق) وتبديل
     مهام يوم كامل (لتحسين القيود المرنة بفعالية دون التأثير على الانحراف).
+    - الحركات واصفات تُطبَّق على الحل الحالي عبر CostEvaluator (صلاحية وتكلفة تزايدية) ويُتراجع عنها عند الرفض.
+    - تبديل اليوم الكامل بين أستاذين يعملان في اليوم نفسه لا يغيّر أيامهما: يُتخطى إذا تساوت أعداد أدوارهما
+      (كبيرة، أخرى) في ذلك اليوم لأن التكلفة لا تتغير، ويُفحص مسبقاً بسقفي المهام والقاعات الكبيرة فقط.
+    - مسح منهجي بأول تحسين (first-improvement) بدل العينات العشوائية، حتى لا يبقى تحسين أو تنفد الميزانية.
     """
     if log_q: log_q.put("... [صقل متقدم] بدء مرحلة تحسين القيود المرنة بأدوات قوية...")
 
-    iterations = int(settings.get('swapAttempts', 100)) * 2
+    max_evaluations = int(settings.get('polisherEvaluations', int(settings.get('swapAttempts', 100)) * 200))
+    instance = get_problem_instance(instance, settings, all_professors, duty_patterns, date_map)
     
     current_solution = copy.deepcopy(schedule)
-    best_cost_so_far = calculate_cost(current_solution, settings, all_professors, duty_patterns, date_map)
+    evaluator = CostEvaluator(instance, current_solution)
+    feasibility = evaluator.feasibility
+    best_cost_so_far = evaluator.cost()
+    prof_ids = np.array([instance.prof_id(p) for p in all_professors], dtype=np.int64)
     
     sorted_dates = sorted(current_solution.keys())
 
-    for i in range(iterations):
-        if stop_event and stop_event.is_set(): break
-        
-        neighbor_solution = copy.deepcopy(current_solution)
-        move_type = random.choice(['single_duty_swap', 'full_day_swap']) # اختر حركة بشكل عشوائي
-
-        # --- الحركة الأولى: تبديل مهمة واحدة (نفس السابق) ---
-        if move_type == 'single_duty_swap':
-            all_exams_flat = [exam for day in neighbor_solution.values() for slot in day.values() for exam in slot]
-            all_duties = [(exam, g, idx) for exam in all_exams_flat for idx, g in enumerate(exam.get('guards',[])) if g != "**نقص**" and (exam.get('uuid'), g) not in locked_guards]
-            if not all_duties: continue
-            
-            exam_to_swap, prof_donor, guard_idx = random.choice(all_duties)
-            possible_recipients = [p for p in all_professors if p != prof_donor and p not in exam_to_swap.get('guards',[])]
-            if not possible_recipients: continue
-            prof_recipient = random.choice(possible_recipients)
-
-            exam_in_neighbor = next(e for e in neighbor_solution[exam_to_swap['date']][exam_to_swap['time']] if e.get('uuid') == exam_to_swap.get('uuid'))
-            exam_in_neighbor['guards'][guard_idx] = prof_recipient
-
-        # --- الحركة الثانية: تبديل مهام يوم كامل (الجديدة والقوية) ---
-        elif move_type == 'full_day_swap':
-            if not sorted_dates: continue
-            day_to_swap = random.choice(sorted_dates)
-            
-            # ابحث عن كل الحراس الذين يعملون في هذا اليوم
-            guards_on_day = set()
-            for slot in neighbor_solution[day_to_swap].values():
-                for exam in slot:
-                    for guard in exam.get('guards', []):
-                        if guard != "**نقص**":
-                            guards_on_day.add(guard)
-            
-            if len(guards_on_day) < 2: continue
-            
-            prof1, prof2 = random.sample(list(guards_on_day), 2)
-
-            # قم بتبديل كل ظهور لـ prof1 بـ prof2 والعكس، في هذا اليوم فقط
-            for slot in neighbor_solution[day_to_swap].values():
-                for exam in slot:
-                    new_guards = []
-                    is_locked = False
-                    for guard in exam.get('guards', []):
-                        if (exam.get('uuid'), guard) in locked_guards:
-                            is_locked = True
-                            break
-                    if is_locked: continue
-
-                    for guard in exam.get('guards', []):
-                        if guard == prof1: new_guards.append(prof2)
-                        elif guard == prof2: new_guards.append(prof1)
-                        else: new_guards.append(guard)
-                    exam['guards'] = new_guards
-
-        # --- التقييم والقبول (لا تغيير هنا) ---
-        if not is_schedule_valid(neighbor_solution, settings, all_professors, duty_patterns, date_map):
-            continue
-
-        new_cost = calculate_cost(neighbor_solution, settings, all_professors, duty_patterns, date_map)
-        
-        if new_cost < best_cost_so_far:
-            best_cost_so_far = new_cost
-            current_solution = copy.deepcopy(neighbor_solution)
-            if log_q: log_q.put(f"... [صقل متقدم] تم العثور على تحسين! التكلفة الجديدة: {format_cost_tuple(best_cost_so_far)}")
+    accepted_moves = [0] # يزداد مع كل حركة مقبولة، فتعيد المولدات بناء ما حسبته من الحالة السابقة
 
+    def duties_on_day(date):
+        duties_by_guard = defaultdict(list)
+        for slot in current_solution[date].values():
+            for exam in slot:
+                if any((exam.get('uuid'), guard) in locked_guards for guard in exam.get('guards', [])): continue
+                for g_idx, guard in enumerate(exam.get('guards', [])):
+                    if guard != "**نقص**":
+                        duties_by_guard[guard].append((exam, g_idx))
+        return duties_by_guard
+
+    def day_swap_moves(date):
+        """واصفات تبديل يوم كامل (قائمة التعديلات) لأزواج أساتذة اليوم الذين تختلف أعداد أدوارهم (كبيرة، أخرى) فعلاً."""
+        duties_by_guard, seen_version = duties_on_day(date), accepted_moves[0]
+        guards_on_day = sorted(duties_by_guard, key=lambda g: -feasibility.workload[instance.prof_id(g)])
+        for a, prof1 in enumerate(guards_on_day):
+            for prof2 in guards_on_day[a + 1:]:
+                if seen_version != accepted_moves[0]:
+                    duties_by_guard, seen_version = duties_on_day(date), accepted_moves[0]
+                duties1, duties2 = duties_by_guard.get(prof1, []), duties_by_guard.get(prof2, [])
+                if not duties1 or not duties2: continue
+                p1, p2 = instance.prof_id(prof1), instance.prof_id(prof2)
+                # الانحراف يتبع أدوار المواقع (كبيرة، أخرى) لا نوع القاعة: نفس العدد من كل دور يعني نفس التكلفة
+                # (الأيام لا تتغير أصلاً، فالقيود المرنة ثابتة)
+                role_large1 = sum(evaluator.is_large_role(exam, g_idx) for exam, g_idx in duties1)
+                role_large2 = sum(evaluator.is_large_role(exam, g_idx) for exam, g_idx in duties2)
+                if len(duties1) == len(duties2) and role_large1 == role_large2: continue
+                # السقفان: الفحص الوحيد الممكن فشله، لأن الأستاذين يعملان في هذا اليوم أصلاً
+                large1 = sum(instance.is_large(exam) for exam, _ in duties1)
+                large2 = sum(instance.is_large(exam) for exam, _ in duties2)
+                if feasibility.shifts[p1] - len(duties1) + len(duties2) > instance.max_shifts: continue
+                if feasibility.shifts[p2] - len(duties2) + len(duties1) > instance.max_shifts: continue
+                if feasibility.large[p1] - large1 + large2 > instance.max_large_hall_shifts: continue
+                if feasibility.large[p2] - large2 + large1 > instance.max_large_hall_shifts: continue
+                yield [(exam, g_idx, prof2) for exam, g_idx in duties1] + [(exam, g_idx, prof1) for exam, g_idx in duties2]
+
+    def single_duty_moves():
+        """واصفات نقل مهمة واحدة: من الأكثر عبئاً أولاً، إلى المرشحين الصالحين من الأقل عبئاً أولاً."""
+        duties = [(exam, g_idx, guard) for exam in evaluator.exams for g_idx, guard in enumerate(exam.get('guards', []))
+                  if guard != "**نقص**" and (exam.get('uuid'), guard) not in locked_guards]
+        duties.sort(key=lambda duty: -feasibility.workload[instance.prof_id(duty[2])])
+        for exam, g_idx, donor in duties:
+            if exam['guards'][g_idx] != donor: continue # تغيّرت المهمة بحركة سابقة في نفس المسح
+            eligible = np.flatnonzero(feasibility.eligible_mask(exam)[prof_ids])
+            for j in eligible[np.argsort(feasibility.workload[prof_ids[eligible]], kind='stable')]:
+                if exam['guards'][g_idx] != donor: break
+                yield [(exam, g_idx, all_professors[j])]
+
+    evaluations, sweep, improvements = 0, 0, 0
+    improved_in_sweep = True
+    while improved_in_sweep and evaluations < max_evaluations:
+        if stop_event and stop_event.is_set(): break
+        sweep += 1
+        improved_in_sweep = False
+        sweep_dates = sorted_dates[:]
+        random.shuffle(sweep_dates)
+        candidate_moves = itertools.chain((move for date in sweep_dates for move in day_swap_moves(date)), single_duty_moves())
+        for move in candidate_moves:
+            if evaluations >= max_evaluations or (stop_event and stop_event.is_set()): break
+            evaluations += 1
+
+            # --- التقييم والقبول (تحسين صارم فقط) ---
+            undo_move = evaluator.apply(move)
+            if not feasibility.is_valid():
+                evaluator.undo(undo_move)
+                continue
+            new_cost = evaluator.cost()
+            if not new_cost < best_cost_so_far:
+                evaluator.undo(undo_move)
+            else:
+                best_cost_so_far = new_cost
+                improvements += 1
+                accepted_moves[0] += 1
+                improved_in_sweep = True
+                if log_q: log_q.put(f"... [صقل متقدم] تم العثور على تحسين! التكلفة الجديدة: {format_cost_tuple(best_cost_so_far)}")
+        report_progress(log_q, min(100, int(evaluations / max(max_evaluations, 1) * 100)), phase='Polisher', iteration=evaluations, best_cost=best_cost_so_far)
+
+    if log_q: log_q.put(f"... [صقل متقدم] {sweep} مسح، {evaluations} حركة مُقيَّمة، {improvements} تحسين.")
     if log_q: log_q.put(f"✓ انتهت مرحلة الصقل المتقدم. أفضل تكلفة تم الوصول إليها: {format_cost_tuple(best_cost_so_far)}")
     return current_solution
 
@@ -868,12 +1122,13 @@ def run_advanced_polisher(schedule, settings, all_professors, duty_patterns, dat
 # ===================================================================
 # --- START: النسخة النهائية من Tabu Search (مكتملة ومستقرة) ---
 # ===================================================================
-def run_tabu_search(initial_schedule, settings, all_professors, duty_patterns, date_map, log_q, locked_guards=set(), stop_event=None):
+def run_tabu_search(initial_schedule, settings, all_professors, duty_patterns, date_map, log_q, locked_guards=set(), stop_event=None, instance=None):
     """
     النسخة النهائية والمصححة بالكامل:
     - كل الحركات (إصلاح وموازنة) تتحقق من صلاحية القيود قبل تنفيذها.
     - تستخدم المنطق الصحيح للبحث المحظور للهروب من الحلول المحلية.
-    - عالية الكفاءة بفضل بناء الحالة مرة واحدة لكل دورة.
+    - الجيران حركات تُقيَّم تزايديًا على حل حالي واحد (تطبيق/تراجع) بدل نسخ الجدول لكل جار.
+    - الجوار يُولَّد دفعة واحدة ثم يُقيَّم، اختياريًا على عدة عمليات متوازية (tabuWorkers) بنفس النتيجة.
     """
     log_q.put(">>> تشغيل البحث المحظور (النسخة النهائية الكاملة)...")
 
@@ -881,61 +1136,79 @@ def run_tabu_search(initial_schedule, settings, all_professors, duty_patterns, d
     max_iterations = int(settings.get('tabuIterations', 200))
     tabu_tenure = int(settings.get('tabuTenure', 20))
     neighborhood_size = int(settings.get('tabuNeighborhoodSize', 100))
+    try:
+        num_workers = int(settings.get('tabuWorkers', 1))
+    except (ValueError, TypeError):
+        num_workers = 1
+    num_workers = max(1, min(num_workers, os.cpu_count() or 1))
+    owns_instance = instance is None
+    instance = get_problem_instance(instance, settings, all_professors, duty_patterns, date_map)
 
     # --- 2. الإعدادات الأولية للبحث ---
+    # حل حالي واحد قابل للتعديل: الجيران تُقيَّم كحركات (امتحان، موضع الحارس، الأستاذ الجديد) دون نسخ الجدول
     current_solution = copy.deepcopy(initial_schedule)
     best_solution = copy.deepcopy(current_solution)
+    evaluator = CostEvaluator(instance, current_solution)
+    feasibility = evaluator.feasibility
+    all_exams_in_current = evaluator.exams
 
-    current_cost = calculate_cost(current_solution, settings, all_professors, duty_patterns, date_map)
+    current_cost = evaluator.cost()
     best_cost = current_cost
     log_q.put(f"... [Tabu Search] التكلفة الأولية = {format_cost_tuple(best_cost)}")
     tabu_list = deque(maxlen=tabu_tenure)
 
+    # --- تقييم متوازٍ اختياري: كل عملية تحتفظ بنسخة من الحل الحالي تُزامَن بسجل الحركات المطبقة ---
+    exam_positions = {id(exam): idx for idx, exam in enumerate(all_exams_in_current)}
+    applied_moves = []
+    scoring_pool = None
+    if num_workers > 1 and neighborhood_size >= 2 * num_workers:
+        if multiprocessing.parent_process() is not None:
+            # داخل عملية مستقلة (محاولة بحث، جزيرة...): التوازي موجود أصلاً على مستوى العمليات، فلا مجمعات متداخلة
+            log_q.put("... [Tabu Search] تقييم تسلسلي داخل عملية مستقلة (لا مجمع عمليات متداخل).")
+        else:
+            scoring_pool = get_tabu_scoring_pool(instance, settings, all_professors, duty_patterns, date_map, num_workers)
+            scoring_pool.begin(current_solution)
+            log_q.put(f"... [Tabu Search] تقييم الجوار على {num_workers} عمليات متوازية.")
+
     # --- 3. حلقة البحث الرئيسية ---
     for i in range(max_iterations):
         if stop_event and stop_event.is_set(): break
         if settings.get('should_stop_event', threading.Event()).is_set(): break
         percent_complete = int(((i + 1) / max_iterations) * 100)
-        log_q.put(f"PROGRESS:{percent_complete}")
+        report_progress(log_q, percent_complete, phase='Tabu', iteration=i + 1, best_cost=best_cost)
 
         # ✅ تصحيح: تم تغيير float('inf') إلى tuple لتجنب خطأ المقارنة
-        best_neighbor_in_iteration, best_neighbor_cost_in_iteration, best_move_in_iteration = None, (float('inf'), float('inf'), float('inf'), float('inf')), None
-
-        # --- بناء الحالة الحالية مرة واحدة لكل دورة (لتحقيق أقصى كفاءة) ---
-        current_assignments = defaultdict(list); current_large_counts = defaultdict(int)
-        all_exams_in_current = [e for d in current_solution.values() for s in d.values() for e in s]
-        for e in all_exams_in_current:
-            is_large = any(h['type'] == 'كبيرة' for h in e.get('halls', []))
-            for g in e.get('guards', []):
-                if g != "**نقص**":
-                    current_assignments[g].append(e)
-                    if is_large: current_large_counts[g] += 1
+        best_move_in_iteration, best_neighbor_cost_in_iteration, best_tabu_key_in_iteration = None, (float('inf'), float('inf'), float('inf'), float('inf')), None
+
+        # --- قوائم المرشحين تُبنى مرة واحدة لكل دورة لأن الحل الحالي لا يتغير أثناء استكشاف الجوار ---
+        shortage_slots = None
+        all_duties = None
 
         # --- استراتيجية الحركة الديناميكية ---
         repair_probability = 0.8 if current_cost[0] > 0 or current_cost[1] > 0 else 0.1
 
-        # --- 4. استكشاف الجوار ---
+        # --- 4. توليد الجوار كدفعة من الحركات (الحل الحالي لا يتغير أثناء التوليد) ---
+        candidate_moves = []
         for _ in range(neighborhood_size):
-            neighbor = None
             move = None
 
             if random.random() < repair_probability:
                 # --- حركة الإصلاح ---
-                shortage_slots = [(exam, g_idx) for exam in all_exams_in_current for g_idx, g in enumerate(exam.get('guards',[])) if g == "**نقص**"]
+                if shortage_slots is None:
+                    shortage_slots = [(exam, g_idx) for exam in all_exams_in_current for g_idx, g in enumerate(exam.get('guards',[])) if g == "**نقص**"]
                 if not shortage_slots: continue
                 exam_to_repair, guard_idx = random.choice(shortage_slots)
 
                 shuffled_profs = list(all_professors); random.shuffle(shuffled_profs)
-                prof_to_add = next((p for p in shuffled_profs if is_assignment_valid(p, exam_to_repair, current_assignments, current_large_counts, settings, date_map)), None)
+                eligible = feasibility.eligible_mask(exam_to_repair)
+                prof_to_add = next((p for p in shuffled_profs if eligible[instance.prof_index[p]]), None)
 
                 if prof_to_add:
-                    neighbor = copy.deepcopy(current_solution)
-                    exam_in_neighbor = next(e for e in neighbor[exam_to_repair['date']][exam_to_repair['time']] if e.get('uuid') == exam_to_repair.get('uuid'))
-                    exam_in_neighbor['guards'][guard_idx] = prof_to_add
-                    move = (exam_in_neighbor.get('uuid'), guard_idx)
+                    move = (exam_to_repair, guard_idx, prof_to_add)
             else:
                 # --- حركة الموازنة ---
-                all_duties = [(exam, g, d_idx) for exam in all_exams_in_current for d_idx, g in enumerate(exam.get('guards',[])) if g != "**نقص**" and (exam.get('uuid'), g) not in locked_guards]
+                if all_duties is None:
+                    all_duties = [(exam, g, d_idx) for exam in all_exams_in_current for d_idx, g in enumerate(exam.get('guards',[])) if g != "**نقص**" and (exam.get('uuid'), g) not in locked_guards]
                 if not all_duties: continue
 
                 exam_to_change, prof1, guard_idx = random.choice(all_duties)
@@ -943,35 +1216,40 @@ def run_tabu_search(initial_schedule, settings, all_professors, duty_patterns, d
                 if not possible_profs: continue
                 prof2 = random.choice(possible_profs)
 
-                if not is_assignment_valid(prof2, exam_to_change, current_assignments, current_large_counts, settings, date_map):
+                if not feasibility.eligible_mask(exam_to_change)[instance.prof_index[prof2]]:
                     continue
 
-                neighbor = copy.deepcopy(current_solution)
-                exam_in_neighbor = next(e for e in neighbor[exam_to_change['date']][exam_to_change['time']] if e.get('uuid') == exam_to_change.get('uuid'))
-                exam_in_neighbor['guards'][guard_idx] = prof2
-                move = (exam_in_neighbor.get('uuid'), guard_idx)
+                move = (exam_to_change, guard_idx, prof2)
+
+            if move:
+                candidate_moves.append(move)
 
-            if not neighbor: continue
+        # --- 5. تقييم الدفعة ثم اختيار أفضل حركة غير محظورة (أو محظورة تحقق شرط الطموح) بترتيب التوليد ---
+        if scoring_pool:
+            candidate_costs = scoring_pool.score(applied_moves, [(exam_positions[id(exam)], g_idx, prof) for exam, g_idx, prof in candidate_moves])
+        else:
+            candidate_costs = [evaluator.cost_after([move]) for move in candidate_moves]
 
-            # --- 5. تقييم الجار وتطبيق منطق المحظورات ---
-            neighbor_cost = calculate_cost(neighbor, settings, all_professors, duty_patterns, date_map)
+        for move, neighbor_cost in zip(candidate_moves, candidate_costs):
+            tabu_key = (move[0].get('uuid'), move[1])
 
-            is_tabu = move in tabu_list
+            is_tabu = tabu_key in tabu_list
             if is_tabu:
                 if neighbor_cost < best_cost: # Aspiration
                     if neighbor_cost < best_neighbor_cost_in_iteration:
-                         best_neighbor_in_iteration, best_neighbor_cost_in_iteration, best_move_in_iteration = neighbor, neighbor_cost, move
+                         best_move_in_iteration, best_neighbor_cost_in_iteration, best_tabu_key_in_iteration = move, neighbor_cost, tabu_key
             else:
                 if neighbor_cost < best_neighbor_cost_in_iteration:
-                    best_neighbor_in_iteration, best_neighbor_cost_in_iteration, best_move_in_iteration = neighbor, neighbor_cost, move
+                    best_move_in_iteration, best_neighbor_cost_in_iteration, best_tabu_key_in_iteration = move, neighbor_cost, tabu_key
 
-        # --- 6. تحديث الحالة للدورة القادمة ---
-        if not best_neighbor_in_iteration:
+        # --- 6. تحديث الحالة للدورة القادمة: تطبيق الحركة المختارة فقط على الحل الحالي ---
+        if not best_move_in_iteration:
             continue
 
-        current_solution = best_neighbor_in_iteration
+        evaluator.apply([best_move_in_iteration])
+        applied_moves.append((exam_positions[id(best_move_in_iteration[0])], best_move_in_iteration[1], best_move_in_iteration[2]))
         current_cost = best_neighbor_cost_in_iteration # Use the already calculated cost
-        tabu_list.append(best_move_in_iteration)
+        tabu_list.append(best_tabu_key_in_iteration)
 
         if current_cost < best_cost:
             best_cost, best_solution = current_cost, copy.deepcopy(current_solution)
@@ -983,8 +1261,13 @@ def run_tabu_search(initial_schedule, settings, all_professors, duty_patterns, d
                     log_q.put("... [Tabu] الحل مثالي، إنهاء البحث.")
                     break
 
+    if scoring_pool and owns_instance:
+        # مجمع استدعاء مباشر بلا نسخة مُجمَّعة من المهمة: لا أحد سيعيد استخدامه
+        scoring_pool.shutdown()
+        instance.tabu_scoring_pool = None
+
     # --- 7. إرجاع أفضل حل تم العثور عليه ---
-    final_cost = calculate_cost(best_solution, settings, all_professors, duty_patterns, date_map)
+    final_cost = calculate_cost(best_solution, settings, all_professors, duty_patterns, date_map, instance=instance)
     log_q.put(f"✓ البحث المحظور انتهى بأفضل تكلفة: {format_cost_tuple(final_cost)}")
     return best_solution, None, None, None
 # ===================================================================
@@ -992,23 +1275,108 @@ def run_tabu_search(initial_schedule, settings, all_professors, duty_patterns, d
 # ===================================================================
 
 
+# --- عمليات التقييم المتوازي للبحث المحظور ---
+class TabuScoringPool:
+    """
+    عمليات spawn لتقييم جوار البحث المحظور، تُنشأ مرة واحدة لكل مهمة وتُعاد لكل استدعاءات run_tabu_search فيها
+    (الخوارزمية الفوقية، جولات التحسين، المحاولات المتتالية) بدل إعادة استيراد البرنامج كله في كل استدعاء.
+    - كل عملية تبني ProblemInstance مرة واحدة، وتحتفظ بمُقيِّم لحل الاستدعاء الحالي فقط (run_key).
+    - العملية التي لم يصلها حل الاستدعاء الحالي ترد بـ None، فيُعاد إرسال الجزء إليها ومعه الحل (مرة واحدة لكل عملية).
+    - لا يُرسل من سجل الحركات المطبقة إلا ما أُضيف منذ الدفعة السابقة (sent_moves)؛ العملية التي فاتتها دفعة
+      ترد بـ None فيُعاد إرسال الحالة كاملة (الحل + السجل كله).
+    """
+    def __init__(self, settings, all_professors, duty_patterns, date_map, num_workers):
+        self.num_workers = num_workers
+        self.executor = ProcessPoolExecutor(
+            max_workers=num_workers, mp_context=multiprocessing.get_context('spawn'), initializer=_init_tabu_scoring_worker,
+            initargs=(settings, all_professors, duty_patterns, date_map)
+        )
+        self.run_key, self.schedule, self.sent_moves = None, None, 0
+
+    def begin(self, schedule):
+        """بداية استدعاء جديد للبحث المحظور على هذا الحل."""
+        self.run_key = uuid.uuid4().hex
+        self.schedule = json.loads(json.dumps(schedule, ensure_ascii=False))
+        self.sent_moves = 0
+
+    def score(self, applied_moves, moves):
+        """تقسم الدفعة إلى أجزاء متتالية (جزء لكل عملية) وتعيد التكاليف بنفس ترتيب الحركات."""
+        chunk_size = max(1, math.ceil(len(moves) / self.num_workers))
+        chunks = [moves[start:start + chunk_size] for start in range(0, len(moves), chunk_size)]
+        # لا يُرسل إلا ذيل السجل الجديد منذ الدفعة السابقة، مع موضع بدايته
+        base = self.sent_moves
+        new_moves = applied_moves[base:]
+        futures = [self.executor.submit(_score_tabu_moves_in_worker, self.run_key, base, new_moves, chunk) for chunk in chunks]
+        self.sent_moves = len(applied_moves)
+        costs = []
+        for chunk, future in zip(chunks, futures):
+            chunk_costs = future.result()
+            if chunk_costs is None:
+                chunk_costs = self.executor.submit(_score_tabu_moves_in_worker, self.run_key, 0, applied_moves, chunk, self.schedule).result()
+            costs.extend(chunk_costs)
+        return costs
+
+    def shutdown(self):
+        self.executor.shutdown(cancel_futures=True)
+
+
+def get_tabu_scoring_pool(instance, settings, all_professors, duty_patterns, date_map, num_workers):
+    """مجمع التقييم المرتبط بالنسخة المُجمَّعة من المهمة، يُنشأ عند أول حاجة (أو إذا تغير عدد العمليات)."""
+    pool = instance.tabu_scoring_pool
+    if pool is None or pool.num_workers != num_workers:
+        if pool is not None:
+            pool.shutdown()
+        pool = instance.tabu_scoring_pool = TabuScoringPool(settings, all_professors, duty_patterns, date_map, num_workers)
+    return pool
+
+
+_TABU_WORKER_STATE = {}
+
+def _init_tabu_scoring_worker(settings, all_professors, duty_patterns, date_map):
+    """يبني النسخة المُجمَّعة من المسألة مرة واحدة عند بدء العملية."""
+    _TABU_WORKER_STATE.update(instance=ProblemInstance(settings, all_professors, duty_patterns, date_map), run_key=None)
+
+def _score_tabu_moves_in_worker(run_key, base, new_moves, moves, schedule=None):
+    """
+    يطبق الحركات المختارة التي لم تصل هذه العملية بعد (new_moves تبدأ من الموضع base في السجل)،
+    ثم يُرجع تكلفة كل حركة مرشحة دون تغيير الحل.
+    يُرجع None إذا كان الاستدعاء جديداً على هذه العملية أو فاتتها حركات قبل base، ولم يُرسل معه الحل.
+    """
+    state = _TABU_WORKER_STATE
+    in_sync = state['run_key'] == run_key and base <= state['num_applied'] <= base + len(new_moves)
+    if not in_sync:
+        if schedule is None:
+            return None
+        instance = state['instance']
+        for exam in instance.flat_exams(schedule):
+            instance.refresh_exam(exam)
+        state.update(run_key=run_key, evaluator=CostEvaluator(instance, schedule), num_applied=0)
+    evaluator = state['evaluator']
+    exams = evaluator.exams
+    for exam_idx, guard_idx, prof in new_moves[state['num_applied'] - base:]:
+        evaluator.apply([(exams[exam_idx], guard_idx, prof)])
+    state['num_applied'] = base + len(new_moves)
+    return [evaluator.cost_after([(exams[exam_idx], guard_idx, prof)]) for exam_idx, guard_idx, prof in moves]
+
+
 
 
 # ===================================================================
 # --- START: COST FUNCTION V6 (DEVIATION > SOFT CONSTRAINTS) ---
 # ===================================================================
-def calculate_cost(schedule, settings, all_professors, duty_patterns, date_map):
+def calculate_cost(schedule, settings, all_professors, duty_patterns, date_map, instance=None):
     """
     (النسخة V6) تعطي الأولوية للانحراف عن التوزيع على القيود المرنة.
     """
+    instance = get_problem_instance(instance, settings, all_professors, duty_patterns, date_map)
     # حساب كل المكونات بشكل منفصل
     
     # 1. نقص الحراسة
-    all_exams_flat = [exam for day in schedule.values() for slot in day.values() for exam in slot]
-    shortage_component = sum(e.get('guards', []).count("**نقص**") for e in (exam for day in schedule.values() for slot in day.values() for exam in slot))
+    all_exams_flat = instance.flat_exams(schedule)
+    shortage_component = sum(e.get('guards', []).count("**نقص**") for e in all_exams_flat)
 
     # 2. القيود الصارمة
-    hard_constraint_component = 1 if not is_schedule_valid(schedule, settings, all_professors, duty_patterns, date_map) else 0
+    hard_constraint_component = 1 if not is_schedule_valid(schedule, settings, all_professors, duty_patterns, date_map, instance=instance) else 0
 
     # 3. القيود المرنة (الهيكلية)
     soft_constraint_component = 0
@@ -1038,29 +1406,22 @@ def calculate_cost(schedule, settings, all_professors, duty_patterns, date_map):
 
     # 4. الانحراف عن التوزيع
     deviation_component = 0.0
-    # ... (نفس منطق حساب balance_cost)
-    # ...
-    large_hall_weight = float(settings.get('largeHallWeight', 3.0))
     prof_stats = {prof: {'large': 0, 'other': 0} for prof in all_professors}
-    guards_large_hall = int(settings.get('guardsLargeHall', 4))
     for exam in all_exams_flat:
         guards_copy = [g for g in exam.get('guards', []) if g != "**نقص**"]
-        large_guards_needed = sum(guards_large_hall for h in exam.get('halls', []) if h.get('type') == 'كبيرة')
+        large_guards_needed = instance.large_guards_needed(exam)
         for guard in guards_copy[:large_guards_needed]:
             if guard in prof_stats: prof_stats[guard]['large'] += 1
         for guard in guards_copy[large_guards_needed:]:
             if guard in prof_stats: prof_stats[guard]['other'] += 1
-            
-    enable_custom_targets = settings.get('enableCustomTargets', False)
-    custom_target_patterns = settings.get('customTargetPatterns', [])
 
-    if enable_custom_targets and custom_target_patterns:
-        target_counts = Counter((p['large'], p['other']) for p in custom_target_patterns for _ in range(p.get('count', 0)))
+    if instance.use_custom_targets:
+        target_counts = instance.custom_target_counts
         actual_counts = Counter((s['large'], s['other']) for s in prof_stats.values())
         total_deviation = sum(abs(actual_counts.get(p, 0) - target_counts.get(p, 0)) for p in set(target_counts.keys()) | set(actual_counts.keys()))
         deviation_component = total_deviation * 2.0
     else:
-        prof_workload = {p: s['large'] * large_hall_weight + s['other'] for p, s in prof_stats.items()}
+        prof_workload = {p: s['large'] * instance.large_hall_weight + s['other'] for p, s in prof_stats.items()}
         if prof_workload:
             workload_values = list(prof_workload.values())
             deviation_component = max(workload_values) - min(workload_values) if workload_values else 0.0
@@ -1071,6 +1432,467 @@ def calculate_cost(schedule, settings, all_professors, duty_patterns, date_map):
 # --- END: COST FUNCTION V6 ---
 # ===================================================================
 
+# ===================================================================
+# --- START: المُقيِّم التزايدي للتكلفة والقيود الصارمة (FeasibilityTracker / CostEvaluator) ---
+# ===================================================================
+class FeasibilityTracker:
+    """
+    متتبع تزايدي للقيود الصارمة بنفس شروط is_schedule_valid، مبني على مصفوفات NumPy.
+    يحفظ لكل أستاذ: إشغال الخانات الزمنية (أستاذ × خانة)، أيام الحراسة (أستاذ × يوم)، عدد الحصص،
+    حصص القاعة الكبيرة والعبء الموزون، ويعيد فحص الأساتذة الذين تلمسهم الحركة فقط
+    (السقوف، النمط، تطابق أيام الأزواج).
+    eligible_mask(exam) تعيد متجه الأساتذة الصالحين لمهمة بنفس شروط is_assignment_valid.
+    """
+    UNKNOWN_DATE_POS = -10 ** 6
+
+    def __init__(self, instance, exams=()):
+        self.instance = instance
+        self.num_base_profs = instance.num_professors
+        self.shortage = 0
+        self.double_bookings = 0
+        self.unavailable_hits = 0
+        self.over_limit_profs = set()
+        self.pattern_violators = set()
+        self.broken_pairs = set()
+        self.pairs_of_prof = defaultdict(list)
+        for pair_idx, (p1, p2) in enumerate(instance.partner_pairs):
+            self.pairs_of_prof[p1].append(pair_idx)
+            self.pairs_of_prof[p2].append(pair_idx)
+
+        # --- الأعمدة: الأيام بترتيب date_map، ثم أي تاريخ غير معروف يُضاف عند أول ظهور ---
+        self.date_cols = {date: col for col, date in enumerate(instance.dates)}
+        self.date_pos = np.array([instance.date_map[d] for d in instance.dates] or [self.UNKNOWN_DATE_POS], dtype=np.int64)
+
+        num_rows = max(len(instance.prof_names), 1)
+        num_slots = max(len(instance.slots), 1)
+        num_cols = len(self.date_pos)
+        self.busy = np.zeros((num_rows, num_slots), dtype=np.int32)
+        self.day_counts = np.zeros((num_rows, num_cols), dtype=np.int32)
+        self.num_days = np.zeros(num_rows, dtype=np.int32)
+        self.day_pos_sum = np.zeros(num_rows, dtype=np.int64)
+        self.shifts = np.zeros(num_rows, dtype=np.int32)
+        self.large = np.zeros(num_rows, dtype=np.int32)
+        self.workload = np.zeros(num_rows, dtype=np.float64)
+        self.unavailable = np.zeros((num_rows, num_cols), dtype=bool)
+        self.assign_codes = np.zeros(num_rows, dtype=np.int8)
+        self.num_filled_profs = 0
+        self._fill_prof_facts()
+
+        for exam in exams:
+            exam.setdefault('guards', [])
+            for guard in exam['guards']:
+                self.add_duty(exam, guard, 1)
+
+    # ---------------- النمو عند ظهور أستاذ/خانة/يوم جديد ----------------
+    def _fill_prof_facts(self):
+        inst = self.instance
+        for p_id in range(self.num_filled_profs, len(inst.prof_names)):
+            self.assign_codes[p_id] = inst.assign_pattern_codes[p_id]
+            for date in inst.unavailable_dates[p_id]:
+                col = self.date_cols.get(date)
+                if col is not None: self.unavailable[p_id, col] = True
+        self.num_filled_profs = len(inst.prof_names)
+
+    def _ensure_prof(self, p_id):
+        rows = self.busy.shape[0]
+        if p_id < self.num_filled_profs:
+            return
+        if p_id < rows:
+            self._fill_prof_facts()
+            return
+        new_rows = max(p_id + 1, rows * 2)
+        grow = lambda arr: np.concatenate([arr, np.zeros((new_rows - rows,) + arr.shape[1:], dtype=arr.dtype)])
+        self.busy, self.day_counts, self.unavailable = grow(self.busy), grow(self.day_counts), grow(self.unavailable)
+        self.num_days, self.day_pos_sum, self.shifts = grow(self.num_days), grow(self.day_pos_sum), grow(self.shifts)
+        self.large, self.workload, self.assign_codes = grow(self.large), grow(self.workload), grow(self.assign_codes)
+        self._fill_prof_facts()
+
+    def _ensure_slot(self, slot):
+        cols = self.busy.shape[1]
+        if slot >= cols:
+            extra = np.zeros((self.busy.shape[0], max(slot + 1, cols * 2) - cols), dtype=self.busy.dtype)
+            self.busy = np.concatenate([self.busy, extra], axis=1)
+
+    def _date_col(self, date):
+        col = self.date_cols.get(date)
+        if col is None:
+            col = self.date_cols[date] = self.day_counts.shape[1]
+            self.date_pos = np.append(self.date_pos, self.instance.date_map.get(date, self.UNKNOWN_DATE_POS))
+            self.day_counts = np.concatenate([self.day_counts, np.zeros((self.day_counts.shape[0], 1), dtype=self.day_counts.dtype)], axis=1)
+            unavailable_col = np.array([[date in self.instance.unavailable_dates[p] if p < len(self.instance.unavailable_dates) else False]
+                                        for p in range(self.unavailable.shape[0])], dtype=bool)
+            self.unavailable = np.concatenate([self.unavailable, unavailable_col], axis=1)
+        return col
+
+    # ---------------- القراءة ----------------
+    def is_valid(self):
+        return not (self.shortage or self.double_bookings or self.unavailable_hits or
+                    self.over_limit_profs or self.pattern_violators or self.broken_pairs)
+
+    def eligible_mask(self, exam):
+        """
+        متجه منطقي بطول قائمة الأساتذة: من يمكن تعيينه حارساً لهذا الامتحان الآن.
+        نفس شروط is_assignment_valid: التزامن، الغياب، السقفان، ونمط الحراسة (الافتراضي يومان مرنان).
+        """
+        inst = self.instance
+        num_profs = self.num_base_profs
+        e_id = inst.exam_id(exam)
+        slot = inst.exam_slot[e_id]
+        self._ensure_slot(slot)
+        col = self._date_col(exam['date'])
+
+        eligible = self.busy[:num_profs, slot] == 0
+        eligible &= ~self.unavailable[:num_profs, col]
+        eligible &= self.shifts[:num_profs] < inst.max_shifts
+        if inst.exam_is_large[e_id]:
+            eligible &= self.large[:num_profs] < inst.max_large_hall_shifts
+
+        new_day = self.day_counts[:num_profs, col] == 0
+        num_days = self.num_days[:num_profs]
+        day_limit = ASSIGN_PATTERN_DAY_LIMITS[self.assign_codes[:num_profs]]
+        blocked = new_day & (num_days >= day_limit)
+        # النمط المتتالي: اليوم الجديد يجب أن يجاور اليوم الوحيد الحالي
+        consecutive = new_day & (self.assign_codes[:num_profs] == PATTERN_CODES['consecutive_strict']) & (num_days == 1)
+        if consecutive.any():
+            blocked |= consecutive & (np.abs(self.day_pos_sum[:num_profs] - self.date_pos[col]) != 1)
+        return eligible & ~blocked
+
+    def exam_columns(self, exams):
+        """(الخانات، أعمدة الأيام، القاعة الكبيرة) لقائمة امتحانات، مُحضَّرة مرة واحدة لـ prof_eligible_mask."""
+        inst = self.instance
+        e_ids = [inst.exam_id(exam) for exam in exams]
+        slots = np.array([inst.exam_slot[e_id] for e_id in e_ids], dtype=np.int64)
+        if len(slots): self._ensure_slot(int(slots.max()))
+        cols = np.array([self._date_col(exam['date']) for exam in exams], dtype=np.int64)
+        is_large = np.array([inst.exam_is_large[e_id] for e_id in e_ids], dtype=bool)
+        return slots, cols, is_large
+
+    def prof_eligible_mask(self, p_id, exam_columns):
+        """
+        الاتجاه المعاكس لـ eligible_mask: لأستاذ واحد، أي امتحانات (من exam_columns) يمكن تعيينه لها الآن.
+        نفس الشروط؛ تكفي بعد تعيين هذا الأستاذ لأن أهلية غيره لا تتغير.
+        """
+        inst = self.instance
+        slots, cols, is_large = exam_columns
+        if self.shifts[p_id] >= inst.max_shifts:
+            return np.zeros(len(slots), dtype=bool)
+        eligible = self.busy[p_id, slots] == 0
+        eligible &= ~self.unavailable[p_id, cols]
+        if self.large[p_id] >= inst.max_large_hall_shifts:
+            eligible &= ~is_large
+        new_day = self.day_counts[p_id, cols] == 0
+        num_days = self.num_days[p_id]
+        if num_days >= ASSIGN_PATTERN_DAY_LIMITS[self.assign_codes[p_id]]:
+            eligible &= ~new_day
+        elif self.assign_codes[p_id] == PATTERN_CODES['consecutive_strict'] and num_days == 1:
+            eligible &= ~(new_day & (np.abs(self.day_pos_sum[p_id] - self.date_pos[cols]) != 1))
+        return eligible
+
+    # ---------------- الحركات ----------------
+    def apply(self, move):
+        """تطبيق الحركة (قائمة (exam, guard_index, new_guard)) وإرجاع حركة التراجع."""
+        undo = []
+        for exam, guard_idx, new_guard in move:
+            old_guard = exam['guards'][guard_idx]
+            undo.append((exam, guard_idx, old_guard))
+            if old_guard == new_guard:
+                continue
+            self.add_duty(exam, old_guard, -1)
+            exam['guards'][guard_idx] = new_guard
+            self.add_duty(exam, new_guard, 1)
+        undo.reverse()
+        return undo
+
+    def is_move_valid(self, move):
+        """هل يبقى الجدول صالحاً بعد الحركة؟ (تطبيق ثم تراجع)"""
+        undo_move = self.apply(move)
+        valid = self.is_valid()
+        self.apply(undo_move)
+        return valid
+
+    def add_duty(self, exam, guard, sign):
+        """
+        إضافة (sign=1) أو طرح (sign=-1) مهمة حراسة واحدة.
+        تعيد (p_id, day_changed) حتى يحدّث المُقيِّم الأيام الضائعة، أو None لخانة النقص.
+        """
+        if guard == "**نقص**":
+            self.shortage += sign
+            return None
+        inst = self.instance
+        p_id = inst.prof_id(guard)
+        self._ensure_prof(p_id)
+        e_id = inst.exam_id(exam)
+        slot = inst.exam_slot[e_id]
+        self._ensure_slot(slot)
+        col = self._date_col(exam['date'])
+
+        busy = int(self.busy[p_id, slot])
+        if sign > 0:
+            if busy >= 1: self.double_bookings += 1
+        elif busy >= 2:
+            self.double_bookings -= 1
+        self.busy[p_id, slot] = busy + sign
+
+        day_count = int(self.day_counts[p_id, col])
+        self.day_counts[p_id, col] = day_count + sign
+        day_changed = day_count == 0 if sign > 0 else day_count == 1
+        if day_changed:
+            self.num_days[p_id] += sign
+            self.day_pos_sum[p_id] += sign * self.date_pos[col]
+
+        if self.unavailable[p_id, col]:
+            self.unavailable_hits += sign
+        self.shifts[p_id] += sign
+        if inst.exam_is_large[e_id]:
+            self.large[p_id] += sign
+        self.workload[p_id] += sign * inst.exam_weight[e_id]
+
+        self._recheck_limits(p_id)
+        if day_changed:
+            self._recheck_pattern(p_id)
+            for pair_idx in self.pairs_of_prof.get(p_id, ()):
+                self._recheck_pair(pair_idx)
+        return p_id, day_changed
+
+    def _recheck_limits(self, p_id):
+        if p_id >= self.num_base_profs:
+            return
+        inst = self.instance
+        if self.shifts[p_id] > inst.max_shifts or self.large[p_id] > inst.max_large_hall_shifts:
+            self.over_limit_profs.add(p_id)
+        else:
+            self.over_limit_profs.discard(p_id)
+
+    def _recheck_pattern(self, p_id):
+        pattern_code = self.instance.pattern_codes[p_id]
+        if not pattern_code:
+            return
+        positions = self.date_pos[np.flatnonzero(self.day_counts[p_id])]
+        day_indices = sorted(int(pos) for pos in positions if pos != self.UNKNOWN_DATE_POS)
+        if pattern_violated(pattern_code, day_indices):
+            self.pattern_violators.add(p_id)
+        else:
+            self.pattern_violators.discard(p_id)
+
+    def _recheck_pair(self, pair_idx):
+        p1, p2 = self.instance.partner_pairs[pair_idx]
+        self._ensure_prof(max(p1, p2))
+        if not np.array_equal(self.day_counts[p1] > 0, self.day_counts[p2] > 0):
+            self.broken_pairs.add(pair_idx)
+        else:
+            self.broken_pairs.discard(pair_idx)
+
+class CostEvaluator:
+    """
+    مُقيِّم ذو حالة يعيد نفس tuple التكلفة الذي تعيده calculate_cost، لكن بدون إعادة بناء كل شيء.
+    - يعمل مباشرة على قوائم الحراس في الجدول الممرر (بدون نسخ).
+    - الحركة (move) قائمة من (exam, guard_index, new_guard).
+    - apply(move) تطبق الحركة وتحدّث العدادات وتعيد حركة التراجع (undo).
+    - delta(move) تعيد فرق التكلفة للحركة دون الالتزام بها.
+    القيود الصارمة والنقص يتتبعها FeasibilityTracker؛ هنا: عدد (كبيرة، أخرى) لكل أستاذ،
+    المدرج التكراري للأنماط أو توزيع العبء (min/max)، وأيام المواد غير المستغلة.
+    """
+    def __init__(self, instance, schedule):
+        self.instance = instance
+        self.schedule = schedule
+        self.exams = instance.flat_exams(schedule)
+        self.num_base_profs = instance.num_professors
+
+        # --- القيود الصارمة (نفس شروط is_schedule_valid) ---
+        self.feasibility = FeasibilityTracker(instance)
+
+        # --- الانحراف: أدوار (كبيرة، أخرى) لكل أستاذ من قائمة الأساتذة ---
+        self.role_large = [0] * self.num_base_profs
+        self.role_other = [0] * self.num_base_profs
+        self.pattern_hist = Counter({(0, 0): self.num_base_profs}) if self.num_base_profs else Counter()
+        self.pattern_abs_dev = sum(abs(self.pattern_hist.get(k, 0) - instance.custom_target_counts.get(k, 0))
+                                   for k in set(self.pattern_hist) | set(instance.custom_target_counts))
+        self.workload_values = Counter({0.0: self.num_base_profs}) if self.num_base_profs else Counter()
+
+        # --- القيود المرنة: أيام المواد لكل مالك ---
+        self.subject_day_counts = defaultdict(Counter)
+        for exam in self.exams:
+            owner = exam.get('professor', "غير محدد")
+            if owner != "غير محدد":
+                self.subject_day_counts[owner][exam['date']] += 1
+        self.extra_subject_days_penalty = sum((len(days) - 2) * 5 for days in self.subject_day_counts.values() if len(days) > 2)
+        self.missed_days = 0
+        for p_id in range(self.num_base_profs):
+            self.missed_days += len(self.subject_day_counts.get(instance.prof_names[p_id], ()))
+
+        for exam in self.exams:
+            exam.setdefault('guards', [])
+            for guard in exam['guards']:
+                self._add_duty(exam, guard, 1)
+            self._add_exam_roles(exam, 1)
+
+    # ---------------- القراءة ----------------
+    @property
+    def shortage(self):
+        return self.feasibility.shortage
+
+    def is_hard_valid(self):
+        return self.feasibility.is_valid()
+
+    def cost(self):
+        """tuple التكلفة الحالي (نقص، قيود صارمة، انحراف، قيود مرنة) مطابق لـ calculate_cost."""
+        if self.instance.use_custom_targets:
+            deviation = self.pattern_abs_dev * 2.0
+        else:
+            deviation = max(self.workload_values) - min(self.workload_values) if self.workload_values else 0.0
+        soft = self.missed_days * 10 + self.extra_subject_days_penalty
+        return (self.shortage, 0 if self.is_hard_valid() else 1, deviation, soft)
+
+    # ---------------- الحركات ----------------
+    def apply(self, move):
+        """تطبيق الحركة على الجدول وإرجاع حركة التراجع المقابلة."""
+        undo = []
+        touched_exams = {}
+        for exam, guard_idx, new_guard in move:
+            old_guard = exam['guards'][guard_idx]
+            undo.append((exam, guard_idx, old_guard))
+            if old_guard == new_guard:
+                continue
+            # استبدال حارس بحارس لا يغيّر مواقع البقية: يتغير دور الأستاذين فقط (خانتان من المدرج لكل منهما)
+            if id(exam) not in touched_exams and old_guard != "**نقص**" and new_guard != "**نقص**":
+                self._replace_exam_role(exam, guard_idx, old_guard, new_guard)
+                self._add_duty(exam, old_guard, -1)
+                exam['guards'][guard_idx] = new_guard
+                self._add_duty(exam, new_guard, 1)
+                continue
+            # الأدوار تعتمد على قائمة الحراس كاملة: تُطرح مرة واحدة قبل أول تعديل وتُضاف بعد آخر تعديل
+            if id(exam) not in touched_exams:
+                touched_exams[id(exam)] = exam
+                self._add_exam_roles(exam, -1)
+            self._add_duty(exam, old_guard, -1)
+            exam['guards'][guard_idx] = new_guard
+            self._add_duty(exam, new_guard, 1)
+        for exam in touched_exams.values():
+            self._add_exam_roles(exam, 1)
+        undo.reverse()
+        return undo
+
+    def undo(self, undo_move):
+        self.apply(undo_move)
+
+    def cost_after(self, move):
+        """التكلفة بعد الحركة دون الالتزام بها (تطبيق ثم تراجع)."""
+        undo_move = self.apply(move)
+        new_cost = self.cost()
+        self.apply(undo_move)
+        return new_cost
+
+    def delta(self, move):
+        """فرق التكلفة (جديد - حالي) لكل مكون من مكونات الـ tuple."""
+        old_cost = self.cost()
+        return tuple(n - o for n, o in zip(self.cost_after(move), old_cost))
+
+    def detach_exam(self, exam):
+        """طرح مساهمة الامتحان كاملة (حراسه، أدوارهم، ويوم المادة لمالكه) قبل تعديل حقائقه (مثلاً تبديل المواد)."""
+        self._add_exam_roles(exam, -1)
+        for guard in exam['guards']:
+            self._add_duty(exam, guard, -1)
+        self._add_subject_day(exam, -1)
+
+    def attach_exam(self, exam):
+        """عكس detach_exam بعد تعديل الامتحان؛ حقائقه تُقرأ من السجل بحسب UUID الحالي."""
+        self._add_subject_day(exam, 1)
+        for guard in exam['guards']:
+            self._add_duty(exam, guard, 1)
+        self._add_exam_roles(exam, 1)
+
+    # ---------------- التحديثات الداخلية ----------------
+    def _add_duty(self, exam, guard, sign):
+        changed = self.feasibility.add_duty(exam, guard, sign)
+        if changed is None:
+            return
+        p_id, day_changed = changed
+        if day_changed and p_id < self.num_base_profs and exam['date'] in self.subject_day_counts.get(self.instance.prof_names[p_id], ()):
+            self.missed_days -= sign
+
+    def _add_subject_day(self, exam, sign):
+        owner = exam.get('professor', "غير محدد")
+        if owner == "غير محدد":
+            return
+        days = self.subject_day_counts[owner]
+        date = exam['date']
+        old_num_days = len(days)
+        days[date] += sign
+        if days[date] == 0:
+            del days[date]
+        if len(days) == old_num_days:
+            return
+        self.extra_subject_days_penalty += max(len(days) - 2, 0) * 5 - max(old_num_days - 2, 0) * 5
+        # اليوم الضائع: يوم مادة بلا حراسة لمالكها (من قائمة الأساتذة)
+        p_id = self.instance.prof_index.get(owner)
+        if p_id is not None and p_id < self.num_base_profs and not self.feasibility.day_counts[p_id, self.feasibility._date_col(date)]:
+            self.missed_days += sign
+
+    def _add_exam_roles(self, exam, sign):
+        """إضافة/طرح أدوار حراس الامتحان: أول large_guards_needed حارس (بعد حذف النقص) في القاعة الكبيرة."""
+        num_large = self.instance.large_guards_needed(exam)
+        position = 0
+        for guard in exam['guards']:
+            if guard == "**نقص**":
+                continue
+            p_id = self.instance.prof_index.get(guard)
+            if p_id is not None and p_id < self.num_base_profs:
+                if position < num_large:
+                    self._shift_role(p_id, sign, 0)
+                else:
+                    self._shift_role(p_id, 0, sign)
+            position += 1
+
+    def is_large_role(self, exam, guard_idx):
+        """دور الموقع guard_idx في الانحراف: كبيرة إذا سبقه أقل من large_guards_needed حارس فعلي في الامتحان."""
+        position = sum(1 for guard in exam['guards'][:guard_idx] if guard != "**نقص**")
+        return position < self.instance.large_guards_needed(exam)
+
+    def _replace_exam_role(self, exam, guard_idx, old_guard, new_guard):
+        """نقل دور الموقع guard_idx (كبيرة أو أخرى) من old_guard إلى new_guard دون إعادة عدّ أدوار الامتحان."""
+        is_large = self.is_large_role(exam, guard_idx)
+        for guard, sign in ((old_guard, -1), (new_guard, 1)):
+            p_id = self.instance.prof_index.get(guard)
+            if p_id is not None and p_id < self.num_base_profs:
+                self._shift_role(p_id, sign if is_large else 0, 0 if is_large else sign)
+
+    def _shift_role(self, p_id, d_large, d_other):
+        inst = self.instance
+        old_key = (self.role_large[p_id], self.role_other[p_id])
+        new_key = (old_key[0] + d_large, old_key[1] + d_other)
+        self.role_large[p_id], self.role_other[p_id] = new_key
+
+        targets = inst.custom_target_counts
+        for key, change in ((old_key, -1), (new_key, 1)):
+            before = abs(self.pattern_hist.get(key, 0) - targets.get(key, 0))
+            self.pattern_hist[key] += change
+            if not self.pattern_hist[key]: del self.pattern_hist[key]
+            self.pattern_abs_dev += abs(self.pattern_hist.get(key, 0) - targets.get(key, 0)) - before
+
+        old_value = old_key[0] * inst.large_hall_weight + old_key[1]
+        new_value = new_key[0] * inst.large_hall_weight + new_key[1]
+        self.workload_values[old_value] -= 1
+        if not self.workload_values[old_value]: del self.workload_values[old_value]
+        self.workload_values[new_value] += 1
+
+def pattern_violated(pattern_code, day_indices):
+    """نفس شروط نمط الحراسة في is_schedule_valid، انطلاقاً من مؤشرات أيام الحراسة مرتبة تصاعدياً."""
+    num_days = len(day_indices)
+    if num_days == 0:
+        return False
+    if pattern_code == PATTERN_CODES['consecutive_strict']:
+        return num_days != 2 or day_indices[1] - day_indices[0] != 1
+    if pattern_code == PATTERN_CODES['one_day_only']:
+        return num_days > 1
+    if pattern_code == PATTERN_CODES['flexible_2_days']:
+        return num_days != 2
+    if pattern_code == PATTERN_CODES['flexible_3_days']:
+        return num_days < 2 or num_days > 3
+    return False
+# ===================================================================
+# --- END: المُقيِّم التزايدي للتكلفة والقيود الصارمة ---
+# ===================================================================
+
 def format_cost_tuple(cost_tuple):
     """(النسخة المحدثة) تنسيق تفاصيل التكلفة لطباعتها في السجل حسب الترتيب الجديد."""
     # ✅ التغيير هنا: قمنا بتغيير ترتيب المتغيرات لتطابق الـ tuple الجديد
@@ -1079,6 +1901,73 @@ def format_cost_tuple(cost_tuple):
     return f"(نقص: {s}, قيود صارمة: {h}, انحراف: {d:.2f}, قيود مرنة: {f})"
 
 
+class ProgressReporter:
+    """
+    يجمع تحديثات التقدم من حلقات الخوارزميات ويرسلها كرسائل JSON منظمة:
+    - رسالة واحدة كل PROGRESS_MIN_INTERVAL ثانية على الأكثر، وفقط إذا تغيرت النسبة أو المرحلة أو أفضل تكلفة.
+    - التحديث الذي يصل قبل انقضاء الفاصل يُحفظ كآخر حالة، ويُرسل مع التحديث التالي أو عند flush.
+    """
+    def __init__(self, emit, min_interval=PROGRESS_MIN_INTERVAL):
+        self.emit = emit
+        self.min_interval = min_interval
+        self.started_at = time.monotonic()
+        self.last_emit_at = float('-inf')
+        self.last_sent = None
+        self.pending = None
+        self.lock = threading.Lock()
+
+    def update(self, percent, phase=None, iteration=None, best_cost=None):
+        now = time.monotonic()
+        with self.lock:
+            self.pending = (percent, phase, iteration, best_cost)
+            if now - self.last_emit_at >= self.min_interval:
+                self._flush_locked(now)
+
+    def flush(self):
+        with self.lock:
+            self._flush_locked(time.monotonic())
+
+    def _flush_locked(self, now):
+        if self.pending is None:
+            return
+        percent, phase, iteration, best_cost = self.pending
+        self.pending = None
+        if best_cost is not None:
+            # JSON لا يقبل Infinity، والتكلفة قد تحوي أنواع numpy
+            best_cost = [float(c) if c is not None and math.isfinite(c) else None for c in best_cost]
+        key = (percent, phase, best_cost)
+        if key == self.last_sent:
+            return
+        self.last_sent, self.last_emit_at = key, now
+        self.emit("PROGRESS:" + json.dumps({
+            "percent": percent, "phase": phase, "iteration": iteration,
+            "bestCost": best_cost, "elapsed": round(now - self.started_at, 1),
+        }))
+
+    def update_from_message(self, message):
+        """يقبل رسالة PROGRESS قديمة (نسبة فقط) أو رسالة JSON قادمة من عملية مستقلة."""
+        payload = message[len("PROGRESS:"):]
+        try:
+            data = json.loads(payload)
+        except ValueError:
+            return
+        if isinstance(data, dict):
+            self.update(data.get('percent'), data.get('phase'), data.get('iteration'), data.get('bestCost'))
+        else:
+            self.update(data)
+
+
+def report_progress(log_q, percent, phase=None, iteration=None, best_cost=None):
+    """تحديث نسبة التقدم عبر مُجمِّع الطابور إن وُجد، وإلا رسالة PROGRESS نصية كما في السابق."""
+    if not log_q:
+        return
+    reporter = getattr(log_q, 'progress', None)
+    if reporter is not None:
+        reporter.update(percent, phase, iteration, best_cost)
+    else:
+        log_q.put(f"PROGRESS:{percent}")
+
+
 # =====================================================================
 # START: HYPER-HEURISTIC HELPER FUNCTIONS (PORTED FROM PROJECT 1)
 # =====================================================================
@@ -1136,13 +2025,15 @@ def calculate_reward_from_cost(old_cost_tuple, new_cost_tuple):
 # --- START: النسخة النهائية المدمجة من LNS ---
 # ===================================================================
 def run_large_neighborhood_search(
-    initial_schedule, settings, all_professors, duty_patterns, date_map, log_q, locked_guards=set(), stop_event=None
+    initial_schedule, settings, all_professors, duty_patterns, date_map, log_q, locked_guards=set(), stop_event=None, instance=None
 ):
     """
     النسخة النهائية والمحسّنة من LNS:
     - تجمع بين الإصلاح الشامل لكل حالات النقص (من الدالة الجديدة).
     - تستخدم نظام عبء العمل الموزون الدقيق (من الدالة الأصلية) لاختيار أفضل مرشح.
     - تحتفظ بنسبة التدمير الديناميكية.
+    - محفظة عمليات تدمير موجّهة (الأطراف في العبء، يوم كامل، مخالفو الأنماط، أساتذة مترابطون، وعشوائي)
+      يُختار منها بأوزان تتكيف مع التحسين المُلاحظ لكل ثانية معالج.
     """
     log_q.put(">>> تشغيل LNS (النسخة النهائية المدمجة والمحسّنة)...")
 
@@ -1153,69 +2044,94 @@ def run_large_neighborhood_search(
     destroy_fraction_decay_rate = 0.995
     initial_temp = 10.0
     cooling_rate = 0.99
-    
-    settings_for_validation = {
-        'dutyPatterns': duty_patterns,
-        'unavailableDays': settings.get('unavailableDays', {}),
-        'maxShifts': settings.get('maxShifts', '0'),
-        'maxLargeHallShifts': settings.get('maxLargeHallShifts', '2')
-    }
-    large_hall_weight = float(settings.get('largeHallWeight', 3.0))
-    other_hall_weight = float(settings.get('otherHallWeight', 1.0))
+    instance = get_problem_instance(instance, settings, all_professors, duty_patterns, date_map)
 
-    # --- 2. الحل المبدئي وحساب التكلفة الأولية (تبقى كما هي) ---
+    # --- 2. الحل المبدئي وحساب التكلفة الأولية ---
+    # حل واحد قابل للتعديل + مُقيِّم تزايدي: التدمير والإصلاح حركات، والرفض تراجع عنها بدل نسخ الجدول
     current_solution = copy.deepcopy(initial_schedule)
     best_solution_so_far = copy.deepcopy(current_solution)
+    evaluator = CostEvaluator(instance, current_solution)
+    feasibility = evaluator.feasibility
+    prof_ids = np.array([instance.prof_id(p) for p in all_professors], dtype=np.int64)
     
-    current_cost = calculate_cost(current_solution, settings, all_professors, duty_patterns, date_map)
+    current_cost = evaluator.cost()
     best_cost_so_far = current_cost
     log_q.put(f"... [LNS] التكلفة الأولية = {format_cost_tuple(current_cost)}")
 
     temp = initial_temp
     dynamic_destroy_fraction = initial_destroy_fraction
 
+    # --- عمليات التدمير: كل عملية تُرجع قائمة (امتحان، فهرس الحارس) من المهام القابلة للتدمير ---
+    def destroy_random(duties, num_to_destroy):
+        return random.sample(duties, num_to_destroy)
+
+    def destroy_load_extremes(duties, num_to_destroy):
+        # كل مهام الأستاذ الأكثر عبئاً والأستاذ الأقل عبئاً (بين من لديهم مهام قابلة للتدمير)
+        loads = {guard: feasibility.workload[instance.prof_id(guard)] for exam, g_idx in duties for guard in [exam['guards'][g_idx]]}
+        targets = {max(loads, key=loads.get), min(loads, key=loads.get)}
+        return [duty for duty in duties if duty[0]['guards'][duty[1]] in targets]
+
+    def destroy_date(duties, num_to_destroy):
+        date = random.choice([exam['date'] for exam, _ in duties])
+        return [duty for duty in duties if duty[0]['date'] == date]
+
+    def destroy_pattern_violators(duties, num_to_destroy):
+        violators = {instance.prof_names[p_id] for p_id in feasibility.pattern_violators}
+        for pair_idx in feasibility.broken_pairs:
+            violators.update(instance.prof_names[p_id] for p_id in instance.partner_pairs[pair_idx])
+        return [duty for duty in duties if duty[0]['guards'][duty[1]] in violators]
+
+    def destroy_related(duties, num_to_destroy):
+        # أستاذ بذرة ومن يشاركونه خاناته الزمنية؛ مهامهم في تلك الخانات أولاً ثم بقية مهامهم، حتى حجم التدمير
+        seed_exam, seed_idx = random.choice(duties)
+        seed = seed_exam['guards'][seed_idx]
+        seed_slots = {(exam['date'], exam['time']) for exam, g_idx in duties if exam['guards'][g_idx] == seed}
+        related = {seed} | {exam['guards'][g_idx] for exam, g_idx in duties if (exam['date'], exam['time']) in seed_slots}
+        candidates = [duty for duty in duties if duty[0]['guards'][duty[1]] in related]
+        candidates.sort(key=lambda duty: (duty[0]['date'], duty[0]['time']) not in seed_slots)
+        return candidates[:max(num_to_destroy, 1)]
+
+    destroy_operators = {
+        'random': destroy_random, 'load_extremes': destroy_load_extremes, 'date': destroy_date,
+        'pattern_violators': destroy_pattern_violators, 'related': destroy_related,
+    }
+    # أوزان تكيفية: متوسط أسي للتحسين (في "الطاقة") لكل ثانية معالج، مع حد أدنى لكل عملية حتى لا تُهمل نهائياً
+    operator_reaction = float(settings.get('lnsOperatorReaction', 0.2))
+    operator_weights = {name: 1.0 for name in destroy_operators}
+    operator_stats = {name: {'uses': 0, 'improved': 0, 'best': 0, 'cpu': 0.0, 'gain': 0.0} for name in destroy_operators}
+    weights = (100000, 50000, 10, 1) # أوزان العقوبات
+
     # --- 3. حلقة LNS الرئيسية (تبقى كما هي) ---
     for i in range(iterations):
         if stop_event and stop_event.is_set(): break
         
             
         percent_complete = int(((i + 1) / iterations) * 100)
-        log_q.put(f"PROGRESS:{percent_complete}")
+        report_progress(log_q, percent_complete, phase='LNS', iteration=i + 1, best_cost=best_cost_so_far)
         
-        ruined_solution = copy.deepcopy(current_solution)
-
-        # --- 4. مرحلة التدمير (تبقى كما هي) ---
+        # --- 4. مرحلة التدمير (عملية مختارة بالأوزان التكيفية) ---
         duties_to_destroy = []
-        for day in ruined_solution.values():
-            for slot in day.values():
-                for exam in slot:
-                    for g_idx, guard in enumerate(exam.get('guards', [])):
-                        if guard != "**نقص**" and (exam.get('uuid'), guard) not in locked_guards:
-                            duties_to_destroy.append({'exam': exam, 'guard_index': g_idx})
-
-        random.shuffle(duties_to_destroy)
+        for exam in evaluator.exams:
+            for g_idx, guard in enumerate(exam.get('guards', [])):
+                if guard != "**نقص**" and (exam.get('uuid'), guard) not in locked_guards:
+                    duties_to_destroy.append((exam, g_idx))
         num_to_destroy = int(len(duties_to_destroy) * dynamic_destroy_fraction)
-        
-        for j in range(min(num_to_destroy, len(duties_to_destroy))):
-            duty_info = duties_to_destroy[j]
-            duty_info['exam']['guards'][duty_info['guard_index']] = "**نقص**"
+
+        applicable = [name for name in destroy_operators if duties_to_destroy and
+                      (name != 'pattern_violators' or feasibility.pattern_violators or feasibility.broken_pairs)]
+        if applicable:
+            floor = 0.2 * sum(operator_weights[name] for name in applicable) / len(applicable)
+            operator = random.choices(applicable, weights=[max(operator_weights[name], floor) for name in applicable])[0]
+        else:
+            operator = 'random'
+        cpu_start = time.process_time()
+        destroyed = destroy_operators[operator](duties_to_destroy, num_to_destroy) if applicable else []
+
+        undo_log = evaluator.apply([(exam, g_idx, "**نقص**") for exam, g_idx in destroyed])
 
         # --- 5. مرحلة الإصلاح الذكي والمستهدف (النسخة المدمجة) ---
-        all_exams_in_ruined = [exam for day in ruined_solution.values() for slot in day.values() for exam in slot]
-        
-        # (## تعديل مدمج ##): 1. حساب الحالة الأولية (العبء الموزون) مرة واحدة قبل حلقة الإصلاح
-        prof_assignments = defaultdict(list)
-        prof_large_counts = defaultdict(int)
-        prof_workload = defaultdict(float)
-        for exam in all_exams_in_ruined:
-            is_large = any(h['type'] == 'كبيرة' for h in exam.get('halls', []))
-            duty_weight = large_hall_weight if is_large else other_hall_weight
-            for guard in exam.get('guards', []):
-                if guard != "**نقص**":
-                    prof_assignments[guard].append(exam)
-                    prof_workload[guard] += duty_weight
-                    if is_large:
-                        prof_large_counts[guard] += 1
+        # 1. حالة الحراس (الإشغال، السقوف، العبء الموزون) يحفظها متتبع القيود ويحدّثها مع كل تعيين
+        all_exams_in_ruined = evaluator.exams
         
         # 2. تحديد كل خانات النقص (من الدالة الجديدة)
         shortage_slots = []
@@ -1229,51 +2145,43 @@ def run_large_neighborhood_search(
         for repair_info in shortage_slots:
             exam_to_repair = repair_info['exam']
             
-            # (## تعديل مدمج ##): حساب وزن المهمة المطلوب إصلاحها
-            is_large_repair_exam = any(h['type'] == 'كبيرة' for h in exam_to_repair.get('halls',[]))
-            repair_duty_weight = large_hall_weight if is_large_repair_exam else other_hall_weight
-            
-            # إيجاد أفضل مرشح صالح
-            valid_candidates = []
-            for prof in all_professors:
-                if prof in exam_to_repair.get('guards', []): continue
-                
-                if is_assignment_valid(prof, exam_to_repair, prof_assignments, prof_large_counts, settings_for_validation, date_map):
-                    # (## تعديل مدمج ##): استخدام العبء الموزون `prof_workload` لاختيار الأفضل
-                    valid_candidates.append((prof, prof_workload.get(prof, 0)))
+            # إيجاد أفضل مرشح صالح: متجه الصلاحية لكل الأساتذة دفعة واحدة
+            eligible = feasibility.eligible_mask(exam_to_repair)[prof_ids]
 
-            if valid_candidates:
-                # (## تعديل مدمج ##): اختيار الأستاذ صاحب أقل عبء عمل موزون
-                best_prof_found, _ = min(valid_candidates, key=lambda item: item[1])
-                
-                # تعيين الأستاذ في الخانة الفارغة
-                exam_to_repair['guards'][repair_info['index_to_fill']] = best_prof_found
+            if eligible.any():
+                # اختيار الأستاذ صاحب أقل عبء عمل موزون (الأول بترتيب القائمة عند التساوي)
+                best_prof_found = all_professors[int(np.argmin(np.where(eligible, feasibility.workload[prof_ids], np.inf)))]
                 
-                # (## تعديل مدمج ##): تحديث حالة الأستاذ ديناميكيًا لتؤثر على الاختيار التالي
-                prof_assignments[best_prof_found].append(exam_to_repair)
-                prof_workload[best_prof_found] += repair_duty_weight
-                if is_large_repair_exam:
-                    prof_large_counts[best_prof_found] += 1
+                # تعيين الأستاذ في الخانة الفارغة (المتتبع يحدّث حالة الأستاذ فوراً ليؤثر على الاختيار التالي)
+                undo_log = evaluator.apply([(exam_to_repair, repair_info['index_to_fill'], best_prof_found)]) + undo_log
         
-        # --- 6. مرحلة القبول والتحديثات (تبقى كما هي) ---
-        # ✅ الكود الجديد (المصحح)
-        repaired_solution = ruined_solution # This line might not be in your code, but the context is the same
-        new_cost = calculate_cost(repaired_solution, settings, all_professors, duty_patterns, date_map)
+        # --- 6. مرحلة القبول والتحديثات ---
+        new_cost = evaluator.cost()
         
         # نحسب "الطاقة" الإجمالية لكل حل كرقم واحد (مجموع موزون)
         # وذلك فقط لاستخدامها في معادلة القبول العشوائي
-        weights = (100000, 50000, 10, 1) # أوزان العقوبات
         current_energy = sum(c * w for c, w in zip(current_cost, weights))
         new_energy = sum(c * w for c, w in zip(new_cost, weights))
         
         # الآن نستخدم هذه الطاقة في المعادلة
-        if new_cost < current_cost or random.random() < (math.exp((current_energy - new_energy) / temp) if temp > 0 else 0):
-            current_solution, current_cost = repaired_solution, new_cost
+        improved = new_cost < current_cost
+        if improved or random.random() < (math.exp((current_energy - new_energy) / temp) if temp > 0 else 0):
+            current_cost = new_cost
+        else:
+            evaluator.undo(undo_log)
+
+        # تحديث وزن العملية: التحسين المُلاحظ لكل ثانية معالج (صفر إن لم يتحسن الحل)
+        cpu_elapsed = max(time.process_time() - cpu_start, 1e-6)
+        gain = max(0.0, current_energy - new_energy) if improved else 0.0
+        stats = operator_stats[operator]
+        stats['uses'] += 1; stats['improved'] += improved; stats['cpu'] += cpu_elapsed; stats['gain'] += gain
+        operator_weights[operator] = (1 - operator_reaction) * operator_weights[operator] + operator_reaction * gain / cpu_elapsed
         
         if current_cost < best_cost_so_far:
             best_cost_so_far = current_cost
             best_solution_so_far = copy.deepcopy(current_solution)
-            log_q.put(f"... [LNS] دورة {i+1}: تم إيجاد حل أفضل بتكلفة = {format_cost_tuple(best_cost_so_far)}")
+            stats['best'] += 1
+            log_q.put(f"... [LNS] دورة {i+1} ({operator}): تم إيجاد حل أفضل بتكلفة = {format_cost_tuple(best_cost_so_far)}")
             if best_cost_so_far[0] == 0 and best_cost_so_far[1] == 0:
                 # سنطبع الرسالة كعلامة فارقة، لكن لن نوقف البحث
                 log_q.put("... [LNS] تم العثور على حل صالح ومكتمل (سنواصل البحث عن تحسينات).")
@@ -1282,22 +2190,13 @@ def run_large_neighborhood_search(
         dynamic_destroy_fraction = max(min_destroy_fraction, dynamic_destroy_fraction * destroy_fraction_decay_rate)
 
     log_q.put(f"✓ انتهى LNS المحسن بأفضل تكلفة: {format_cost_tuple(best_cost_so_far)}")
+    log_q.put("... [LNS] إحصائيات عمليات التدمير (استخدام / تحسين / أفضل حل / ثواني المعالج / التحسين لكل ثانية):")
+    for name, stats in sorted(operator_stats.items(), key=lambda item: -item[1]['gain']):
+        rate = stats['gain'] / stats['cpu'] if stats['cpu'] else 0.0
+        log_q.put(f"    - {name}: {stats['uses']} / {stats['improved']} / {stats['best']} / {stats['cpu']:.2f}s / {rate:.1f}")
     
     # --- 7. إعادة بناء البيانات النهائية (تبقى كما هي) ---
-    final_assignments = defaultdict(list)
-    final_workload = defaultdict(float)
-    final_large_counts = defaultdict(int)
-    for day_data in best_solution_so_far.values():
-        for slot_data in day_data.values():
-            for exam in slot_data:
-                is_large_exam = any(h['type'] == 'كبيرة' for h in exam['halls'])
-                duty_weight = large_hall_weight if is_large_exam else other_hall_weight
-                for guard in exam.get('guards', []):
-                    if guard != "**نقص**":
-                        final_assignments[guard].append(exam)
-                        final_workload[guard] += duty_weight
-                        if is_large_exam: final_large_counts[guard] += 1
-                        
+    final_assignments, final_large_counts, final_workload = instance.build_assignment_maps(best_solution_so_far)
     return best_solution_so_far, final_assignments, final_workload, final_large_counts
 
 # ===================================================================
@@ -1310,12 +2209,14 @@ def run_large_neighborhood_search(
 # --- START: النسخة النهائية من VNS (تستهدف النقص) ---
 # ===================================================================
 def run_variable_neighborhood_search(
-    initial_schedule, settings, all_professors, duty_patterns, date_map, log_q, locked_guards=set(), stop_event=None
+    initial_schedule, settings, all_professors, duty_patterns, date_map, log_q, locked_guards=set(), stop_event=None, instance=None
 ):
     """
     النسخة النهائية والمحسنة من VNS:
     - مرحلة الإصلاح بعد الهزة تستهدف كل حالات النقص.
     - تستخدم البحث المحلي لتحسين الحلول.
+    - حالة تزايدية واحدة (CostEvaluator) عبر الهز ← الإصلاح ← البحث المحلي: كل تعديل يُسجَّل في سجل تراجع،
+      والجار المرفوض يُلغى بالتراجع بدل نسخ الجدول وإعادة بناء الفهارس.
     """
     log_q.put(">>> تشغيل VNS (النسخة النهائية المستهدفة للنقص)...")
 
@@ -1323,22 +2224,62 @@ def run_variable_neighborhood_search(
     iterations = int(settings.get('vnsIterations', 100))
     k_max = int(settings.get('vnsMaxK', 25)) # زيادة k القصوى لإتاحة تغييرات أكبر
     local_search_swaps = 100 # زيادة عدد محاولات البحث المحلي
-
-    settings_for_validation = {
-        'dutyPatterns': duty_patterns,
-        'unavailableDays': settings.get('unavailableDays', {}),
-        'maxShifts': settings.get('maxShifts', '0'),
-        'maxLargeHallShifts': settings.get('maxLargeHallShifts', '2')
-    }
+    instance = get_problem_instance(instance, settings, all_professors, duty_patterns, date_map)
+    prof_ids = np.array([instance.prof_id(p) for p in all_professors], dtype=np.int64)
 
     # --- 2. الحل المبدئي والتكلفة الأولية ---
     current_solution = copy.deepcopy(initial_schedule)
-    best_solution_so_far = copy.deepcopy(current_solution)
+    evaluator = CostEvaluator(instance, current_solution)
+    feasibility = evaluator.feasibility
+    all_exams_flat = evaluator.exams
 
-    current_cost = calculate_cost(current_solution, settings, all_professors, duty_patterns, date_map)
+    current_cost = evaluator.cost()
     best_cost_so_far = current_cost
     log_q.put(f"... [VNS] التكلفة الأولية = {format_cost_tuple(current_cost)}")
 
+    # فهرس دائم: حارس -> {(موقع الامتحان، فهرس الحارس)}، يُحدَّث مع كل حركة وتراجعها
+    exam_pos = {id(exam): pos for pos, exam in enumerate(all_exams_flat)}
+    prof_duties = defaultdict(set)
+    for pos, exam in enumerate(all_exams_flat):
+        for g_idx, guard in enumerate(exam['guards']):
+            if guard != "**نقص**": prof_duties[guard].add((pos, g_idx))
+
+    def apply_move(move, undo_log):
+        """تطبيق حركة وتسجيل تراجعها في بداية undo_log (يُطبَّق السجل كاملاً بالترتيب للتراجع)."""
+        touched = {(exam_pos[id(exam)], g_idx) for exam, g_idx, _ in move}
+        for pos, g_idx in touched:
+            prof_duties[all_exams_flat[pos]['guards'][g_idx]].discard((pos, g_idx))
+        undo_log[:0] = evaluator.apply(move)
+        for pos, g_idx in touched:
+            guard = all_exams_flat[pos]['guards'][g_idx]
+            if guard != "**نقص**": prof_duties[guard].add((pos, g_idx))
+
+    def local_search(undo_log):
+        """
+        مهمة من الأكثر عبئاً إلى الأقل عبئاً ما دام ذلك صالحاً، بين الأساتذة الذين يحملون مهاماً عند بدء البحث
+        (مثل run_post_processing_swaps)، فأستاذ بلا مهام غير متاح أصلاً لا يوقف البحث من أول محاولة.
+        """
+        holders = [idx for idx, prof in enumerate(all_professors) if prof_duties[prof]]
+        if len(holders) < 2: return
+        holder_ids = prof_ids[holders]
+        for _ in range(local_search_swaps):
+            workloads = feasibility.workload[holder_ids]
+            most_idx, least_idx = int(np.argmax(workloads)), int(np.argmin(workloads))
+            if workloads[most_idx] <= workloads[least_idx]: break
+            most_burdened_prof, least_burdened_prof = all_professors[holders[most_idx]], all_professors[holders[least_idx]]
+            # مهمة تضيّق الفارق فعلاً (وزنها أقل منه) وإلا تأرجحت المهمة بين الأستاذين بلا فائدة
+            gap = workloads[most_idx] - workloads[least_idx]
+            possible_swaps = [(pos, g_idx) for pos, g_idx in prof_duties[most_burdened_prof]
+                              if (all_exams_flat[pos].get('uuid'), most_burdened_prof) not in locked_guards
+                              and instance.duty_weight(all_exams_flat[pos]) < gap]
+            if not possible_swaps: break
+            random.shuffle(possible_swaps)
+            # صلاحية الأستاذ الأقل عبئاً لكل المرشحين دفعة واحدة
+            eligible = feasibility.prof_eligible_mask(holder_ids[least_idx], feasibility.exam_columns([all_exams_flat[pos] for pos, _ in possible_swaps]))
+            if not eligible.any(): break
+            pos, g_idx = possible_swaps[int(np.argmax(eligible))]
+            apply_move([(all_exams_flat[pos], g_idx, least_burdened_prof)], undo_log)
+
     # --- 3. حلقة VNS الرئيسية ---
     i = 0
     stop_early = False
@@ -1347,104 +2288,55 @@ def run_variable_neighborhood_search(
         if settings.get('should_stop_event', threading.Event()).is_set(): break
 
         percent_complete = int(((i + 1) / iterations) * 100)
-        log_q.put(f"PROGRESS:{percent_complete}")
+        report_progress(log_q, percent_complete, phase='VNS', iteration=i + 1, best_cost=best_cost_so_far)
         
         k = 1
         while k <= k_max:
-            # --- 4أ. مرحلة الهز (Shaking) ---
-            shaken_solution = copy.deepcopy(current_solution)
-            
-            duties_to_destroy = []
-            for day in shaken_solution.values():
-                for slot in day.values():
-                    for exam in slot:
-                        for g_idx, guard in enumerate(exam.get('guards', [])):
-                            if guard != "**نقص**" and (exam.get('uuid'), guard) not in locked_guards:
-                                duties_to_destroy.append({'exam': exam, 'guard_index': g_idx})
+            undo_log = []
 
+            # --- 4أ. مرحلة الهز (Shaking): k مهمة عشوائية تصبح نقصاً (تُسجَّل للتراجع) ---
+            duties_to_destroy = [(exam, g_idx) for exam in all_exams_flat for g_idx, guard in enumerate(exam['guards'])
+                                 if guard != "**نقص**" and (exam.get('uuid'), guard) not in locked_guards]
             if not duties_to_destroy: break 
             
-            random.shuffle(duties_to_destroy)
-            
-            for j in range(min(k, len(duties_to_destroy))):
-                duty_info = duties_to_destroy[j]
-                duty_info['exam']['guards'][duty_info['guard_index']] = "**نقص**"
+            apply_move([(exam, g_idx, "**نقص**") for exam, g_idx in random.sample(duties_to_destroy, min(k, len(duties_to_destroy)))], undo_log)
 
             # --- 4ب. مرحلة الإصلاح الشامل (Repair) ---
             # ✅ --- هذا هو نفس المنطق الذكي المستخدم في LNS --- ✅
-            all_exams_in_shaken = [exam for day in shaken_solution.values() for slot in day.values() for exam in slot]
-            
-            shortage_slots = []
-            for exam in all_exams_in_shaken:
-                for idx, guard in enumerate(exam.get('guards', [])):
-                    if guard == "**نقص**":
-                        shortage_slots.append({'exam': exam, 'index_to_fill': idx})
-            
-            for repair_info in shortage_slots:
-                prof_assignments = defaultdict(list)
-                prof_large_counts = defaultdict(int)
-                for exam in all_exams_in_shaken:
-                    is_large = any(h['type'] == 'كبيرة' for h in exam.get('halls', []))
-                    for guard in exam.get('guards', []):
-                        if guard != "**نقص**":
-                            prof_assignments[guard].append(exam)
-                            if is_large: prof_large_counts[guard] += 1
-                
-                exam_to_repair = repair_info['exam']
-                
-                valid_candidates = []
-                for prof in all_professors:
-                    if prof in exam_to_repair.get('guards', []): continue
-                    if is_assignment_valid(prof, exam_to_repair, prof_assignments, prof_large_counts, settings_for_validation, date_map):
-                        valid_candidates.append(prof)
-                
-                if valid_candidates:
-                    exam_to_repair['guards'][repair_info['index_to_fill']] = random.choice(valid_candidates)
+            shortage_slots = [(exam, idx) for exam in all_exams_flat for idx, guard in enumerate(exam['guards']) if guard == "**نقص**"]
+            for exam_to_repair, index_to_fill in shortage_slots:
+                eligible = np.flatnonzero(feasibility.eligible_mask(exam_to_repair)[prof_ids])
+                if len(eligible):
+                    apply_move([(exam_to_repair, index_to_fill, all_professors[random.choice(eligible)])], undo_log)
 
             # --- 4ج. مرحلة البحث المحلي (Local Search) ---
-            local_search_solution, _, _, _ = run_post_processing_swaps(
-                shaken_solution, defaultdict(list), defaultdict(float), defaultdict(int),
-                settings, all_professors, date_map, local_search_swaps, locked_guards
-            )
+            local_search(undo_log)
 
             # --- 5. مرحلة التحديث (Move or not) ---
-            new_cost = calculate_cost(local_search_solution, settings, all_professors, duty_patterns, date_map)
+            new_cost = evaluator.cost()
 
             if new_cost < current_cost:
-                current_solution, current_cost = local_search_solution, new_cost
+                current_cost = new_cost
                 log_q.put(f"... [VNS] دورة {i+1}, k={k}: تم العثور على حل أفضل بتكلفة = {format_cost_tuple(current_cost)}")
                 
                 if new_cost < best_cost_so_far:
-                    best_cost_so_far, best_solution_so_far = new_cost, copy.deepcopy(current_solution)
+                    best_cost_so_far = new_cost
                     if best_cost_so_far[0] == 0 and best_cost_so_far[1] == 0:
                         log_q.put("... [VNS] تم العثور على حل صالح ومكتمل (سنواصل البحث عن تحسينات).")
                 k = 1
             else:
+                apply_move(undo_log, [])
                 k += 1
         
         if stop_early: break
         i += 1
 
+    # لا يُقبل إلا التحسين الصارم، فالحل الحالي هو أفضل حل دائماً: نسخة واحدة في النهاية
+    best_solution_so_far = copy.deepcopy(current_solution)
     log_q.put(f"✓ انتهى VNS بأفضل تكلفة: {format_cost_tuple(best_cost_so_far)}")
     
     # إعادة بناء البيانات النهائية من أفضل حل
-    final_assignments = defaultdict(list)
-    final_workload = defaultdict(float)
-    final_large_counts = defaultdict(int)
-    large_hall_weight = float(settings.get('largeHallWeight', 3.0))
-    other_hall_weight = float(settings.get('otherHallWeight', 1.0))
-    for day in best_solution_so_far.values():
-        for slot in day.values():
-            for exam in slot:
-                 is_large = any(h['type'] == 'كبيرة' for h in exam.get('halls', []))
-                 duty_weight = large_hall_weight if is_large else other_hall_weight
-                 for guard in exam.get('guards',[]):
-                     if guard != "**نقص**":
-                         final_assignments[guard].append(exam)
-                         final_workload[guard] += duty_weight
-                         if is_large:
-                             final_large_counts[guard] += 1
-
+    final_assignments, final_large_counts, final_workload = instance.build_assignment_maps(best_solution_so_far)
     return best_solution_so_far, final_assignments, final_workload, final_large_counts
 # ===================================================================
 # --- END: النسخة النهائية من VNS ---
@@ -1473,7 +2365,7 @@ def calculate_deviation_from_stats(prof_stats, settings, all_professors):
 # --- START: UNIFIED LNS ALGORITHM V16 (HYBRID: LNS for Repair, V13 for Optimization) ---
 # =====================================================================================
 
-def run_unified_lns_optimizer(initial_schedule, settings, all_professors, assignments, duty_patterns, date_map, all_subjects, log_q, all_levels_list, locked_guards=set(), stop_event=None):
+def run_unified_lns_optimizer(initial_schedule, settings, all_professors, assignments, duty_patterns, date_map, all_subjects, log_q, all_levels_list, locked_guards=set(), stop_event=None, instance=None):
     """
     (النسخة V16) "الخوارزمية الهجينة"
     - تستدعي LNS العادية (الموثوقة) للقيام بمهمة جبر النقص أولاً.
@@ -1483,11 +2375,12 @@ def run_unified_lns_optimizer(initial_schedule, settings, all_professors, assign
 
     # --- الإعدادات والحل المبدئي (لا تغيير هنا) ---
     iterations = int(settings.get('lnsUnifiedIterations', 300))
+    instance = get_problem_instance(instance, settings, all_professors, duty_patterns, date_map)
     initial_solution = complete_schedule_with_guards(
         initial_schedule, settings, all_professors, assignments,
-        all_levels_list, duty_patterns, date_map, all_subjects, locked_guards=locked_guards
+        all_levels_list, duty_patterns, date_map, all_subjects, locked_guards=locked_guards, instance=instance
     )
-    initial_cost = calculate_cost(initial_solution, settings, all_professors, duty_patterns, date_map)
+    initial_cost = calculate_cost(initial_solution, settings, all_professors, duty_patterns, date_map, instance=instance)
     log_q.put(f"... التكلفة الأولية للحل: {format_cost_tuple(initial_cost)}")
 
     repaired_solution = initial_solution
@@ -1502,14 +2395,14 @@ def run_unified_lns_optimizer(initial_schedule, settings, all_professors, assign
         # نستدعي الخوارزمية التي تنجح دائماً في الإصلاح
         repaired_solution_from_lns, _, _, _ = run_large_neighborhood_search(
             initial_solution, settings, all_professors, duty_patterns, 
-            date_map, log_q, locked_guards, stop_event
+            date_map, log_q, locked_guards, stop_event, instance=instance
         )
         
         # نتحقق من نتيجة الإصلاح
         if repaired_solution_from_lns:
             repaired_solution = repaired_solution_from_lns
         
-        repaired_cost = calculate_cost(repaired_solution, settings, all_professors, duty_patterns, date_map)
+        repaired_cost = calculate_cost(repaired_solution, settings, all_professors, duty_patterns, date_map, instance=instance)
     
     # --- التحقق من نجاح مرحلة الإصلاح ---
     if repaired_cost[0] > 0:
@@ -1524,117 +2417,199 @@ def run_unified_lns_optimizer(initial_schedule, settings, all_professors, assign
         # =================================================================
         log_q.put("--- بدء المرحلة 2: تحسين الجدول الكامل باستخدام منطق V13...")
         
+        # حل حالي واحد تُطبَّق عليه الحركات عبر CostEvaluator، مع فهارس دائمة تُحدَّث بالحركة المطبقة فقط
         current_solution = copy.deepcopy(repaired_solution)
-        current_cost = repaired_cost
+        evaluator = CostEvaluator(instance, current_solution)
+        feasibility = evaluator.feasibility
+        prof_ids = np.array([instance.prof_id(p) for p in all_professors], dtype=np.int64)
+        current_cost = evaluator.cost()
         best_solution = copy.deepcopy(current_solution)
         best_cost = current_cost
         
         temp = 5.0
         cooling_rate = 0.995
-        
+        candidate_count = int(settings.get('lnsUnifiedCandidates', 8))
+
+        # --- الفهارس الدائمة ---
+        all_exams_flat = evaluator.exams
+        exam_pos = {id(exam): pos for pos, exam in enumerate(all_exams_flat)}
+        prof_duties = defaultdict(set)           # حارس -> {(موقع الامتحان، فهرس الحارس)}
+        exams_by_owner_date = defaultdict(set)   # (أستاذ المادة، التاريخ) -> مواقع امتحاناته
+        exams_by_date_level = defaultdict(list)  # (التاريخ، المستوى) -> مواقع الامتحانات (ثابت: تبديل المواد لا يغير التاريخ ولا المستوى)
+
+        def index_exam(pos, sign):
+            exam = all_exams_flat[pos]
+            for g_idx, guard in enumerate(exam['guards']):
+                if guard != "**نقص**":
+                    if sign > 0: prof_duties[guard].add((pos, g_idx))
+                    else: prof_duties[guard].discard((pos, g_idx))
+            owner = exam.get('professor', "غير محدد")
+            if owner != "غير محدد":
+                if sign > 0: exams_by_owner_date[(owner, exam['date'])].add(pos)
+                else: exams_by_owner_date[(owner, exam['date'])].discard(pos)
+
+        for pos, exam in enumerate(all_exams_flat):
+            index_exam(pos, 1)
+            exams_by_date_level[(exam['date'], exam.get('level'))].append(pos)
+
+        def apply_guard_move(move):
+            """تطبيق حركة حراس مع تحديث الفهارس؛ تعيد حركة التراجع (تُطبَّق بنفس الدالة)."""
+            positions = {exam_pos[id(exam)] for exam, _, _ in move}
+            for pos in positions: index_exam(pos, -1)
+            undo_move = evaluator.apply(move)
+            for pos in positions: index_exam(pos, 1)
+            return undo_move
+
+        def guard_days_of(prof):
+            p_id = instance.prof_index.get(prof)
+            if p_id is None or p_id >= feasibility.day_counts.shape[0]: return set()
+            row = feasibility.day_counts[p_id]
+            return {date for date, col in feasibility.date_cols.items() if row[col]}
+
+        def weighted(cost):
+            # ترتيب المرشحين: النقص والقيود الصارمة أولاً، ثم نفس مجموع القبول (انحراف × 10 + مرنة)
+            return (cost[0], cost[1], 10 * cost[2] + cost[3])
+
+        def fill_shortages(exam):
+            """ملء خانات النقص في امتحان بأقل الأساتذة الصالحين عبئاً."""
+            for g_idx, guard in enumerate(exam['guards']):
+                if guard != "**نقص**": continue
+                eligible = feasibility.eligible_mask(exam)[prof_ids]
+                if eligible.any():
+                    apply_guard_move([(exam, g_idx, all_professors[int(np.argmin(np.where(eligible, feasibility.workload[prof_ids], np.inf)))])])
+
+        def swap_subjects(exam_A, exam_B):
+            """تبديل معلومات امتحانين ككتلة واحدة؛ تعيد دالة تراجع."""
+            snapshots = [(exam, {key: exam[key] for key in ('subject', 'professor', 'halls')}, list(exam['guards'])) for exam in (exam_A, exam_B)]
+            for exam in (exam_A, exam_B):
+                index_exam(exam_pos[id(exam)], -1)
+                evaluator.detach_exam(exam)
+            props_A = {'subject': exam_A['subject'], 'professor': exam_A['professor'], 'halls': exam_A['halls']}
+            props_B = {'subject': exam_B['subject'], 'professor': exam_B['professor'], 'halls': exam_B['halls']}
+            exam_A.update(props_B)
+            exam_B.update(props_A)
+
+            # الآن، تعديل قوائم الحراس لتناسب المتطلبات الجديدة
+            for exam in (exam_A, exam_B):
+                # نفس الـ UUID مع إعادة حساب حقائقه (القاعات تغيرت)، فلا يكبر سجل الامتحانات مع كل محاولة
+                instance.refresh_exam(exam)
+                needed = instance.guards_needed(exam)
+                current_guards = [g for g in exam.get('guards', []) if g != "**نقص**"]
+                if len(current_guards) > needed:
+                    exam['guards'] = current_guards[:needed]
+                else:
+                    exam['guards'] = current_guards + ["**نقص**"] * (needed - len(current_guards))
+                evaluator.attach_exam(exam)
+                index_exam(exam_pos[id(exam)], 1)
+
+            def undo():
+                for exam, _, _ in snapshots:
+                    index_exam(exam_pos[id(exam)], -1)
+                    evaluator.detach_exam(exam)
+                for exam, props, guards in snapshots:
+                    exam.update(props)
+                    exam['guards'] = guards
+                    instance.refresh_exam(exam)
+                    evaluator.attach_exam(exam)
+                    index_exam(exam_pos[id(exam)], 1)
+            return undo
+
+        last_percent = -1
         for i in range(iterations):
             if stop_event and stop_event.is_set(): break
-            log_q.put(f"PROGRESS:{int(((i+1)/iterations)*100)}")
-            
-            neighbor_solution = copy.deepcopy(current_solution)
-            
-            # (هذا هو منطق التحسين من النسخة V13 الذي تفضله)
-            prof_guard_days = defaultdict(set); prof_subject_days = defaultdict(set)
-            prof_stats = {p: {'large': 0, 'other': 0} for p in all_professors}
-            prof_duties = defaultdict(list); prof_assignments = defaultdict(list); prof_large_counts = defaultdict(int)
-            all_exams_flat = [exam for day in neighbor_solution.values() for slot in day.values() for exam in slot]
-            guards_large_hall = int(settings.get('guardsLargeHall', 4))
-            guards_medium_hall = int(settings.get('guardsMediumHall', 2))
-            guards_small_hall = int(settings.get('guardsSmallHall', 1))
-            
-            for exam in all_exams_flat:
-                owner = exam.get('professor', "غير محدد")
-                if owner != "غير محدد": prof_subject_days[owner].add(exam['date'])
-                is_large = any(h['type'] == 'كبيرة' for h in exam.get('halls',[]))
-                for idx, guard in enumerate(exam.get('guards', [])):
-                    if guard != "**نقص**":
-                        prof_guard_days[guard].add(exam['date'])
-                        prof_duties[guard].append({'exam': exam, 'guard_index': idx})
-                        prof_assignments[guard].append(exam)
-                        if is_large: prof_large_counts[guard] += 1
-            
+            percent_complete = int(((i+1)/iterations)*100)
+            if percent_complete != last_percent:
+                last_percent = percent_complete
+                report_progress(log_q, percent_complete, phase='Unified LNS', iteration=i + 1, best_cost=best_cost)
+
+            undo_action = None
             tool_choice = random.random()
             if tool_choice < 0.6: # 60% فرصة لمحاولة تحسين الانحراف
-                custom_patterns = settings.get('customTargetPatterns', [])
-                target_counts = Counter((p['large'], p['other']) for p in custom_patterns for _ in range(p.get('count', 0)))
-                actual_counts = Counter((s['large'], s['other']) for s in prof_stats.values())
-                over_patterns = {p for p, a in actual_counts.items() if a > target_counts.get(p, 0)}
-                donors = [p for p, s in prof_stats.items() if (s['large'], s['other']) in over_patterns]
-                recipients = all_professors
-                random.shuffle(donors); random.shuffle(recipients)
-                move_made = False
+                # المتبرعون: أصحاب الأنماط (كبيرة، أخرى) الزائدة عن الهدف، من المدرج الذي يحفظه المُقيِّم
+                target_counts = instance.custom_target_counts
+                over_patterns = {p for p, a in evaluator.pattern_hist.items() if a > target_counts.get(p, 0)}
+                donors = [p for p in all_professors if prof_duties.get(p) and
+                          (evaluator.role_large[instance.prof_index[p]], evaluator.role_other[instance.prof_index[p]]) in over_patterns]
+                random.shuffle(donors)
                 for prof_donor in donors:
-                    donatable_duties = [d for d in prof_duties[prof_donor] if (d['exam'].get('uuid'), prof_donor) not in locked_guards]
-                    random.shuffle(donatable_duties)
-                    for duty_to_donate in donatable_duties:
-                        for prof_recipient in recipients:
-                            if prof_donor == prof_recipient: continue
-                            exam_to_reassign = duty_to_donate['exam']
-                            if is_assignment_valid(prof_recipient, exam_to_reassign, prof_assignments, prof_large_counts, settings, date_map):
-                                neighbor_solution[exam_to_reassign['date']][exam_to_reassign['time']][
-                                    [e['uuid'] for e in neighbor_solution[exam_to_reassign['date']][exam_to_reassign['time']]].index(exam_to_reassign['uuid'])
-                                ]['guards'][duty_to_donate['guard_index']] = prof_recipient
-                                move_made = True
-                                break
-                        if move_made: break
-                    if move_made: break
+                    donatable_duties = [(pos, g_idx) for pos, g_idx in prof_duties[prof_donor]
+                                        if (all_exams_flat[pos].get('uuid'), prof_donor) not in locked_guards]
+                    if not donatable_duties: continue
+                    pos, g_idx = random.choice(donatable_duties)
+                    exam_to_reassign = all_exams_flat[pos]
+                    eligible = np.flatnonzero(feasibility.eligible_mask(exam_to_reassign)[prof_ids])
+                    if not len(eligible): continue
+                    # تقييم عدد محدود من المستلمين بفرق التكلفة واختيار أفضلهم
+                    candidates = np.random.choice(eligible, min(candidate_count, len(eligible)), replace=False)
+                    moves = [[(exam_to_reassign, g_idx, all_professors[j])] for j in candidates]
+                    best_move = min(moves, key=lambda move: weighted(evaluator.cost_after(move)))
+                    undo_move = apply_guard_move(best_move)
+                    undo_action = lambda undo_move=undo_move: apply_guard_move(undo_move)
+                    break
             else: # 40% فرصة لمحاولة تبديل المواد لتحسين القيود المرنة
                 # ✅ --- الأداة الجديدة: التبديل الذكي للمواد ---
-                improvement_candidates = [p for p, s_days in prof_subject_days.items() if not s_days.issubset(prof_guard_days.get(p, set()))]
-                if improvement_candidates:
-                    prof_to_fix = random.choice(improvement_candidates)
-                    guard_days = prof_guard_days.get(prof_to_fix, set())
-                    non_guard_subject_days = prof_subject_days.get(prof_to_fix, set()) - guard_days
-                    
+                # أول أستاذ (بترتيب عشوائي) له يوم مادة بلا حراسة، من عدادات المُقيِّم ومتتبع الأيام
+                owners = list(evaluator.subject_day_counts)
+                random.shuffle(owners)
+                prof_to_fix, guard_days, non_guard_subject_days = None, set(), set()
+                for owner in owners:
+                    guard_days = guard_days_of(owner)
+                    non_guard_subject_days = set(evaluator.subject_day_counts[owner]) - guard_days
+                    if non_guard_subject_days:
+                        prof_to_fix = owner
+                        break
+                if prof_to_fix is not None:
                     if non_guard_subject_days and guard_days:
-                        day_from = random.choice(list(non_guard_subject_days))
-                        day_to = random.choice(list(guard_days))
+                        day_from = random.choice(sorted(non_guard_subject_days))
+                        day_to = random.choice(sorted(guard_days))
                         
-                        exam_A = next((e for e in all_exams_flat if e['date'] == day_from and e['professor'] == prof_to_fix), None)
+                        exam_A = all_exams_flat[min(exams_by_owner_date[(prof_to_fix, day_from)])]
                         
                         # ابحث عن شريك تبديل في اليوم المستهدف بنفس المستوى
-                        partners = [e for e in all_exams_flat if e['date'] == day_to and e['level'] == exam_A.get('level')]
-                        if exam_A and partners:
-                            exam_B = random.choice(partners)
-
-                            # تبديل معلومات الامتحان ككتلة واحدة
-                            props_A = {'subject': exam_A['subject'], 'professor': exam_A['professor'], 'halls': exam_A['halls']}
-                            props_B = {'subject': exam_B['subject'], 'professor': exam_B['professor'], 'halls': exam_B['halls']}
-                            exam_A.update(props_B)
-                            exam_B.update(props_A)
-
-                            # الآن، تعديل قوائم الحراس لتناسب المتطلبات الجديدة
-                            for exam in [exam_A, exam_B]:
-                                needed = (sum(guards_large_hall for h in exam.get('halls',[]) if h['type']=='كبيرة') +
-                                        sum(guards_medium_hall for h in exam.get('halls',[]) if h['type']=='متوسطة') +
-                                        sum(guards_small_hall for h in exam.get('halls',[]) if h['type']=='صغيرة'))
-                                
-                                current_guards = [g for g in exam.get('guards', []) if g != "**نقص**"]
-                                if len(current_guards) > needed:
-                                    exam['guards'] = current_guards[:needed]
-                                else:
-                                    exam['guards'] = current_guards + ["**نقص**"] * (needed - len(current_guards))
-                            
-                            was_changed = True # تفعيل الإصلاح الشامل
-
-
-            final_neighbor = neighbor_solution
-            new_cost = calculate_cost(final_neighbor, settings, all_professors, duty_patterns, date_map)
-            
+                        partners = exams_by_date_level.get((day_to, exam_A.get('level')), [])
+                        if partners:
+                            exam_B = all_exams_flat[random.choice(partners)]
+                            # امتحان بحراسة مثبتة لا يُبدَّل: تبقى الدورة بلا حركة وتمر بالتبريد أدناه
+                            if not any((e['uuid'], g) in locked_guards for e in (exam_A, exam_B) for g in e.get('guards', [])):
+                                undo_swap = swap_subjects(exam_A, exam_B)
+                                # إصلاح النقص الناتج عن تغير عدد الحراس المطلوب (تراجعه ضمن تراجع التبديل)
+                                fill_moves = []
+                                for exam in (exam_A, exam_B):
+                                    before = list(exam['guards'])
+                                    fill_shortages(exam)
+                                    fill_moves += [(exam, g_idx, old) for g_idx, old in enumerate(before) if exam['guards'][g_idx] != old]
+                                def undo_action(fill_moves=fill_moves, undo_swap=undo_swap):
+                                    apply_guard_move(fill_moves)
+                                    undo_swap()
+
+            if undo_action is None:
+                temp = max(0.1, temp * cooling_rate)
+                continue
+
+            new_cost = evaluator.cost()
             cost_diff = sum(w * (n - c) for w, n, c in zip((10, 1), new_cost[2:], current_cost[2:]))
-            if cost_diff < 0 or random.random() < math.exp(-cost_diff / temp if temp > 0 else float('-inf')):
-                current_solution, current_cost = final_neighbor, new_cost
+            # لا تُقبل حركة تزيد النقص أو تكسر قيداً صارماً كان محترماً
+            if new_cost[:2] <= current_cost[:2] and (cost_diff < 0 or random.random() < math.exp(-cost_diff / temp if temp > 0 else float('-inf'))):
+                current_cost = new_cost
                 if new_cost < best_cost:
                     best_solution, best_cost = copy.deepcopy(current_solution), new_cost
                     log_q.put(f"... [مُحسِّن LNS v16] دورة {i+1}: حل أفضل بتكلفة = {format_cost_tuple(best_cost)}")
+            else:
+                undo_action()
 
             temp = max(0.1, temp * cooling_rate)
 
+        # الامتحانات التي تبدلت مادتها في أفضل حل تأخذ UUID جديداً (مرة واحدة لكل امتحان، لا لكل محاولة)،
+        # وتُعاد حقائق الـ UUID الأصلية إلى قاعات الحل المُدخل الذي قد تحتفظ به الدوال المستدعية
+        original_exams = {exam['uuid']: exam for exam in instance.flat_exams(repaired_solution)}
+        for exam in original_exams.values():
+            instance.refresh_exam(exam)
+        for exam in instance.flat_exams(best_solution):
+            original = original_exams.get(exam['uuid'])
+            if original is not None and (exam['subject'], exam['halls']) != (original['subject'], original['halls']):
+                exam['uuid'] = str(uuid.uuid4())
+                instance.exam_id(exam)
+
     log_q.put(f"✓ انتهى مُحسِّن LNS v16 بأفضل تكلفة: {format_cost_tuple(best_cost)}")
     return best_solution, True
 
@@ -1643,7 +2618,7 @@ def run_unified_lns_optimizer(initial_schedule, settings, all_professors, assign
 # =====================================================================================
 
 # --- الخطوة 1: دالة تقييم جديدة تعيد tuple التكلفة مباشرة ---
-def evaluate_chromosome(chromosome, schedule_with_ids, duty_slots, settings, all_professors, date_map):
+def evaluate_chromosome(chromosome, schedule_with_ids, duty_slots, settings, all_professors, date_map, instance=None):
     # (هذه الدالة هي نفسها build_schedule_from_chromosome و calculate_fitness مدمجتان)
     schedule_copy = copy.deepcopy(schedule_with_ids)
     exam_map = {ex['uuid']: ex for slots in schedule_copy.values() for exams in slots.values() for ex in exams}
@@ -1656,7 +2631,7 @@ def evaluate_chromosome(chromosome, schedule_with_ids, duty_slots, settings, all
         if exam_in_copy:
             exam_in_copy['guards'].append(guard)
     
-    return calculate_cost(schedule_copy, settings, all_professors, settings.get('dutyPatterns', {}), date_map)
+    return calculate_cost(schedule_copy, settings, all_professors, settings.get('dutyPatterns', {}), date_map, instance=instance)
 
 # --- الخطوة 2: دالة "الاختيار بالبطولة" الجديدة ---
 def tournament_selection(population_with_costs, k=5):
@@ -1667,51 +2642,218 @@ def tournament_selection(population_with_costs, k=5):
     return winner[0] # نعيد الكروموسوم الفائز فقط
 
 
-def run_genetic_algorithm(fixed_subject_schedule, settings, all_professors, assignments, all_levels_list, all_halls, exam_schedule_settings, all_subjects, level_hall_assignments, date_map, log_q, locked_guards=set(), stop_event=None):
+class PopulationCostEvaluator:
     """
-    (النسخة V3) - تستخدم tuple التكلفة والاختيار بالبطولة.
+    تقييم مجتمع كامل من الكروموسومات دفعة واحدة، بنفس tuple التكلفة الذي تعيده calculate_cost.
+    الكروموسوم صف أعداد صحيحة بطول مهام الحراسة (duty_slots): رقم الأستاذ في ProblemInstance
+    أو SHORTAGE_GENE لخانة النقص. لا تُبنى أي قواميس جداول: المجتمع مصفوفة (أفراد × مهام)
+    تتحول إلى عدادات (فرد × أستاذ) وإشغال أيام (فرد × أستاذ × يوم) بعمليات المصفوفات.
     """
-    log_q.put(">>> [Genetic Alg v3] بدء الخوارزمية الجينية المطورة...")
-    # --- استخلاص الإعدادات (نفس السابق) ---
-    pop_size = int(settings.get('geneticPopulation', 100))
-    num_generations = int(settings.get('geneticGenerations', 500))
-    crossover_rate = 0.8
-    mutation_rate = float(settings.get('geneticMutation', 0.15))
-    elitism_count = int(settings.get('geneticElitism', 4))
-    
-    # --- التحضيرات (نفس السابق) ---
-    schedule_with_ids = copy.deepcopy(fixed_subject_schedule)
-    all_exams_flat = [exam for slots in schedule_with_ids.values() for exams in slots.values() for exam in exams]
-    for exam in all_exams_flat:
-        exam['uuid'] = str(uuid.uuid4())
-    duty_slots = []
-    guards_large_hall = int(settings.get('guardsLargeHall', 4))
-    guards_medium_hall = int(settings.get('guardsMediumHall', 2))
-    guards_small_hall = int(settings.get('guardsSmallHall', 1))
-    for exam in all_exams_flat:
-        num_guards_needed = (sum(guards_large_hall for h in exam.get('halls', []) if h.get('type') == 'كبيرة') +
-                           sum(guards_medium_hall for h in exam.get('halls', []) if h.get('type') == 'متوسطة') +
-                           sum(guards_small_hall for h in exam.get('halls', []) if h.get('type') == 'صغيرة'))
-        for _ in range(num_guards_needed):
-            duty_slots.append(exam)
-    if not duty_slots:
-        return fixed_subject_schedule, True
+    SHORTAGE_GENE = -1
+
+    def __init__(self, instance, exams):
+        inst = self.instance = instance
+        self.num_profs = num_profs = inst.num_professors
+        duties = inst.duty_slots(exams)
+        self.num_genes = len(duties)
+        gene_exam = np.array([e_id for e_id, _ in duties], dtype=np.int64)
+        gene_pos = np.array([g_idx for _, g_idx in duties], dtype=np.int64)
+        # مهام الامتحان الواحد متتالية، وترتيب المهمة داخل امتحانها هو ترتيب الحارس في قائمة حراسه
+        self.gene_exam_start = np.arange(self.num_genes) - gene_pos
+        self.gene_large_needed = np.array(inst.exam_large_demand, dtype=np.int64)[gene_exam] if duties else np.zeros(0, dtype=np.int64)
+        self.gene_is_large = np.array(inst.exam_is_large, dtype=bool)[gene_exam] if duties else np.zeros(0, dtype=bool)
+        self.gene_time_slot = np.array(inst.exam_slot, dtype=np.int64)[gene_exam] if duties else np.zeros(0, dtype=np.int64)
+        self.num_time_slots = max(len(inst.slots), 1)
+
+        # --- أعمدة الأيام: أيام date_map ثم أي تاريخ امتحان غير معروف ---
+        dates = list(inst.dates)
+        date_cols = {date: col for col, date in enumerate(dates)}
+        for exam in exams:
+            if exam['date'] not in date_cols:
+                date_cols[exam['date']] = len(dates)
+                dates.append(exam['date'])
+        self.num_dates = max(len(dates), 1)
+        self.gene_date_col = np.array([date_cols[inst.exam_date[e_id]] for e_id in gene_exam], dtype=np.int64)
+        self.date_pos = np.array([inst.date_map.get(d, -1) for d in dates] or [-1], dtype=np.int64)
+        self.known_date_cols = np.flatnonzero(self.date_pos >= 0)
+
+        self.unavailable = np.array([[d in inst.unavailable_dates[p] for d in dates] + [False] * (self.num_dates - len(dates))
+                                     for p in range(num_profs)], dtype=bool).reshape(num_profs, self.num_dates)
+        self.pattern_codes = np.array(inst.pattern_codes[:num_profs], dtype=np.int8)
+        self.assign_codes = np.array(inst.assign_pattern_codes[:num_profs], dtype=np.int8)
+        # مواقع الأيام لفحص التجاور في النمط المتتالي (التاريخ غير المعروف لا يجاور أي يوم)
+        self.adjacency_pos = np.where(self.date_pos >= 0, self.date_pos, FeasibilityTracker.UNKNOWN_DATE_POS)
+        # الأستاذ الشريك غير الموجود في القائمة ليس له أيام حراسة: نوجهه إلى صف فارغ إضافي
+        self.partner_pairs = np.array([(min(p1, num_profs), min(p2, num_profs)) for p1, p2 in inst.partner_pairs], dtype=np.int64).reshape(-1, 2)
+
+        # --- القيود المرنة: أيام مواد كل أستاذ ثابتة لأن جدول المواد ثابت ---
+        self.subject_days = np.zeros((num_profs, self.num_dates), dtype=bool)
+        owner_days = defaultdict(set)
+        for exam in exams:
+            owner = exam.get('professor', "غير محدد")
+            if owner == "غير محدد":
+                continue
+            owner_days[owner].add(exam['date'])
+            p_id = inst.prof_index.get(owner)
+            if p_id is not None and p_id < num_profs:
+                self.subject_days[p_id, date_cols[exam['date']]] = True
+        self.extra_subject_days_penalty = sum((len(days) - 2) * 5 for days in owner_days.values() if len(days) > 2)
+
+        target_items = list(inst.custom_target_counts.items()) if inst.use_custom_targets else []
+        self.target_large = np.array([large for (large, _), _ in target_items], dtype=np.int64)
+        self.target_other = np.array([other for (_, other), _ in target_items], dtype=np.int64)
+        self.target_count = np.array([count for _, count in target_items], dtype=np.int64)
+
+    # ---------------- العدادات المشتركة ----------------
+    def _counts(self, population):
+        population = np.atleast_2d(np.asarray(population, dtype=np.int64))
+        num_rows = population.shape[0]
+        valid = population >= 0
+        genes = np.where(valid, population, 0)
+        prof_rows = np.arange(num_rows)[:, None] * self.num_profs + genes
+        size = num_rows * self.num_profs
+        shifts = np.bincount(prof_rows[valid], minlength=size).reshape(num_rows, self.num_profs)
+        large = np.bincount(prof_rows[valid & self.gene_is_large], minlength=size).reshape(num_rows, self.num_profs)
+        days = np.bincount((prof_rows * self.num_dates + self.gene_date_col)[valid], minlength=size * self.num_dates)
+        days = days.reshape(num_rows, self.num_profs, self.num_dates) > 0
+        return population, valid, genes, prof_rows, shifts, large, days
+
+    def _pattern_violations(self, days):
+        """(فرد × أستاذ): نفس شروط نمط الحراسة في is_schedule_valid، على الأيام المعروفة فقط."""
+        known = days[:, :, self.known_date_cols]
+        num_days = known.sum(axis=2)
+        codes = self.pattern_codes[None, :]
+        violated = (codes == PATTERN_CODES['one_day_only']) & (num_days > 1)
+        violated |= (codes == PATTERN_CODES['flexible_2_days']) & (num_days > 0) & (num_days != 2)
+        violated |= (codes == PATTERN_CODES['flexible_3_days']) & (num_days > 0) & ((num_days < 2) | (num_days > 3))
+        consecutive = (codes == PATTERN_CODES['consecutive_strict']) & (num_days > 0)
+        if consecutive.any():
+            positions = self.date_pos[self.known_date_cols]
+            gap = np.where(known, positions, -1).max(axis=2) - np.where(known, positions, np.iinfo(np.int64).max).min(axis=2)
+            violated |= consecutive & ((num_days != 2) | (gap != 1))
+        return violated
+
+    def _hard_violations(self, valid, genes, shifts, large, days):
+        shortage = (~valid).any(axis=1)
+        booking_keys = np.where(valid, genes * self.num_time_slots + self.gene_time_slot, -1 - np.arange(self.num_genes))
+        booking_keys.sort(axis=1)
+        double_booked = (np.diff(booking_keys, axis=1) == 0).any(axis=1)
+        unavailable = (valid & self.unavailable[genes, self.gene_date_col]).any(axis=1) if self.num_profs else np.zeros(len(valid), dtype=bool)
+        over_limit = ((shifts > self.instance.max_shifts) | (large > self.instance.max_large_hall_shifts)).any(axis=1)
+        hard = shortage | double_booked | unavailable | over_limit | self._pattern_violations(days).any(axis=1)
+        if len(self.partner_pairs):
+            padded = np.concatenate([days, np.zeros((days.shape[0], 1, self.num_dates), dtype=bool)], axis=1)
+            hard |= (padded[:, self.partner_pairs[:, 0]] != padded[:, self.partner_pairs[:, 1]]).any(axis=(1, 2))
+        return hard
+
+    # ---------------- الواجهة ----------------
+    def pattern_violations(self, chromosome):
+        """متجه منطقي بطول قائمة الأساتذة: من يخالف نمط أيام الحراسة في هذا الكروموسوم."""
+        return self._pattern_violations(self._counts(chromosome)[6])[0]
+
+    def eligible_mask(self, chromosome, gene_idx):
+        """
+        متجه الأساتذة الصالحين للمهمة gene_idx مع بقاء بقية الكروموسوم كما هو،
+        بنفس شروط is_assignment_valid (التزامن، الغياب، السقفان، ونمط الأيام).
+        """
+        inst = self.instance
+        _, valid, genes, _, shifts, large, days = self._counts(chromosome)
+        valid, genes, shifts, large, days = valid[0], genes[0], shifts[0], large[0], days[0]
+        col = self.gene_date_col[gene_idx]
+
+        busy = np.zeros(self.num_profs, dtype=bool)
+        busy[genes[valid & (self.gene_time_slot == self.gene_time_slot[gene_idx])]] = True
+        eligible = ~busy & ~self.unavailable[:, col] & (shifts < inst.max_shifts)
+        if self.gene_is_large[gene_idx]:
+            eligible &= large < inst.max_large_hall_shifts
+
+        new_day = ~days[:, col]
+        num_days = days.sum(axis=1)
+        blocked = new_day & (num_days >= ASSIGN_PATTERN_DAY_LIMITS[self.assign_codes])
+        consecutive = new_day & (self.assign_codes == PATTERN_CODES['consecutive_strict']) & (num_days == 1)
+        if consecutive.any():
+            existing_pos = self.adjacency_pos[days.argmax(axis=1)]
+            blocked |= consecutive & (np.abs(existing_pos - self.adjacency_pos[col]) != 1)
+        return eligible & ~blocked
+
+    def is_valid(self, chromosome):
+        """نفس نتيجة is_schedule_valid للجدول المبني من الكروموسوم."""
+        _, valid, genes, _, shifts, large, days = self._counts(chromosome)
+        return not self._hard_violations(valid, genes, shifts, large, days)[0]
+
+    def evaluate(self, population):
+        """قائمة tuples التكلفة (نقص، قيود صارمة، انحراف، قيود مرنة) لكل صف من مصفوفة المجتمع."""
+        population, valid, genes, prof_rows, shifts, large, days = self._counts(population)
+        num_rows = population.shape[0]
+        size = num_rows * self.num_profs
+        shortage = (~valid).sum(axis=1)
+        hard = self._hard_violations(valid, genes, shifts, large, days)
+
+        # الأدوار: أول large_guards_needed حارس (من غير خانات النقص) في كل امتحان هم حراس القاعة الكبيرة
+        filled_before = np.concatenate([np.zeros((num_rows, 1), dtype=np.int64), np.cumsum(valid, axis=1)], axis=1)
+        rank_in_exam = filled_before[:, :self.num_genes] - filled_before[:, self.gene_exam_start]
+        large_role = valid & (rank_in_exam < self.gene_large_needed)
+        role_large = np.bincount(prof_rows[large_role], minlength=size).reshape(num_rows, self.num_profs)
+        role_other = np.bincount(prof_rows[valid & ~large_role], minlength=size).reshape(num_rows, self.num_profs)
+
+        if self.instance.use_custom_targets:
+            # Σ|الفعلي - الهدف| على اتحاد الأنماط = Σ على أنماط الهدف + عدد الأساتذة خارجها
+            matches = (role_large[:, :, None] == self.target_large) & (role_other[:, :, None] == self.target_other)
+            actual = matches.sum(axis=1)
+            deviation = (np.abs(actual - self.target_count).sum(axis=1) + self.num_profs - actual.sum(axis=1)) * 2.0
+        elif self.num_profs:
+            workload = role_large * self.instance.large_hall_weight + role_other
+            deviation = workload.max(axis=1) - workload.min(axis=1)
+        else:
+            deviation = np.zeros(num_rows)
+
+        missed_days = (self.subject_days[None] & ~days).sum(axis=(1, 2))
+        soft = missed_days * 10 + self.extra_subject_days_penalty
+        return [(int(shortage[r]), int(hard[r]), float(deviation[r]), int(soft[r])) for r in range(num_rows)]
 
-    def create_random_chromosome():
-        chromosome = [None] * len(duty_slots)
-        prof_assignments = {prof: [] for prof in all_professors}
-        prof_large_counts = defaultdict(int)
+
+class GeneticEngine:
+    """
+    عوامل الخوارزمية الجينية على كروموسومات مصفوفات أعداد صحيحة: الإنشاء العشوائي، العبور، الطفرة المُصلِحة،
+    وبناء جيل كامل (نخبة + اختيار بالبطولة). تُستخدم في run_genetic_algorithm وفي كل جزيرة من run_genetic_islands.
+    """
+    def __init__(self, schedule_with_ids, settings, all_professors, assignments, all_subjects, instance, mutation_rate):
+        self.schedule_with_ids = schedule_with_ids
+        self.settings = settings
+        self.all_professors = all_professors
+        self.assignments = assignments
+        self.all_subjects = all_subjects
+        self.instance = instance
+        self.pop_size = int(settings.get('geneticPopulation', 100))
+        self.elitism_count = int(settings.get('geneticElitism', 4))
+        self.crossover_rate = 0.8
+        self.mutation_rate = mutation_rate
+        self.duty_patterns = settings.get('dutyPatterns', {})
+        self.prof_index = instance.prof_index
+
+        self.all_exams_flat = [exam for slots in schedule_with_ids.values() for exams in slots.values() for exam in exams]
+        self.duty_slots = []
+        for exam in self.all_exams_flat:
+            for _ in range(instance.guards_needed(exam)):
+                self.duty_slots.append(exam)
+        self.num_genes = len(self.duty_slots)
+        self.evaluator = PopulationCostEvaluator(instance, self.all_exams_flat)
+
+    def create_random_chromosome(self):
+        instance, settings, prof_index, duty_slots = self.instance, self.settings, self.prof_index, self.duty_slots
+        chromosome = np.full(self.num_genes, PopulationCostEvaluator.SHORTAGE_GENE, dtype=np.int32)
+        is_filled = np.zeros(self.num_genes, dtype=bool)
+        feasibility = FeasibilityTracker(instance)
 
         unavailable_days = settings.get('unavailableDays', {})
-        duty_patterns = settings.get('dutyPatterns', {})
-        max_shifts = int(settings.get('maxShifts', '0')) if settings.get('maxShifts', '0') != '0' else float('inf')
-        max_large_hall_shifts = int(settings.get('maxLargeHallShifts', '2')) if settings.get('maxLargeHallShifts', '2') != '0' else float('inf')
+        max_shifts = instance.max_shifts
+        max_large_hall_shifts = instance.max_large_hall_shifts
         assign_owner_as_guard = settings.get('assignOwnerAsGuard', False)
 
         if assign_owner_as_guard:
-            subject_owners = { (clean_string_for_matching(s['name']), clean_string_for_matching(s['level'])): clean_string_for_matching(prof) for prof, uids in assignments.items() for uid in uids for s in all_subjects if f"{s['name']} ({s['level']})" == uid }
+            subject_owners = { (clean_string_for_matching(s['name']), clean_string_for_matching(s['level'])): clean_string_for_matching(prof) for prof, uids in self.assignments.items() for uid in uids for s in self.all_subjects if f"{s['name']} ({s['level']})" == uid }
             prof_last_exam = {}
-            for exam in all_exams_flat:
+            for exam in self.all_exams_flat:
                 owner = subject_owners.get((clean_string_for_matching(exam['subject']), clean_string_for_matching(exam['level'])))
                 if owner:
                     exam_date_time = (exam['date'], exam['time'])
@@ -1719,192 +2861,189 @@ def run_genetic_algorithm(fixed_subject_schedule, settings, all_professors, assi
                         prof_last_exam[owner] = {'exam': exam, 'datetime': exam_date_time}
 
             for owner, data in prof_last_exam.items():
+                owner_id = prof_index.get(owner)
+                if owner_id is None or owner_id >= len(self.all_professors): continue
                 exam_to_assign = data['exam']
                 duty_index_to_fill = -1
                 for i, slot_exam in enumerate(duty_slots):
-                    if slot_exam['uuid'] == exam_to_assign['uuid'] and chromosome[i] is None:
+                    if slot_exam['uuid'] == exam_to_assign['uuid'] and not is_filled[i]:
                         duty_index_to_fill = i
                         break
 
                 if duty_index_to_fill != -1:
-                    is_large = any(h['type'] == 'كبيرة' for h in exam_to_assign.get('halls', []))
+                    is_large = instance.is_large(exam_to_assign)
                     if exam_to_assign['date'] not in unavailable_days.get(owner, []) and \
-                    len(prof_assignments[owner]) < max_shifts and \
-                    (not is_large or prof_large_counts[owner] < max_large_hall_shifts):
+                    feasibility.shifts[owner_id] < max_shifts and \
+                    (not is_large or feasibility.large[owner_id] < max_large_hall_shifts):
 
-                        chromosome[duty_index_to_fill] = owner
-                        prof_assignments[owner].append(exam_to_assign)
-                        if is_large:
-                            prof_large_counts[owner] += 1
+                        chromosome[duty_index_to_fill] = owner_id
+                        is_filled[duty_index_to_fill] = True
+                        feasibility.add_duty(exam_to_assign, owner, 1)
 
-        shuffled_indices = list(range(len(duty_slots)))
+        shuffled_indices = list(range(self.num_genes))
         random.shuffle(shuffled_indices)
 
         for i in shuffled_indices:
-            if chromosome[i] is not None: continue 
+            if is_filled[i]: continue
 
             exam = duty_slots[i]
-            is_large_exam = any(h['type'] == 'كبيرة' for h in exam.get('halls', []))
-
-            shuffled_profs = list(all_professors)
+            shuffled_profs = list(self.all_professors)
             random.shuffle(shuffled_profs)
 
-            assigned_prof = None
-            for prof in shuffled_profs:
-                if any(chromosome[j] == prof for j, slot in enumerate(duty_slots) if slot['uuid'] == exam['uuid']):
-                    continue
-
-                is_busy = any(a_exam['date'] == exam['date'] and a_exam['time'] == exam['time'] for a_exam in prof_assignments[prof])
-                if is_busy: continue
-                if exam['date'] in unavailable_days.get(prof, []): continue
-                if len(prof_assignments[prof]) >= max_shifts: continue
-                if is_large_exam and prof_large_counts[prof] >= max_large_hall_shifts: continue
-
-                prof_pattern = duty_patterns.get(prof, 'flexible_2_days')
-                current_prof_dates = {e['date'] for e in prof_assignments.get(prof, [])}
-                is_new_day = exam['date'] not in current_prof_dates
-
-                is_pattern_violated = False
-                if is_new_day:
-                    num_current_days = len(current_prof_dates)
-                    if prof_pattern == 'one_day_only' and num_current_days >= 1: is_pattern_violated = True
-                    elif prof_pattern == 'flexible_2_days' and num_current_days >= 2: is_pattern_violated = True
-                    elif prof_pattern == 'flexible_3_days' and num_current_days >= 3: is_pattern_violated = True
-                    elif prof_pattern == 'consecutive_strict':
-                        if num_current_days >= 2: is_pattern_violated = True
-                        elif num_current_days == 1:
-                            existing_day_idx = date_map.get(list(current_prof_dates)[0])
-                            new_day_idx = date_map.get(exam['date'])
-                            if existing_day_idx is None or new_day_idx is None or abs(new_day_idx - existing_day_idx) != 1:
-                                is_pattern_violated = True
-                if is_pattern_violated: continue
-
-                assigned_prof = prof
-                break
+            # التزامن (ومنه تكرار الأستاذ في نفس الامتحان)، الغياب، السقفان ونمط الأيام في متجه واحد
+            eligible = feasibility.eligible_mask(exam)
+            assigned_prof = next((prof for prof in shuffled_profs if eligible[prof_index[prof]]), None)
 
             if assigned_prof:
-                chromosome[i] = assigned_prof
-                prof_assignments[assigned_prof].append(exam)
-                if is_large_exam:
-                    prof_large_counts[assigned_prof] += 1
-            else:
-                chromosome[i] = "**نقص**"
+                chromosome[i] = prof_index[assigned_prof]
+                feasibility.add_duty(exam, assigned_prof, 1)
+            is_filled[i] = True
 
         return chromosome
-    
-    def build_schedule_from_chromosome(chromosome, schedule_with_ids, duty_slots):
-        schedule_copy = copy.deepcopy(schedule_with_ids)
-        exam_map = {ex['uuid']: ex for slots in schedule_copy.values() for exams in slots.values() for ex in exams}
-        # هام: مسح الحراس الحاليين قبل ملء الجدول من جديد
-        for ex in exam_map.values():
-            ex['guards'] = []
-
-        for i, guard in enumerate(chromosome):
-            exam_ref_uuid = duty_slots[i]['uuid']
-            exam_in_copy = exam_map.get(exam_ref_uuid)
-            if exam_in_copy:
-                exam_in_copy['guards'].append(guard)
-        return schedule_copy
-    
-    # --- دوال Crossover و Mutation (تبقى كما هي تماماً) ---
-    def crossover(parent1, parent2):
+
+    def crossover(self, parent1, parent2):
         point = random.randint(1, len(parent1) - 1)
-        return parent1[:point] + parent2[point:], parent2[:point] + parent1[point:]
-    
-    def mutation(chromosome):
+        return np.concatenate([parent1[:point], parent2[point:]]), np.concatenate([parent2[:point], parent1[point:]])
+
+    def mutation(self, chromosome):
         """
         عامل طفرة ذكي ومُحسَّن.
         الاستراتيجية الأولى: إذا كان الكروموسوم غير صالح، فإنه يحاول "إصلاح" الانتهاك.
         الاستراتيجية الثانية: إذا كان الكروموسوم صالحًا بالفعل، فإنه يقوم بتبديل "آمن" لاستكشاف حلول أخرى.
         """
-        mutated_chromosome = list(chromosome)
-        
-        # --- التحقق من وجود انتهاكات أولاً ---
-        # بناء جدول مؤقت لتحليله
-        schedule = build_schedule_from_chromosome(mutated_chromosome, schedule_with_ids, duty_slots)
-        
-        # جلب مهام كل أستاذ من الكروموسوم الحالي
-        prof_assigned_slots = defaultdict(list)
-        for i, guard in enumerate(mutated_chromosome):
-            if guard != "**نقص**":
-                exam = duty_slots[i]
-                prof_assigned_slots[guard].append({ 'exam': exam, 'duty_index': i })
+        prof_index, num_profs = self.prof_index, len(self.all_professors)
+        mutated_chromosome = chromosome.copy()
+
+        # تحديد الأساتذة الذين ينتهكون قيود نمط الأيام (بترتيب إعدادات الأنماط)
+        violation_mask = self.evaluator.pattern_violations(mutated_chromosome)
+        violating_profs = [prof for prof in self.duty_patterns
+                           if prof_index.get(prof, num_profs) < num_profs and violation_mask[prof_index[prof]]]
 
-        # تحديد الأساتذة الذين ينتهكون قيود نمط الأيام
-        violating_profs = []
-        duty_patterns = settings.get('dutyPatterns', {})
-        for prof, pattern in duty_patterns.items():
-            if not prof_assigned_slots.get(prof): continue
-            
-            duties_dates_indices = sorted(list({date_map.get(d['exam']['date']) for d in prof_assigned_slots.get(prof, []) if date_map.get(d['exam']['date']) is not None}))
-            if not duties_dates_indices: continue
-            
-            num_unique_duty_days = len(duties_dates_indices)
-            is_violated = False
-            # (هذا هو نفس منطق التحقق من صحة القيود الصارمة)
-            if pattern == 'consecutive_strict':
-                if num_unique_duty_days > 0 and (num_unique_duty_days != 2 or (duties_dates_indices[1] - duties_dates_indices[0] != 1)): is_violated = True
-            elif pattern == 'one_day_only':
-                if num_unique_duty_days > 1: is_violated = True
-            elif pattern == 'flexible_2_days':
-                if num_unique_duty_days > 0 and num_unique_duty_days != 2: is_violated = True
-            elif pattern == 'flexible_3_days':
-                if num_unique_duty_days > 0 and (num_unique_duty_days < 2 or num_unique_duty_days > 3): is_violated = True
-            
-            if is_violated:
-                violating_profs.append(prof)
-                
         # --- الاستراتيجية 1: إصلاح جدول غير صالح ---
         if violating_profs:
             prof_to_fix = random.choice(violating_profs)
             
             # اختر عشوائياً إحدى مهام هذا الأستاذ لإعادة إسنادها
-            duty_to_reassign_info = random.choice(prof_assigned_slots[prof_to_fix])
-            duty_index = duty_to_reassign_info['duty_index']
-            exam_for_duty = duty_to_reassign_info['exam']
-            
-            # بناء السياق الكامل اللازم للتحقق من صحة التعيين
-            prof_assignments_map = defaultdict(list)
-            prof_large_counts_map = defaultdict(int)
-            all_exams_in_schedule = [exam for day in schedule.values() for slot in day.values() for exam in slot]
-            for exam in all_exams_in_schedule:
-                is_large = any(h['type'] == 'كبيرة' for h in exam.get('halls', []))
-                for guard in exam.get('guards', []):
-                    if guard != "**نقص**":
-                        prof_assignments_map[guard].append(exam)
-                        if is_large: prof_large_counts_map[guard] += 1
+            duty_index = random.choice(np.flatnonzero(mutated_chromosome == prof_index[prof_to_fix]).tolist())
             
             # ابحث عن أستاذ جديد يمكنه تولي هذه المهمة بشكل صحيح
-            shuffled_profs = list(all_professors); random.shuffle(shuffled_profs)
+            eligible = self.evaluator.eligible_mask(mutated_chromosome, duty_index)
+            shuffled_profs = list(self.all_professors); random.shuffle(shuffled_profs)
             for new_prof in shuffled_profs:
                 if new_prof == prof_to_fix: continue
                 
-                # تحقق مما إذا كان الأستاذ الجديد يستطيع قبول المهمة
-                if is_assignment_valid(new_prof, exam_for_duty, prof_assignments_map, prof_large_counts_map, settings, date_map):
-                    mutated_chromosome[duty_index] = new_prof
+                if eligible[prof_index[new_prof]]:
+                    mutated_chromosome[duty_index] = prof_index[new_prof]
                     return mutated_chromosome # إرجاع الكروموسوم بعد إصلاحه
 
         # --- الاستراتيجية 2: استكشاف حلول جديدة من جدول صالح ---
         # إذا لم يكن هناك انتهاكات، قم بإجراء تبديل عشوائي آمن
         for _ in range(10): 
-            if len(chromosome) < 2: return list(chromosome)
+            if len(chromosome) < 2: return chromosome.copy()
             idx1, idx2 = random.sample(range(len(chromosome)), 2)
             if chromosome[idx1] == chromosome[idx2]: continue
 
-            temp_mutated = list(chromosome)
+            temp_mutated = chromosome.copy()
             temp_mutated[idx1], temp_mutated[idx2] = temp_mutated[idx2], temp_mutated[idx1]
             
             # تحقق من أن هذا التبديل الاستكشافي لم يكسر الجدول الصالح
-            temp_schedule = build_schedule_from_chromosome(temp_mutated, schedule_with_ids, duty_slots)
-            if is_schedule_valid(temp_schedule, settings, all_professors, duty_patterns, date_map):
+            if self.evaluator.is_valid(temp_mutated):
                 return temp_mutated # قبول الحركة الاستكشافية الصالحة
 
         # إذا فشلت كل من عملية الإصلاح والاستكشاف، أرجع الحل الأصلي
-        return list(chromosome)
+        return chromosome.copy()
+
+    def initial_population(self):
+        """المجتمع الأولي مع تكاليف فارغة (None = لم يُقيَّم بعد)."""
+        return [self.create_random_chromosome() for _ in range(self.pop_size)], [None] * self.pop_size
+
+    def rank(self, population, population_costs):
+        """تقييم الأفراد غير المقيَّمين دفعة واحدة ثم إرجاع (كروموسوم، تكلفة) مرتبة من الأفضل للأسوأ."""
+        unevaluated = [idx for idx, cost in enumerate(population_costs) if cost is None]
+        if unevaluated:
+            for idx, cost in zip(unevaluated, self.evaluator.evaluate(np.stack([population[idx] for idx in unevaluated]))):
+                population_costs[idx] = cost
+        population_with_costs = list(zip(population, population_costs))
+        # بايثون تقارن الـ tuple عنصرًا بعنصر تلقائيًا، وهذا بالضبط ما نريده
+        population_with_costs.sort(key=lambda item: item[1])
+        return population_with_costs
+
+    def next_generation(self, population_with_costs):
+        """
+        جيل جديد من مجتمع مرتب: النخبة كما هي، ثم أبناء من الاختيار بالبطولة والعبور الحذِر والطفرة.
+        تكلفة النخبة والأبناء المقبولين بلا طفرة تنتقل معهم، فلا يُعاد تقييمهم.
+        """
+        next_generation = list(population_with_costs[:self.elitism_count])
+        
+        while len(next_generation) < self.pop_size:
+            # اختيار الآباء مع تكاليفهم
+            parent1_item = min(random.sample(population_with_costs, k=5), key=lambda item: item[1])
+            parent2_item = min(random.sample(population_with_costs, k=5), key=lambda item: item[1])
+            p1, p1_cost = parent1_item
+            p2, p2_cost = parent2_item
+
+            c1, c1_cost, c2, c2_cost = p1, p1_cost, p2, p2_cost  # بشكل افتراضي، الأبناء هم نسخة من الآباء
+
+            if random.random() < self.crossover_rate:
+                child1_candidate, child2_candidate = self.crossover(p1, p2)
+
+                # --- ✅ المنطق الجديد للعبور الحذِر ---
+                # قبول الابن فقط إذا لم يكن أسوأ من الأب من ناحية القيود الصارمة
+                child1_cost, child2_cost = self.evaluator.evaluate(np.stack([child1_candidate, child2_candidate]))
+                # [1] هو مؤشر "القيود الصارمة" في tuple التكلفة
+                if child1_cost[1] <= p1_cost[1]:
+                    c1, c1_cost = child1_candidate, child1_cost  # تم قبول الابن الأول
+                if child2_cost[1] <= p2_cost[1]:
+                    c2, c2_cost = child2_candidate, child2_cost  # تم قبول الابن الثاني
+
+            # الآن يتم تطبيق الطفرة الذكية (المُصلِحة) على الأبناء المقبولين
+            if random.random() < self.mutation_rate:
+                next_generation.append((self.mutation(c1), None))
+            else:
+                next_generation.append((c1, c1_cost))
+
+            if len(next_generation) < self.pop_size:
+                if random.random() < self.mutation_rate:
+                    next_generation.append((self.mutation(c2), None))
+                else:
+                    next_generation.append((c2, c2_cost))
+        return [item[0] for item in next_generation], [item[1] for item in next_generation]
+
+    def build_schedule(self, chromosome):
+        """بناء الجدول (نسخة من جدول المواد) من كروموسوم."""
+        schedule_built = copy.deepcopy(self.schedule_with_ids)
+        exam_map = {ex['uuid']: ex for slots in schedule_built.values() for exams in slots.values() for ex in exams}
+        for ex in exam_map.values(): ex['guards'] = []
+        for i, gene in enumerate(chromosome):
+            exam_in_copy = exam_map.get(self.duty_slots[i]['uuid'])
+            if exam_in_copy: exam_in_copy['guards'].append(self.instance.prof_names[gene] if gene != PopulationCostEvaluator.SHORTAGE_GENE else "**نقص**")
+        return schedule_built
+
+
+def run_genetic_algorithm(fixed_subject_schedule, settings, all_professors, assignments, all_levels_list, all_halls, exam_schedule_settings, all_subjects, level_hall_assignments, date_map, log_q, locked_guards=set(), stop_event=None, instance=None):
+    """
+    (النسخة V4) - تستخدم tuple التكلفة والاختيار بالبطولة.
+    الكروموسوم مصفوفة أعداد صحيحة (رقم الأستاذ لكل مهمة حراسة)، والمجتمع يُقيَّم دفعة واحدة
+    بـ PopulationCostEvaluator دون بناء جداول وسيطة. العوامل الجينية في GeneticEngine.
+    """
+    log_q.put(">>> [Genetic Alg v3] بدء الخوارزمية الجينية المطورة...")
+    # --- استخلاص الإعدادات (نفس السابق) ---
+    num_generations = int(settings.get('geneticGenerations', 500))
+    mutation_rate = float(settings.get('geneticMutation', 0.15))
+    
+    # --- التحضيرات ---
+    schedule_with_ids = copy.deepcopy(fixed_subject_schedule)
+    for exam in (exam for slots in schedule_with_ids.values() for exams in slots.values() for exam in exams):
+        exam['uuid'] = str(uuid.uuid4())
+    instance = get_problem_instance(instance, settings, all_professors, settings.get('dutyPatterns', {}), date_map)
+    engine = GeneticEngine(schedule_with_ids, settings, all_professors, assignments, all_subjects, instance, mutation_rate)
+    if not engine.duty_slots:
+        return fixed_subject_schedule, True
 
     # --- 3. بدء الخوارزمية بالمنطق الجديد ---
     log_q.put("... بناء المجتمع الأولي...")
-    population = [create_random_chromosome() for _ in range(pop_size)] # create_random_chromosome تبقى كما هي
+    # تكلفة كل فرد تُحفظ معه؛ None = لم يُقيَّم بعد (النخبة والأبناء المقبولون بلا طفرة لا يُعاد تقييمهم)
+    population, population_costs = engine.initial_population()
     
     best_chromosome_so_far = None
     best_cost_so_far = (float('inf'), float('inf'), float('inf'), float('inf'))
@@ -1915,14 +3054,10 @@ def run_genetic_algorithm(fixed_subject_schedule, settings, all_professors, assi
             break
             
         percent_complete = int(((gen + 1) / num_generations) * 100)
-        log_q.put(f"PROGRESS:{percent_complete}")
-        
-        # --- V3: نقوم بتقييم كل فرد في المجتمع بناءً على tuple التكلفة ---
-        population_with_costs = [(chrom, evaluate_chromosome(chrom, schedule_with_ids, duty_slots, settings, all_professors, date_map)) for chrom in population]
+        report_progress(log_q, percent_complete, phase='GA', iteration=gen + 1, best_cost=best_cost_so_far)
         
-        # --- V3: الفرز الآن يعتمد على التكلفة (الأقل هو الأفضل) ---
-        # بايثون تقارن الـ tuple عنصرًا بعنصر تلقائيًا، وهذا بالضبط ما نريده
-        population_with_costs.sort(key=lambda item: item[1])
+        # --- تقييم كل الأفراد غير المقيَّمين دفعة واحدة ثم الفرز حسب التكلفة (الأقل هو الأفضل) ---
+        population_with_costs = engine.rank(population, population_costs)
         
         current_best_chrom, current_best_cost = population_with_costs[0]
         
@@ -1936,93 +3071,159 @@ def run_genetic_algorithm(fixed_subject_schedule, settings, all_professors, assi
             log_q.put("✓ تم العثور على حل مثالي. إنهاء البحث.")
             break
         
-        # --- V3: النخبة (Elitism) تبقى، نأخذ أفضل الحلول (أقلها تكلفة) ---
-        next_generation = [item[0] for item in population_with_costs[:elitism_count]]
-        
-        while len(next_generation) < pop_size:
-            # اختيار الآباء مع تكاليفهم
-            parent1_item = min(random.sample(population_with_costs, k=5), key=lambda item: item[1])
-            parent2_item = min(random.sample(population_with_costs, k=5), key=lambda item: item[1])
-            p1, p1_cost = parent1_item
-            p2, p2_cost = parent2_item
-
-            c1, c2 = p1, p2  # بشكل افتراضي، الأبناء هم نسخة من الآباء
-
-            if random.random() < crossover_rate:
-                child1_candidate, child2_candidate = crossover(p1, p2)
-
-                # --- ✅ المنطق الجديد للعبور الحذِر ---
-                # قبول الابن فقط إذا لم يكن أسوأ من الأب من ناحية القيود الصارمة
-                
-                # تقييم الابن المرشح الأول
-                child1_cost = evaluate_chromosome(child1_candidate, schedule_with_ids, duty_slots, settings, all_professors, date_map)
-                # [1] هو مؤشر "القيود الصارمة" في tuple التكلفة
-                if child1_cost[1] <= p1_cost[1]:
-                    c1 = child1_candidate  # تم قبول الابن الأول
-                
-                # تقييم الابن المرشح الثاني
-                child2_cost = evaluate_chromosome(child2_candidate, schedule_with_ids, duty_slots, settings, all_professors, date_map)
-                if child2_cost[1] <= p2_cost[1]:
-                    c2 = child2_candidate  # تم قبول الابن الثاني
-
-            # الآن يتم تطبيق الطفرة الذكية (المُصلِحة) على الأبناء المقبولين
-            if random.random() < mutation_rate:
-                next_generation.append(mutation(c1))
-            else:
-                next_generation.append(c1)
-
-            if len(next_generation) < pop_size:
-                if random.random() < mutation_rate:
-                    next_generation.append(mutation(c2))
-                else:
-                    next_generation.append(c2)
-        population = next_generation
+        population, population_costs = engine.next_generation(population_with_costs)
 
     log_q.put(f">>> [Genetic Alg v3] Finished. Best cost found: {format_cost_tuple(best_cost_so_far)}")
     
-    if not best_chromosome_so_far:
+    if best_chromosome_so_far is None:
         log_q.put("!!! لم تتمكن الخوارزمية الجينية من إيجاد حل.")
         return fixed_subject_schedule, False
 
-    # --- V3: بناء الجدول النهائي من أفضل كروموسوم تم العثور عليه ---
-    final_schedule = evaluate_chromosome(best_chromosome_so_far, schedule_with_ids, duty_slots, settings, all_professors, date_map)
-    # ملاحظة: دالة التقييم تعيد tuple التكلفة، لكنها تبني الجدول كخطوة وسطية. علينا إعادة بناء الجدول مرة أخيرة
-    final_schedule_built = copy.deepcopy(schedule_with_ids)
-    final_exam_map = {ex['uuid']: ex for slots in final_schedule_built.values() for exams in slots.values() for ex in exams}
-    for ex in final_exam_map.values(): ex['guards'] = []
-    for i, guard in enumerate(best_chromosome_so_far):
-        exam_ref_uuid = duty_slots[i]['uuid']
-        exam_in_copy = final_exam_map.get(exam_ref_uuid)
-        if exam_in_copy: exam_in_copy['guards'].append(guard)
-        
-    return final_schedule_built, True
+    # --- بناء الجدول النهائي من أفضل كروموسوم تم العثور عليه ---
+    return engine.build_schedule(best_chromosome_so_far), True
 
 # =====================================================================================
 # --- END: GENETIC ALGORITHM V3 ---
 # =====================================================================================
 
 
+# =====================================================================================
+# --- START: نموذج الجزر للخوارزمية الجينية (عمليات متوازية مع هجرة حلقية) ---
+# =====================================================================================
+def _run_genetic_island_in_worker(island_idx, num_islands, seed, schedule_with_ids, settings, all_professors, assignments, all_subjects, date_map, mutation_rate, inboxes, shared_log_q, shared_stop_event):
+    """
+    جزيرة واحدة: مجتمع مستقل بمعدل طفرة خاص. كل migration_interval جيل ترسل أفضل أفرادها إلى الجزيرة التالية
+    في الحلقة وتستقبل ما وصلها (دون انتظار) ليحل محل أسوأ أفرادها.
+    """
+    random.seed(seed)
+    np.random.seed(seed % (2 ** 32))
+    log_q = _PrefixedLogQueue(shared_log_q, f"[جزيرة {island_idx + 1}]", forward_progress=(island_idx == 0))
+    instance = ProblemInstance(settings, all_professors, settings.get('dutyPatterns', {}), date_map)
+    engine = GeneticEngine(schedule_with_ids, settings, all_professors, assignments, all_subjects, instance, mutation_rate)
+    num_generations = int(settings.get('geneticGenerations', 500))
+    migration_interval = max(1, int(settings.get('geneticMigrationInterval', 10)))
+    num_migrants = max(1, int(settings.get('geneticMigrants', 2)))
+
+    log_q.put(f"... بناء المجتمع الأولي (معدل الطفرة = {mutation_rate:.3f})...")
+    population, population_costs = engine.initial_population()
+    best_chromosome, best_cost = None, (float('inf'), float('inf'), float('inf'), float('inf'))
+
+    for gen in range(num_generations):
+        if shared_stop_event.is_set():
+            break
+        report_progress(log_q, int(((gen + 1) / num_generations) * 100), phase='GA', iteration=gen + 1, best_cost=best_cost)
+
+        population_with_costs = engine.rank(population, population_costs)
+        if population_with_costs[0][1] < best_cost:
+            best_chromosome, best_cost = population_with_costs[0]
+            log_q.put(f"... [Generation {gen+1}/{num_generations}] New best cost: {format_cost_tuple(best_cost)}")
+            if best_cost == (0, 0, 0.0, 0):
+                log_q.put("✓ تم العثور على حل مثالي. إيقاف كل الجزر.")
+                shared_stop_event.set()
+                break
+
+        # --- الهجرة الحلقية: أفضل الأفراد إلى الجزيرة التالية، والوافدون يحلون محل الأسوأ ---
+        if (gen + 1) % migration_interval == 0:
+            inboxes[(island_idx + 1) % num_islands].put([(chrom.tolist(), cost) for chrom, cost in population_with_costs[:num_migrants]])
+            immigrants = []
+            while True:
+                try:
+                    immigrants.extend(inboxes[island_idx].get_nowait())
+                except queue.Empty:
+                    break
+            if immigrants:
+                immigrants = immigrants[:len(population_with_costs) - engine.elitism_count]
+                population_with_costs[len(population_with_costs) - len(immigrants):] = [(np.array(chrom, dtype=np.int32), tuple(cost)) for chrom, cost in immigrants]
+                population_with_costs.sort(key=lambda item: item[1])
+
+        population, population_costs = engine.next_generation(population_with_costs)
+
+    return island_idx, (best_chromosome.tolist() if best_chromosome is not None else None), best_cost
+
+
+def run_genetic_islands(fixed_subject_schedule, settings, all_professors, assignments, all_levels_list, all_halls, exam_schedule_settings, all_subjects, level_hall_assignments, date_map, log_q, locked_guards=set(), stop_event=None, instance=None):
+    """
+    نموذج الجزر: عدة مجتمعات جينية في عمليات مستقلة (ProcessPoolExecutor)، لكل منها معدل طفرة مختلف حول
+    القيمة المحددة، مع تبادل أفضل الأفراد كل عدة أجيال عبر حلقة. النتيجة هي أفضل حل بين كل الجزر.
+    """
+    log_q.put(">>> [Genetic Islands] بدء نموذج الجزر للخوارزمية الجينية...")
+    try:
+        num_islands = int(settings.get('geneticIslands', 4))
+    except (ValueError, TypeError):
+        num_islands = 4
+    # الأنوية المشغولة بعمليات محاولات البحث (لمهام أخرى جارية) لا تُحسب للجزر
+    available_cpus = (os.cpu_count() or 1) // max(1, running_attempt_workers())
+    num_islands = max(1, min(num_islands, available_cpus))
+    if multiprocessing.parent_process() is not None:
+        # داخل عملية مستقلة (محاولة بحث): التوازي موجود أصلاً على مستوى العمليات، فلا مجمعات متداخلة
+        log_q.put("... داخل عملية مستقلة (لا مجمع عمليات متداخل)، سيتم تشغيل الخوارزمية الجينية العادية.")
+        num_islands = 1
+    elif num_islands == 1:
+        log_q.put("... جزيرة واحدة فقط متاحة، سيتم تشغيل الخوارزمية الجينية العادية.")
+    if num_islands == 1:
+        return run_genetic_algorithm(fixed_subject_schedule, settings, all_professors, assignments, all_levels_list, all_halls, exam_schedule_settings, all_subjects, level_hall_assignments, date_map, log_q, locked_guards=locked_guards, stop_event=stop_event, instance=instance)
+
+    # معرفات الامتحانات تُثبَّت هنا حتى يكون ترتيب المهام (الجينات) واحداً في كل الجزر
+    schedule_with_ids = json.loads(json.dumps(fixed_subject_schedule, ensure_ascii=False))
+    for exam in (exam for slots in schedule_with_ids.values() for exams in slots.values() for exam in exams):
+        exam['uuid'] = str(uuid.uuid4())
+    instance = get_problem_instance(instance, settings, all_professors, settings.get('dutyPatterns', {}), date_map)
+    engine = GeneticEngine(schedule_with_ids, settings, all_professors, assignments, all_subjects, instance, 0.0)
+    if not engine.duty_slots:
+        return fixed_subject_schedule, True
+
+    base_mutation_rate = float(settings.get('geneticMutation', 0.15))
+    mutation_rates = [min(1.0, base_mutation_rate * factor) for factor in np.linspace(0.5, 2.0, num_islands)]
+    base_seed = random.randrange(2 ** 32)
+    log_q.put(f"... {num_islands} جزر، معدلات الطفرة: {', '.join(f'{rate:.3f}' for rate in mutation_rates)}")
+
+    island_results = []
+    mp_context = multiprocessing.get_context('spawn')
+    with mp_context.Manager() as manager:
+        shared_log_q = manager.Queue()
+        shared_stop_event = manager.Event()
+        inboxes = [manager.Queue() for _ in range(num_islands)]
+        with ProcessPoolExecutor(max_workers=num_islands, mp_context=mp_context) as pool:
+            pending = {
+                pool.submit(_run_genetic_island_in_worker, idx, num_islands, base_seed + idx, schedule_with_ids, settings,
+                            all_professors, dict(assignments), all_subjects, date_map, mutation_rates[idx], inboxes, shared_log_q, shared_stop_event)
+                for idx in range(num_islands)
+            }
+            while pending:
+                done, pending = wait(pending, timeout=0.2, return_when=FIRST_COMPLETED)
+                _drain_shared_log_queue(shared_log_q, log_q)
+                if stop_event and stop_event.is_set() and not shared_stop_event.is_set():
+                    log_q.put("... [Genetic Islands] تم الإيقاف بواسطة المستخدم.")
+                    shared_stop_event.set()
+                island_results.extend(future.result() for future in done)
+        _drain_shared_log_queue(shared_log_q, log_q)
+
+    finished = [(cost, idx, chrom) for idx, chrom, cost in island_results if chrom is not None]
+    if not finished:
+        log_q.put("!!! لم تتمكن الخوارزمية الجينية من إيجاد حل.")
+        return fixed_subject_schedule, False
+    best_cost, best_island, best_chromosome = min(finished, key=lambda item: (item[0], item[1]))
+    log_q.put(f">>> [Genetic Islands] Finished. Best cost found: {format_cost_tuple(best_cost)} (جزيرة {best_island + 1})")
+    return engine.build_schedule(np.array(best_chromosome, dtype=np.int32)), True
+# =====================================================================================
+# --- END: نموذج الجزر للخوارزمية الجينية ---
+# =====================================================================================
+
+
+
 # ===================================================================
 # --- START: النسخة النهائية والمحسنة (مبدأ الأستاذ الأكثر تقييدًا) ---
 # ===================================================================
-def complete_schedule_with_guards(subject_schedule, settings, all_professors, assignments, all_levels_list, duty_patterns, date_map, all_subjects, locked_guards=set(), stop_event=None, log_q=None):
+def complete_schedule_with_guards(subject_schedule, settings, all_professors, assignments, all_levels_list, duty_patterns, date_map, all_subjects, locked_guards=set(), stop_event=None, log_q=None, instance=None):
     """
     النسخة المحسّنة V2: تستخدم "مبدأ الأستاذ الأكثر تقييدًا" (Most Constrained)
     لتقليل احتمالية حدوث نقص في الحراسة بشكل استباقي.
+    المهام المتبقية في طابور أولويات حسب عدد المرشحين، ويُحدَّث بعد كل تعيين للامتحانات المتأثرة فقط.
     """
     schedule = copy.deepcopy(subject_schedule)
     
     # --- إعدادات وقواميس مساعدة (لا تغيير هنا) ---
-    guards_large_hall = int(settings.get('guardsLargeHall', 4))
-    guards_medium_hall = int(settings.get('guardsMediumHall', 2))
-    guards_small_hall = int(settings.get('guardsSmallHall', 1))
-    
-    settings_for_validation = {
-        'dutyPatterns': duty_patterns,
-        'unavailableDays': settings.get('unavailableDays', {}),
-        'maxShifts': settings.get('maxShifts', '0'),
-        'maxLargeHallShifts': settings.get('maxLargeHallShifts', '2')
-    }
+    instance = get_problem_instance(instance, settings, all_professors, duty_patterns, date_map)
 
     # --- 1. تحديد كل الخانات الفارغة وتطبيق المهام المقفلة (لا تغيير هنا) ---
     duties_to_fill = []
@@ -2036,186 +3237,315 @@ def complete_schedule_with_guards(subject_schedule, settings, all_professors, as
             if prof not in exam['guards']:
                 exam['guards'].append(prof)
 
-        num_needed = (sum(guards_large_hall for h in exam.get('halls',[]) if h.get('type')=='كبيرة') +
-                      sum(guards_medium_hall for h in exam.get('halls',[]) if h.get('type')=='متوسطة') +
-                      sum(guards_small_hall for h in exam.get('halls',[]) if h.get('type')=='صغيرة'))
-        
-        num_to_add = num_needed - len(exam.get('guards', []))
-        for _ in range(num_to_add):
-            duties_to_fill.append(exam)
-    
-    # --- 2. الحلقة الديناميكية: في كل خطوة، جدد التفكير (لا تغيير هنا) ---
-    while duties_to_fill:
+        num_needed = instance.guards_needed(exam)
+        
+        num_to_add = num_needed - len(exam.get('guards', []))
+        for _ in range(num_to_add):
+            duties_to_fill.append(exam)
+    
+    # --- 2. الحلقة الديناميكية بطابور أولويات ---
+    # مصفوفة الأهلية (امتحان متبقٍ × أستاذ) تُبنى مرة واحدة. بعد كل تعيين لا يتغير إلا عمود الأستاذ المعيَّن
+    # (أهلية غيره لا تعتمد عليه)، فيُعاد حساب هذا العمود وحده وتُحدَّث عدادات المرشحين ودرجات المرونة
+    # للامتحانات التي تغيّر فيها. الطابور: (عدد المرشحين، ترتيب الامتحان) مع إهمال المدخلات القديمة،
+    # فيبقى نفس الاختيار: الأقل مرشحين ثم الأسبق في الجدول.
+    feasibility = FeasibilityTracker(instance, all_scheduled_exams_flat)
+    prof_ids = np.array([instance.prof_id(p) for p in all_professors], dtype=np.int64)
+    pending_exams, remaining = [], []
+    for duty_exam in duties_to_fill:
+        if pending_exams and pending_exams[-1] is duty_exam:
+            remaining[-1] += 1
+        else:
+            pending_exams.append(duty_exam)
+            remaining.append(1)
+    remaining = np.array(remaining, dtype=np.int64)
+    exam_columns = feasibility.exam_columns(pending_exams)
+    eligible = np.array([feasibility.eligible_mask(exam)[prof_ids] for exam in pending_exams], dtype=bool).reshape(len(pending_exams), len(all_professors))
+    candidate_counts = eligible.sum(axis=1)
+    # درجة المرونة = عدد الخانات الفارغة التي لا يزال الأستاذ صالحاً لها
+    flexibility = remaining @ eligible
+    heap = [(int(count), exam_idx) for exam_idx, count in enumerate(candidate_counts)]
+    heapq.heapify(heap)
+
+    while heap:
+        if stop_event and stop_event.is_set():
+            if log_q: log_q.put("... [توزيع الحراس] تم الإيقاف بواسطة المستخدم.")
+            break
+        count, exam_idx = heapq.heappop(heap)
+        if remaining[exam_idx] == 0 or count != candidate_counts[exam_idx]:
+            continue
+        hardest_duty_exam = pending_exams[exam_idx]
+        valid_candidates_for_hardest = np.flatnonzero(eligible[exam_idx])
+
+        if len(valid_candidates_for_hardest):
+            # لا نحسب خانات المهمة الحالية في المرونة. الفرز: أقل مرونة (الأكثر تقييدًا)، ثم أقل عبء، ثم الترتيب
+            flexibility_scores = (flexibility - remaining[exam_idx] * eligible[exam_idx])[valid_candidates_for_hardest]
+            workloads = feasibility.shifts[prof_ids[valid_candidates_for_hardest]]
+            best_idx = valid_candidates_for_hardest[np.lexsort((valid_candidates_for_hardest, workloads, flexibility_scores))[0]]
+            hardest_duty_exam['guards'].append(all_professors[best_idx])
+            feasibility.add_duty(hardest_duty_exam, all_professors[best_idx], 1)
+        else:
+            # إذا لم يتم العثور على أي مرشح صالح، نسجل حالة نقص
+            hardest_duty_exam['guards'].append("**نقص**")
+            feasibility.add_duty(hardest_duty_exam, "**نقص**", 1)
+
+        remaining[exam_idx] -= 1
+        flexibility -= eligible[exam_idx]
+        if len(valid_candidates_for_hardest):
+            new_column = feasibility.prof_eligible_mask(prof_ids[best_idx], exam_columns)
+            changed = np.flatnonzero(new_column != eligible[:, best_idx])
+            if len(changed):
+                delta = new_column[changed].astype(np.int64) - eligible[changed, best_idx]
+                eligible[changed, best_idx] = new_column[changed]
+                candidate_counts[changed] += delta
+                flexibility[best_idx] += int(remaining[changed] @ delta)
+                for changed_idx in changed:
+                    if remaining[changed_idx] > 0 and changed_idx != exam_idx:
+                        heapq.heappush(heap, (int(candidate_counts[changed_idx]), int(changed_idx)))
+        if remaining[exam_idx] > 0:
+            heapq.heappush(heap, (int(candidate_counts[exam_idx]), exam_idx))
+
+    return schedule
+# ===================================================================
+# --- END: النسخة النهائية والمحسنة ---
+# ===================================================================
+
+# ===================================================================
+# --- START: التوزيع بالتدفق الأدنى تكلفة (Min-Cost Flow) ---
+# ===================================================================
+def run_min_cost_flow_assignment(subject_schedule, settings, all_professors, assignments, all_levels_list, duty_patterns, date_map, all_subjects, locked_guards=set(), stop_event=None, log_q=None, instance=None):
+    """
+    بديل سريع لـ complete_schedule_with_guards بنفس التوقيع.
+    - كل خانة زمنية (يوم، فترة) مسألة نقل ثنائية: الامتحانات تطلب k حارساً، وكل أستاذ يأخذ مهمة واحدة على الأكثر.
+      تُحل الخانات بالترتيب الزمني، كل واحدة حلاً أمثل بـ SimpleMinCostFlow.
+    - أقواس (امتحان ← أستاذ) لا تُنشأ إلا للأساتذة الصالحين (التزامن، الغياب، السقوف، نمط الأيام)،
+      وتكلفتها العبء الموزون بعد التعيين، مع تكلفة لفتح يوم حراسة جديد ومكافأة لإكمال أيام نمط بدأه الأستاذ.
+    - قوس نقص بتكلفة عالية جداً لكل امتحان، فتُملأ الخانة دائماً بأقل نقص ممكن.
+    - بعدها جولات إصلاح محدودة: الأساتذة المخالفون لنمطهم أو لشراكتهم تُنقل حصصهم لغيرهم إن قلّ ذلك المخالفات.
+    """
+    schedule = copy.deepcopy(subject_schedule)
+    instance = get_problem_instance(instance, settings, all_professors, duty_patterns, date_map)
+
+    # --- 1. المهام المقفلة (كما في complete_schedule_with_guards) ---
+    all_scheduled_exams_flat = [exam for day in schedule.values() for slot in day.values() for exam in slot]
+    for exam in all_scheduled_exams_flat:
+        if 'uuid' not in exam: exam['uuid'] = str(uuid.uuid4())
+        if 'guards' not in exam: exam['guards'] = []
+        for e_uuid, prof in locked_guards:
+            if e_uuid == exam['uuid'] and prof not in exam['guards']:
+                exam['guards'].append(prof)
+
+    feasibility = FeasibilityTracker(instance, all_scheduled_exams_flat)
+    prof_ids = np.array([instance.prof_id(p) for p in all_professors], dtype=np.int64)
+    num_professors = len(all_professors)
+    # أقل عدد أيام يقبله النمط (is_schedule_valid)، مفهرس برمز النمط
+    pattern_min_days = np.array([0, 1, 2, 2, 2])[np.array([instance.pattern_codes[p] for p in prof_ids], dtype=np.int64)] if num_professors else np.zeros(0, dtype=np.int64)
+    owner_dates = defaultdict(set)
+    for exam in all_scheduled_exams_flat:
+        owner_dates[exam.get('professor')].add(exam['date'])
+    COST_SCALE, NEW_DAY_COST, PATTERN_BONUS, SHORTAGE_COST = 100, 1000, 5000, 10 ** 9
+
+    # --- 2. الخانات بالترتيب الزمني، كل خانة مسألة تدفق مستقلة ---
+    slot_keys = sorted(((date, time_slot) for date, day in schedule.items() for time_slot in day),
+                       key=lambda key: (date_map.get(key[0], float('inf')), key[0], key[1]))
+    for date, time_slot in slot_keys:
         if stop_event and stop_event.is_set():
-            if log_q: log_q.put("... [توزيع الحراس] تم الإيقاف بواسطة المستخدم.")
+            if log_q: log_q.put("... [التدفق] تم الإيقاف بواسطة المستخدم.")
             break
-            
-        # --- 2أ. إعادة بناء الحالة الحالية للحراس (لا تغيير هنا) ---
-        prof_assignments = defaultdict(list)
-        prof_large_counts = defaultdict(int)
+        slot_exams = [exam for exam in schedule[date][time_slot] if instance.guards_needed(exam) > len(exam['guards'])]
+        if not slot_exams: continue
+        needs = [instance.guards_needed(exam) - len(exam['guards']) for exam in slot_exams]
+        col = feasibility.exam_columns(slot_exams[:1])[1][0]
+        new_day = feasibility.day_counts[prof_ids, col] == 0
+        # فتح يوم جديد مكلف، إلا إن كان يُكمل الحد الأدنى لنمط بدأه الأستاذ فعلاً (وإلا بقي مخالفاً ومحجوزاً بلا فائدة)
+        num_days = feasibility.num_days[prof_ids]
+        day_cost = np.where(new_day, NEW_DAY_COST, 0)
+        day_cost[new_day & (num_days > 0) & (num_days < pattern_min_days)] = -PATTERN_BONUS
+        day_cost[[j for j, prof in enumerate(all_professors) if date in owner_dates.get(prof, ())]] = 0
+        base_workload = feasibility.workload[prof_ids]
+
+        # العُقد: 0 المصدر، 1 المصب، ثم الامتحانات، ثم الأساتذة
+        source, sink, first_exam, first_prof = 0, 1, 2, 2 + len(slot_exams)
+        tails, heads, capacities, costs = [], [], [], []
+        for exam_idx, (exam, need) in enumerate(zip(slot_exams, needs)):
+            exam_node = first_exam + exam_idx
+            tails += [source, exam_node]; heads += [exam_node, sink]; capacities += [need, need]; costs += [0, SHORTAGE_COST]
+            candidates = np.flatnonzero(feasibility.eligible_mask(exam)[prof_ids])
+            arc_costs = np.rint(COST_SCALE * (base_workload[candidates] + instance.duty_weight(exam))) + day_cost[candidates]
+            tails += [exam_node] * len(candidates); heads += (first_prof + candidates).tolist()
+            capacities += [1] * len(candidates); costs += arc_costs.astype(np.int64).tolist()
+        tails += [first_prof + j for j in range(num_professors)]; heads += [sink] * num_professors
+        capacities += [1] * num_professors; costs += [0] * num_professors
+
+        flow = min_cost_flow.SimpleMinCostFlow()
+        arcs = flow.add_arcs_with_capacity_and_unit_cost(np.array(tails, dtype=np.int32), np.array(heads, dtype=np.int32),
+                                                         np.array(capacities, dtype=np.int64), np.array(costs, dtype=np.int64))
+        supplies = np.zeros(first_prof + num_professors, dtype=np.int64)
+        supplies[source], supplies[sink] = sum(needs), -sum(needs)
+        flow.set_nodes_supplies(np.arange(len(supplies), dtype=np.int32), supplies)
+        if flow.solve() != flow.OPTIMAL:
+            if log_q: log_q.put(f"!!! [التدفق] تعذر حل الخانة {date} {time_slot}")
+            continue
+        flows = flow.flows(arcs)
+        for arc_idx in np.flatnonzero(flows):
+            tail, head = int(flow.tail(arc_idx)), int(flow.head(arc_idx))
+            if first_exam <= tail < first_prof:
+                exam = slot_exams[tail - first_exam]
+                guard = all_professors[head - first_prof] if head >= first_prof else "**نقص**"
+                for _ in range(int(flows[arc_idx])):
+                    exam['guards'].append(guard)
+                    feasibility.add_duty(exam, guard, 1)
+
+    # --- 3. جولات إصلاح محدودة: نقل كل حصص المخالفين (نمطاً أو شراكةً) لغيرهم إن قلّت المخالفات ---
+    def violation_key():
+        return (feasibility.shortage, len(feasibility.pattern_violators) + len(feasibility.broken_pairs) + len(feasibility.over_limit_profs))
+
+    def try_release(p_names):
+        released = np.array([prof in p_names for prof in all_professors], dtype=bool)
+        before = violation_key()
+        undo_moves, freed = [], []
         for exam in all_scheduled_exams_flat:
-            is_large = any(h['type'] == 'كبيرة' for h in exam.get('halls', []))
-            for guard in exam.get('guards', []):
-                if guard in all_professors:
-                    prof_assignments[guard].append(exam)
-                    if is_large: prof_large_counts[guard] += 1
-        
-        # --- 2ب. إعادة تحليل صعوبة كل المهام المتبقية الآن (لا تغيير هنا) ---
-        duties_with_candidate_count = []
-        for duty_exam in duties_to_fill:
-            if stop_event and stop_event.is_set(): break
-            candidate_count = 0
-            for prof in all_professors:
-                if prof in duty_exam.get('guards', []): continue
-                if is_assignment_valid(prof, duty_exam, prof_assignments, prof_large_counts, settings_for_validation, date_map):
-                    candidate_count += 1
-            duties_with_candidate_count.append({'exam': duty_exam, 'candidates': candidate_count})
-
-        if not duties_with_candidate_count: break
-
-        # --- 2ج. تحديد المهمة الأصعب حاليًا (لا تغيير هنا) ---
-        hardest_duty_info = min(duties_with_candidate_count, key=lambda x: x['candidates'])
-        hardest_duty_exam = hardest_duty_info['exam']
-        
-        # ###############################################################
-        # ### START: NEW IMPROVED LOGIC FOR GUARD SELECTION           ###
-        # ###############################################################
-        
-        # --- 2د. إيجاد أفضل حارس للمهمة الأصعب (المنطق الجديد والمحسّن) ---
-        valid_candidates_with_scores = []
-        
-        # أولاً، نجد قائمة المرشحين الصالحين لهذه المهمة الصعبة تحديداً
-        valid_candidates_for_hardest = []
-        for prof in all_professors:
-            if prof in hardest_duty_exam.get('guards', []): continue
-            if is_assignment_valid(prof, hardest_duty_exam, prof_assignments, prof_large_counts, settings_for_validation, date_map):
-                valid_candidates_for_hardest.append(prof)
-        
-        # ثانياً، لكل مرشح صالح، نحسب "درجة مرونته" الإجمالية
-        for prof in valid_candidates_for_hardest:
-            if stop_event and stop_event.is_set(): break
-            
-            # درجة المرونة = عدد الخانات الفارغة الأخرى التي لا يزال هذا الأستاذ صالحاً لها
-            flexibility_score = 0
-            for other_duty in duties_to_fill:
-                # لا نحسب المهمة الحالية ضمن درجة المرونة
-                if other_duty is hardest_duty_exam: continue
-                
-                # هل يمكن لهذا الأستاذ أن يأخذ هذه المهمة الأخرى؟
-                if prof not in other_duty.get('guards', []) and is_assignment_valid(prof, other_duty, prof_assignments, prof_large_counts, settings_for_validation, date_map):
-                    flexibility_score += 1
-            
-            workload = len(prof_assignments.get(prof, []))
-            # نخزن (درجة المرونة، عبء العمل الحالي، اسم الأستاذ)
-            valid_candidates_with_scores.append((flexibility_score, workload, prof))
-        
-        
-        best_prof_found = None
-        if valid_candidates_with_scores:
-            # الفرز: أولاً حسب أقل درجة مرونة (الأكثر تقييدًا)، ثم حسب أقل عبء عمل كعامل ثانوي
-            valid_candidates_with_scores.sort(key=lambda x: (x[0], x[1]))
-            best_prof_found = valid_candidates_with_scores[0][2] # [0] هو الأفضل، [2] هو اسم الأستاذ
-            hardest_duty_exam['guards'].append(best_prof_found)
-        else:
-            # إذا لم يتم العثور على أي مرشح صالح، نسجل حالة نقص
-            hardest_duty_exam['guards'].append("**نقص**")
-        
-        # ###############################################################
-        # ### END: NEW IMPROVED LOGIC                                 ###
-        # ###############################################################
-        
-        # --- 2هـ. إزالة المهمة التي تم حلها من القائمة (لا تغيير هنا) ---
-        try:
-            duties_to_fill.remove(hardest_duty_exam)
-        except ValueError:
-             # حل بديل آمن في حال كان العنصر غير موجود لسبب ما
-             for i, item in enumerate(duties_to_fill):
-                 if item is hardest_duty_exam:
-                     del duties_to_fill[i]
-                     break
+            for g_idx, guard in enumerate(exam['guards']):
+                if guard in p_names and (exam['uuid'], guard) not in locked_guards:
+                    undo_moves.append(feasibility.apply([(exam, g_idx, "**نقص**")]))
+                    freed.append((exam, g_idx))
+        for exam, g_idx in freed:
+            candidates = np.flatnonzero(feasibility.eligible_mask(exam)[prof_ids] & ~released)
+            if not len(candidates): continue
+            col = feasibility.exam_columns([exam])[1][0]
+            opens_day = feasibility.day_counts[prof_ids[candidates], col] == 0
+            best = candidates[np.lexsort((candidates, feasibility.workload[prof_ids[candidates]], opens_day))[0]]
+            undo_moves.append(feasibility.apply([(exam, g_idx, all_professors[best])]))
+        if violation_key() < before:
+            return True
+        for undo_move in reversed(undo_moves):
+            feasibility.apply(undo_move)
+        return False
 
+    repaired = 0
+    for _ in range(3):
+        if stop_event and stop_event.is_set(): break
+        violators = {instance.prof_names[p_id] for p_id in feasibility.pattern_violators}
+        groups = [{name} for name in violators]
+        groups += [{instance.prof_names[p1], instance.prof_names[p2]} for p1, p2 in (instance.partner_pairs[i] for i in feasibility.broken_pairs)]
+        if not groups: break
+        repaired_this_round = sum(try_release(group) for group in groups)
+        repaired += repaired_this_round
+        if not repaired_this_round: break
+
+    if log_q: log_q.put(f"✓ [التدفق] اكتمل التوزيع: {feasibility.shortage} خانة نقص، {repaired} إصلاح.")
     return schedule
 # ===================================================================
-# --- END: النسخة النهائية والمحسنة ---
+# --- END: التوزيع بالتدفق الأدنى تكلفة ---
 # ===================================================================
 
-def run_constraint_solver(original_schedule, settings, all_professors, assignments, all_levels_list, subject_owners, last_day_restriction, sorted_dates, duty_patterns, date_map, log_q, stop_event=None):
+def _build_guard_cp_model(all_scheduled_exams, settings, all_professors, sorted_dates, duty_patterns, date_map, instance, log_q=None, soft_shortage=True, free_exams_by_prof=None, fixed_guards=None):
     """
-    النسخة النهائية والمصححة (V10):
-    - تستخدم UUID لضمان بناء الجدول بشكل صحيح حتى مع وجود امتحانات متشابهة.
-    - تعيد None عند الفشل لتجنب معالجة النتائج الخاطئة.
-    - تضيف معرفات UUID إذا كانت غير موجودة.
+    يبني نموذج CP-SAT المختزل لتوزيع الحراس ويعيد (model, y, shortage).
+    - متغير منطقي واحد لكل (أستاذ، امتحان) بدل (أستاذ، مهمة): مهام الامتحان الواحد متطابقة، فتمثيلها
+      بمتغيرات منفصلة يضاعف حجم النموذج ويملؤه بحلول متناظرة. y[p, e] = 1 يعني أن الأستاذ p يحرس
+      الامتحان e (e موقعه في all_scheduled_exams)، ومجموع y يساوي عدد الحراس المطلوب.
+    - الأيام التي يغيب فيها الأستاذ لا يُنشأ لها متغير أصلاً.
+    - مع soft_shortage: متغير نقص لكل امتحان يكمل المجموع، فيبقى النموذج قابلاً للحل دائماً.
+    - free_exams_by_prof / fixed_guards (نموذج جزئي لـ cpsat_lns): لا تُنشأ متغيرات إلا للأزواج الحرة،
+      والحراس الثابتون لكل امتحان يدخلون القيود والهدف كثوابت.
     """
     model = cp_model.CpModel()
-    
-    # --- ✅  بداية التصحيح: ضمان وجود UUID لكل امتحان ---
-    schedule_with_ids = copy.deepcopy(original_schedule)
-    all_scheduled_exams = []
-    for date, time_slots in schedule_with_ids.items():
-        for time, exams in time_slots.items():
-            for exam in exams:
-                if 'uuid' not in exam:
-                    exam['uuid'] = str(uuid.uuid4())
-                all_scheduled_exams.append(exam)
-    # --- نهاية التصحيح ---
-
-    # --- استخلاص الإعدادات (تبقى كما هي) ---
     large_hall_weight = int(settings.get('largeHallWeight', 3))
     other_hall_weight = int(settings.get('otherHallWeight', 1))
-    max_shifts = int(settings.get('maxShifts', '0')) if settings.get('maxShifts', '0') != '0' else float('inf')
-    max_large_hall_shifts = int(settings.get('maxLargeHallShifts', '2')) if settings.get('maxLargeHallShifts', '2') != '0' else float('inf')
+    max_shifts = instance.max_shifts
+    max_large_hall_shifts = instance.max_large_hall_shifts
     enable_custom_targets = settings.get('enableCustomTargets', False)
     custom_target_patterns = settings.get('customTargetPatterns', [])
-    solver_timelimit = int(settings.get('solverTimelimit', 30))
     prof_map = {name: i for i, name in enumerate(all_professors)}
     num_professors = len(all_professors)
-    guards_large_hall = int(settings.get('guardsLargeHall', 4))
-    guards_medium_hall = int(settings.get('guardsMediumHall', 2))
-    guards_small_hall = int(settings.get('guardsSmallHall', 1))
     unavailable_days = settings.get('unavailableDays', {})
-    
-    # بناء كل المتغيرات والقيود الصارمة (بما في ذلك قيد الأزواج)
-    duties = []
-    for exam in all_scheduled_exams:
-        num_guards_needed = sum(guards_large_hall for h in exam.get('halls', []) if h.get('type') == 'كبيرة') + sum(guards_medium_hall for h in exam.get('halls', []) if h.get('type') == 'متوسطة') + sum(guards_small_hall for h in exam.get('halls', []) if h.get('type') == 'صغيرة')
-        for _ in range(num_guards_needed):
-            # ✅  تصحيح: قم بتضمين الـ UUID في كل مهمة
-            duties.append({'exam_uuid': exam['uuid'], 'exam_date': exam['date'], 'exam_time': exam['time'], 'is_large': any(h['type'] == 'كبيرة' for h in exam['halls'])})
-
-    x = {(p_idx, d_idx): model.NewBoolVar(f'x_{p_idx}_{d_idx}') for p_idx in range(num_professors) for d_idx in range(len(duties))}
-    for d_idx in range(len(duties)): model.AddExactlyOne(x[p_idx, d_idx] for p_idx in range(num_professors))
-    
-    slots = defaultdict(list)
-    for d_idx, duty in enumerate(duties): slots[(duty['exam_date'], duty['exam_time'])].append(d_idx)
+    partial = free_exams_by_prof is not None
+
+    exam_ids = [instance.exam_id(exam) for exam in all_scheduled_exams]
+    exam_day_idx = [date_map.get(exam['date']) for exam in all_scheduled_exams]
+
+    # --- الثوابت: ما يشغله الحراس الثابتون من خانات وأيام وحصص ---
+    fixed_count = [0] * len(all_scheduled_exams)
+    fixed_slots, fixed_days = defaultdict(set), defaultdict(set)
+    fixed_total, fixed_large = Counter(), Counter()
+    for e_pos, guards in enumerate(fixed_guards or []):
+        exam = all_scheduled_exams[e_pos]
+        for guard in guards:
+            if guard == "**نقص**": continue
+            fixed_count[e_pos] += 1
+            p_idx = prof_map.get(guard)
+            if p_idx is None: continue
+            fixed_slots[p_idx].add((exam['date'], exam['time']))
+            fixed_days[p_idx].add(exam_day_idx[e_pos])
+            fixed_total[p_idx] += 1
+            fixed_large[p_idx] += instance.exam_is_large[exam_ids[e_pos]]
+
+    y = {}
+    shortage = {}
+    exams_by_prof = defaultdict(list)
+    for e_pos, exam in enumerate(all_scheduled_exams):
+        e_id = exam_ids[e_pos]
+        demand = instance.exam_demand[e_id] - fixed_count[e_pos]
+        if demand <= 0: continue
+        candidates = []
+        for p_idx in range(num_professors):
+            if partial and e_pos not in free_exams_by_prof.get(p_idx, ()): continue
+            if exam['date'] in unavailable_days.get(all_professors[p_idx], []): continue
+            if (exam['date'], exam['time']) in fixed_slots.get(p_idx, ()): continue
+            y[p_idx, e_pos] = model.NewBoolVar(f'y_{p_idx}_{e_pos}')
+            candidates.append(y[p_idx, e_pos])
+            exams_by_prof[p_idx].append(e_pos)
+        if partial and not candidates: continue
+        if soft_shortage:
+            shortage[e_pos] = model.NewIntVar(0, demand, f'shortage_{e_pos}')
+            model.Add(sum(candidates) + shortage[e_pos] == demand)
+        else:
+            model.Add(sum(candidates) == demand)
+    active_profs = {p_idx for p_idx, prof_exams in exams_by_prof.items() if prof_exams}
+
     for p_idx in range(num_professors):
-        for slot_duties in slots.values(): model.Add(sum(x[p_idx, d] for d in slot_duties) <= 1)
-    
-    # (بقية قيود النموذج تبقى كما هي تماماً)
-    if max_shifts != float('inf'):
-        for p_idx in range(num_professors): model.Add(sum(x[p_idx, d_idx] for d_idx in range(len(duties))) <= max_shifts)
-    if max_large_hall_shifts != float('inf'):
-        large_duty_indices = [d_idx for d_idx, duty in enumerate(duties) if duty['is_large']]
-        for p_idx in range(num_professors): model.Add(sum(x[p_idx, d_idx] for d_idx in large_duty_indices) <= max_large_hall_shifts)
-    for prof, dates in unavailable_days.items():
-        if prof in prof_map:
-            p_idx = prof_map[prof]
-            for d_idx, duty in enumerate(duties):
-                if duty['exam_date'] in dates: model.Add(x[p_idx, d_idx] == 0)
+        prof_exams = exams_by_prof[p_idx]
+        slot_vars = defaultdict(list)
+        for e_pos in prof_exams:
+            exam = all_scheduled_exams[e_pos]
+            slot_vars[(exam['date'], exam['time'])].append(y[p_idx, e_pos])
+        for slot_list in slot_vars.values():
+            if len(slot_list) > 1: model.AddAtMostOne(slot_list)
+        if max_shifts != float('inf') and len(prof_exams) > max_shifts - fixed_total[p_idx]:
+            model.Add(sum(y[p_idx, e_pos] for e_pos in prof_exams) <= max_shifts - fixed_total[p_idx])
+        if max_large_hall_shifts != float('inf'):
+            large_vars = [y[p_idx, e_pos] for e_pos in prof_exams if instance.exam_is_large[exam_ids[e_pos]]]
+            if len(large_vars) > max_large_hall_shifts - fixed_large[p_idx]:
+                model.Add(sum(large_vars) <= max_large_hall_shifts - fixed_large[p_idx])
+
+    # --- مؤشرات أيام الحراسة: تُبنى فقط للأساتذة الذين يحتاجونها (نمط حراسة أو شراكة) ---
+    # في النموذج الجزئي: الأنماط لمن له متغيرات فقط، والشراكة إذا كان لأحد الطرفين متغيرات.
+    professor_pairs = [(prof_map[pair[0]], prof_map[pair[1]]) for pair in settings.get('professorPartnerships', []) or []
+                       if len(pair) == 2 and pair[0] in prof_map and pair[1] in prof_map]
+    if partial:
+        professor_pairs = [pair for pair in professor_pairs if pair[0] in active_profs or pair[1] in active_profs]
+    pattern_profs = {prof_map[name] for name in duty_patterns if name in prof_map and (not partial or prof_map[name] in active_profs)}
+    profs_needing_days = pattern_profs | {p_idx for pair in professor_pairs for p_idx in pair}
 
     is_duty_day, prof_has_any_duty = {}, {}
-    for p_idx in range(num_professors):
+    for p_idx in sorted(profs_needing_days):
+        vars_by_day = defaultdict(list)
+        for e_pos in exams_by_prof[p_idx]:
+            vars_by_day[exam_day_idx[e_pos]].append(y[p_idx, e_pos])
         prof_has_any_duty[p_idx] = model.NewBoolVar(f'prof_has_duty_{p_idx}')
-        duties_for_prof = [x[p_idx, d_idx] for d_idx in range(len(duties))]
-        model.Add(sum(duties_for_prof) > 0).OnlyEnforceIf(prof_has_any_duty[p_idx]); model.Add(sum(duties_for_prof) == 0).OnlyEnforceIf(prof_has_any_duty[p_idx].Not())
         for day_idx in range(len(sorted_dates)):
-            is_duty_day[p_idx, day_idx] = model.NewBoolVar(f'is_duty_day_{p_idx}_{day_idx}')
-            duties_in_this_day = [x[p_idx, d_idx] for d_idx, duty in enumerate(duties) if date_map.get(duty['exam_date']) == day_idx]
-            if duties_in_this_day:
-                model.AddBoolOr(duties_in_this_day).OnlyEnforceIf(is_duty_day[p_idx, day_idx]); model.Add(sum(duties_in_this_day) == 0).OnlyEnforceIf(is_duty_day[p_idx, day_idx].Not())
-            else: model.Add(is_duty_day[p_idx, day_idx] == False)
+            day_var = is_duty_day[p_idx, day_idx] = model.NewBoolVar(f'is_duty_day_{p_idx}_{day_idx}')
+            duties_in_this_day = vars_by_day.get(day_idx)
+            if day_idx in fixed_days.get(p_idx, ()): model.Add(day_var == 1)
+            elif duties_in_this_day:
+                for var in duties_in_this_day: model.AddImplication(var, day_var)
+                model.AddBoolOr(duties_in_this_day).OnlyEnforceIf(day_var)
+            else: model.Add(day_var == 0)
+            model.AddImplication(day_var, prof_has_any_duty[p_idx])
+        model.AddBoolOr([is_duty_day[p_idx, day_idx] for day_idx in range(len(sorted_dates))] or [False]).OnlyEnforceIf(prof_has_any_duty[p_idx])
 
     for prof_name, pattern in duty_patterns.items():
-        if prof_name in prof_map:
+        if prof_name in prof_map and prof_map[prof_name] in pattern_profs:
             p_idx = prof_map[prof_name]
             num_unique_duty_days = sum(is_duty_day[p_idx, day_idx] for day_idx in range(len(sorted_dates)))
             if pattern == 'consecutive_strict':
@@ -2229,23 +3559,19 @@ def run_constraint_solver(original_schedule, settings, all_professors, assignmen
             elif pattern == 'flexible_2_days': model.Add(num_unique_duty_days == 2).OnlyEnforceIf(prof_has_any_duty[p_idx])
             elif pattern == 'flexible_3_days':
                 model.Add(num_unique_duty_days >= 2).OnlyEnforceIf(prof_has_any_duty[p_idx]); model.Add(num_unique_duty_days <= 3).OnlyEnforceIf(prof_has_any_duty[p_idx])
-    
-    professor_pairs = settings.get('professorPartnerships', [])
-    if professor_pairs:
-        for pair in professor_pairs:
-            if len(pair) == 2 and pair[0] in prof_map and pair[1] in prof_map:
-                prof1_idx, prof2_idx = prof_map[pair[0]], prof_map[pair[1]]
-                for day_idx in range(len(sorted_dates)):
-                    model.Add(is_duty_day[prof1_idx, day_idx] == is_duty_day[prof2_idx, day_idx])
 
-    # الهدف (Objective) - يبقى كما هو
+    for prof1_idx, prof2_idx in professor_pairs:
+        for day_idx in range(len(sorted_dates)):
+            model.Add(is_duty_day[prof1_idx, day_idx] == is_duty_day[prof2_idx, day_idx])
+
+    # الهدف (Objective): الحصص الثابتة تدخل كثوابت
     prof_large_duties = [model.NewIntVar(0, 100, f'large_{p}') for p in range(num_professors)]
     prof_other_duties = [model.NewIntVar(0, 100, f'other_{p}') for p in range(num_professors)]
     for p_idx in range(num_professors):
-        model.Add(prof_large_duties[p_idx] == sum(x[p_idx, d_idx] for d_idx, duty in enumerate(duties) if duty['is_large']))
-        model.Add(prof_other_duties[p_idx] == sum(x[p_idx, d_idx] for d_idx, duty in enumerate(duties) if not duty['is_large']))
+        model.Add(prof_large_duties[p_idx] == sum(y[p_idx, e_pos] for e_pos in exams_by_prof[p_idx] if instance.exam_is_large[exam_ids[e_pos]]) + fixed_large[p_idx])
+        model.Add(prof_other_duties[p_idx] == sum(y[p_idx, e_pos] for e_pos in exams_by_prof[p_idx] if not instance.exam_is_large[exam_ids[e_pos]]) + fixed_total[p_idx] - fixed_large[p_idx])
     if enable_custom_targets and custom_target_patterns:
-        log_q.put("... استخدام نموذج تقليل الانحراف مع معاقبة الأنماط غير المستهدفة")
+        if log_q: log_q.put("... استخدام نموذج تقليل الانحراف مع معاقبة الأنماط غير المستهدفة")
         target_counts = Counter((p['large'], p['other']) for p in custom_target_patterns for _ in range(p.get('count', 0)))
         actual_counts = {}
         for l, o in target_counts.keys():
@@ -2263,71 +3589,332 @@ def run_constraint_solver(original_schedule, settings, all_professors, assignmen
         num_untracked = model.NewIntVar(0, num_professors, 'num_untracked')
         total_tracked_profs = sum(actual_counts.values()) if actual_counts else 0
         model.Add(num_untracked == num_professors - total_tracked_profs)
-        model.Minimize(total_deviation + 10 * num_untracked)
+        balance_objective = total_deviation + 10 * num_untracked
+        balance_objective_ub = num_professors * len(target_counts) + 10 * num_professors
     else:
-        log_q.put("... استخدام دالة الهدف الافتراضية (الموازنة العامة)")
+        if log_q: log_q.put("... استخدام دالة الهدف الافتراضية (الموازنة العامة)")
         prof_workload = [model.NewIntVar(0, 1000, f'workload_{p}') for p in range(num_professors)]
         for p_idx in range(num_professors):
             model.Add(prof_workload[p_idx] == prof_large_duties[p_idx] * large_hall_weight + prof_other_duties[p_idx] * other_hall_weight)
         min_w, max_w = model.NewIntVar(0, 1000, 'min_w'), model.NewIntVar(0, 1000, 'max_w')
         if prof_workload:
             model.AddMinEquality(min_w, prof_workload); model.AddMaxEquality(max_w, prof_workload)
-        model.Minimize(max_w - min_w)
+        balance_objective = max_w - min_w
+        balance_objective_ub = 1000
 
-    # --- حل النموذج (يبقى كما هو) ---
-    solver = cp_model.CpSolver()
-    solver.parameters.max_time_in_seconds = float(solver_timelimit)
-    if stop_event:
-        class StopSearchCallback(cp_model.CpSolverSolutionCallback):
-            def __init__(self, event):
-                cp_model.CpSolverSolutionCallback.__init__(self)
-                self._event = event
-            def on_solution_callback(self):
-                if self._event.is_set(): self.StopSearch()
-        status = solver.Solve(model, StopSearchCallback(stop_event))
+    if shortage:
+        # ترتيب معجمي: خانة نقص واحدة أسوأ من أي انحراف ممكن
+        total_shortage = sum(shortage.values())
+        model.Minimize((balance_objective_ub + 1) * total_shortage + balance_objective)
     else:
-        status = solver.Solve(model)
+        model.Minimize(balance_objective)
 
-    # --- ✅  بداية التصحيح: منطق جديد بالكامل لبناء النتائج ---
-    if status == cp_model.OPTIMAL or status == cp_model.FEASIBLE:
-        log_q.put("✓ تم العثور على حل باستخدام البرمجة بالقيود.")
-        
-        # 1. إنشاء خريطة بحث سريعة باستخدام الـ UUID
-        exam_map_by_uuid = {e['uuid']: e for e in all_scheduled_exams}
-        
-        # 2. مسح الحراس القدامى من كل الامتحانات في الخريطة
-        for exam in exam_map_by_uuid.values():
-            exam['guards'] = []
 
-        # 3. ملء قوائم الحراس بناءً على حل النموذج
-        for p_idx in range(num_professors):
-            for d_idx, duty in enumerate(duties):
-                if solver.Value(x[p_idx, d_idx]):
-                    exam_uuid = duty['exam_uuid']
-                    # الإضافة الآمنة للحارس باستخدام الـ UUID
-                    if exam_uuid in exam_map_by_uuid:
-                        exam_map_by_uuid[exam_uuid]['guards'].append(all_professors[p_idx])
-
-        # 4. إعادة بناء هيكل الجدول النهائي من القائمة المسطحة
-        final_schedule = defaultdict(lambda: defaultdict(list))
-        for exam in all_scheduled_exams:
-            final_schedule[exam['date']][exam['time']].append(exam)
-            
-        return final_schedule, True
+    return model, y, shortage
+
+
+def _configure_cp_solver(solver, settings, time_limit, log_q=None, min_auto_workers=1):
+    """
+    إعدادات المُحلل المشتركة: الحد الزمني، عدد العمليات، وتوجيه سجل البحث.
+    يُرجع True إذا كان عدد العمليات تلقائياً (solverWorkers = 0): عدد الأنوية، بحد أدنى min_auto_workers.
+    """
+    solver.parameters.max_time_in_seconds = float(time_limit)
+    solver_workers = int(settings.get('solverWorkers', 0) or 0)
+    solver.parameters.num_workers = solver_workers if solver_workers > 0 else max(min_auto_workers, os.cpu_count() or 1)
+    if log_q and settings.get('solverLogSearch', False):
+        # سجل البحث يُوجَّه إلى نافذة السجل بدل الطرفية
+        solver.parameters.log_search_progress = True
+        solver.parameters.log_to_stdout = False
+        solver.log_callback = lambda line: line.strip() and log_q.put(line.rstrip())
+    return solver_workers <= 0
+
+
+def run_constraint_solver(original_schedule, settings, all_professors, assignments, all_levels_list, subject_owners, last_day_restriction, sorted_dates, duty_patterns, date_map, log_q, stop_event=None, instance=None, hint_schedule=None):
+    """
+    النسخة النهائية والمصححة (V10):
+    - تستخدم UUID لضمان بناء الجدول بشكل صحيح حتى مع وجود امتحانات متشابهة.
+    - تعيد None عند الفشل لتجنب معالجة النتائج الخاطئة.
+    - تضيف معرفات UUID إذا كانت غير موجودة.
+    - النموذج مختزل التناظر: متغير واحد لكل (أستاذ، امتحان) مع قيد مجموع يساوي عدد الحراس المطلوب.
+    - hint_schedule: حل سريع (جشع أو من جولة سابقة) يُمرَّر للمُحلل كنقطة بداية (AddHint).
+    - كل حل محسَّن يُرسل إلى السجل مع قيمة الهدف والحد الأدنى وتكلفته، ويُحتفظ بأفضله
+      بحيث يعيد الإيقاف المبكر أفضل حل معروف بدل None.
+    """
+    # --- ✅  بداية التصحيح: ضمان وجود UUID لكل امتحان ---
+    schedule_with_ids = copy.deepcopy(original_schedule)
+    all_scheduled_exams = []
+    for date, time_slots in schedule_with_ids.items():
+        for exams in time_slots.values():
+            for exam in exams:
+                if 'uuid' not in exam:
+                    exam['uuid'] = str(uuid.uuid4())
+                all_scheduled_exams.append(exam)
+    # --- نهاية التصحيح ---
+
+    instance = get_problem_instance(instance, settings, all_professors, duty_patterns, date_map)
+    solver_timelimit = int(settings.get('solverTimelimit', 30))
+    soft_shortage = bool(settings.get('solverSoftShortage', True))
+    build_started = time.time()
+    model, y, shortage = _build_guard_cp_model(all_scheduled_exams, settings, all_professors, sorted_dates, duty_patterns, date_map, instance, log_q=log_q, soft_shortage=soft_shortage)
+    exam_ids = [instance.exam_id(exam) for exam in all_scheduled_exams]
+
+    # --- التلميح: تعيينات حل سريع تُعطى للمُحلل كنقطة بداية ---
+    # المطابقة بالـ UUID أولاً، ثم بمفتاح الامتحان (اليوم، الفترة، المادة، المستوى) لحلول الجولات السابقة.
+    hint_schedule_cost = None
+    if hint_schedule:
+        hint_by_uuid, hint_by_key = {}, {}
+        for day in hint_schedule.values():
+            for slot in day.values():
+                for exam in slot:
+                    guards = set(exam.get('guards', []))
+                    if 'uuid' in exam: hint_by_uuid[exam['uuid']] = guards
+                    hint_by_key[(exam['date'], exam['time'], exam['subject'], exam['level'])] = guards
+        hinted = 0
+        hinted_by_exam = Counter()
+        for (p_idx, e_pos), var in y.items():
+            exam = all_scheduled_exams[e_pos]
+            guards = hint_by_uuid.get(exam['uuid'])
+            if guards is None:
+                guards = hint_by_key.get((exam['date'], exam['time'], exam['subject'], exam['level']), set())
+            in_hint = all_professors[p_idx] in guards
+            model.AddHint(var, in_hint)
+            hinted += in_hint
+            hinted_by_exam[e_pos] += in_hint
+        for e_pos, var in shortage.items():
+            model.AddHint(var, max(0, instance.exam_demand[exam_ids[e_pos]] - hinted_by_exam[e_pos]))
+        hint_schedule_cost = calculate_cost(hint_schedule, settings, all_professors, duty_patterns, date_map, instance=instance)
+        log_q.put(f"... تلميح البداية: {hinted} تعيين، تكلفته {format_cost_tuple(hint_schedule_cost)}")
+
+    log_q.put(f"... بُني نموذج القيود ({len(y)} متغير حراسة) في {time.time() - build_started:.2f} ثانية")
+
+    def build_schedule_from(assigned):
+        """بناء الجدول من مجموعة أزواج (أستاذ، امتحان) المختارة؛ الترتيب داخل كل امتحان حسب ترتيب الأساتذة،
+        والخانات غير المغطاة تُملأ بعلامة النقص."""
+        guards_by_exam = defaultdict(list)
+        for p_idx, e_pos in sorted(assigned, key=lambda pair: (pair[1], pair[0])):
+            guards_by_exam[e_pos].append(all_professors[p_idx])
+        schedule = defaultdict(lambda: defaultdict(list))
+        for e_pos, exam in enumerate(all_scheduled_exams):
+            guards = guards_by_exam.get(e_pos, [])
+            if e_pos in shortage:
+                guards += ["**نقص**"] * (instance.exam_demand[exam_ids[e_pos]] - len(guards))
+            exam['guards'] = guards
+            schedule[exam['date']][exam['time']].append(exam)
+        return schedule
+
+    # --- حل النموذج ---
+    solver = cp_model.CpSolver()
+    auto_workers = _configure_cp_solver(solver, settings, solver_timelimit, log_q)
+
+    class SolutionStreamCallback(cp_model.CpSolverSolutionCallback):
+        """يحتفظ بأفضل حل ويرسل كل تحسين إلى السجل: الهدف، الحد الأدنى، التكلفة."""
+        def __init__(self):
+            cp_model.CpSolverSolutionCallback.__init__(self)
+            self.best_assigned = None
+            self.num_solutions = 0
+        def on_solution_callback(self):
+            self.num_solutions += 1
+            self.best_assigned = [pair for pair, var in y.items() if self.Value(var)]
+            cost = calculate_cost(build_schedule_from(self.best_assigned), settings, all_professors, duty_patterns, date_map, instance=instance)
+            objective, bound = self.ObjectiveValue(), self.BestObjectiveBound()
+            log_q.put(f"... [CP-SAT] حل #{self.num_solutions} بعد {self.WallTime():.1f} ث: الهدف = {objective:g}، الحد الأدنى = {bound:g}، التكلفة = {format_cost_tuple(cost)}")
+            report_progress(log_q, min(99, int(self.WallTime() / max(solver_timelimit, 1) * 100)), phase='CP-SAT', iteration=self.num_solutions, best_cost=cost)
+            if stop_event and stop_event.is_set(): self.StopSearch()
+
+    # مراقبة حدث الإيقاف حتى قبل العثور على أول حل
+    search_done = threading.Event()
+    def watch_stop_event():
+        while not search_done.wait(0.2):
+            if stop_event.is_set():
+                solver.StopSearch()
+                return
+    if stop_event:
+        threading.Thread(target=watch_stop_event, daemon=True).start()
+    callback = SolutionStreamCallback()
+    try:
+        status = solver.Solve(model, callback)
+        # مُحلل العملية الواحدة (أو القليلة) لا يشغّل باحثات الجدوى السريعة وقد لا يجد أي حل:
+        # في الوضع التلقائي فقط تُعاد المحاولة مرة واحدة بـ CP_SOLVER_RETRY_WORKERS عمليات وبنفس الحد الزمني
+        if (status == cp_model.UNKNOWN and callback.best_assigned is None and auto_workers
+                and solver.parameters.num_workers < CP_SOLVER_RETRY_WORKERS and not (stop_event and stop_event.is_set())):
+            log_q.put(f"... [CP-SAT] لا حل بعد {solver_timelimit} ث بـ {solver.parameters.num_workers} عمليات، إعادة المحاولة بـ {CP_SOLVER_RETRY_WORKERS} عمليات...")
+            _configure_cp_solver(solver, settings, solver_timelimit, log_q, min_auto_workers=CP_SOLVER_RETRY_WORKERS)
+            status = solver.Solve(model, callback)
+    finally:
+        search_done.set()
+
+    if status == cp_model.OPTIMAL or status == cp_model.FEASIBLE or callback.best_assigned is not None:
+        if status == cp_model.OPTIMAL:
+            log_q.put("✓ تم العثور على الحل الأمثل باستخدام البرمجة بالقيود.")
+        else:
+            log_q.put(f"✓ تم العثور على حل باستخدام البرمجة بالقيود (الهدف = {solver.ObjectiveValue():g}، الحد الأدنى = {solver.BestObjectiveBound():g}).")
+        if callback.best_assigned is not None:
+            assigned = callback.best_assigned
+        else:
+            assigned = [pair for pair, var in y.items() if solver.Value(var)]
+        return build_schedule_from(assigned), True
+    elif status == cp_model.UNKNOWN and hint_schedule:
+        # انتهى الوقت أو أُوقف البحث قبل أول حل: التلميح هو أفضل ما هو معروف
+        log_q.put(f"!!! توقف المُحلل قبل العثور على أي حل، سيتم إرجاع حل البداية {format_cost_tuple(hint_schedule_cost)}.")
+        return copy.deepcopy(hint_schedule), True
     else:
         log_q.put("✗ فشل! لم يتم العثور على أي حل صالح. هذا يؤكد وجود تضارب في القيود نفسها.")
         # إرجاع None للإشارة بوضوح إلى الفشل
         return None, False
 
+
+def run_cpsat_lns(initial_solution, settings, all_professors, duty_patterns, date_map, sorted_dates, log_q, locked_guards=set(), stop_event=None, instance=None):
+    """
+    بحث الجوار الواسع بالبرمجة بالقيود (CP-SAT LNS) للدورات الكبيرة التي لا يتسع لها النموذج الكامل.
+    - يبدأ من حل استدلالي، وفي كل خطوة يحرر جزءاً من التعيينات ويثبت الباقي: نافذة أيام متتالية،
+      أو مجموعة أساتذة، أو الأساتذة الذين يحرسون مستوى واحداً. ما دام الحل يخالف قيداً صارماً يُضاف
+      جوار "إصلاح" يحرر كل الأساتذة المخالفين معاً، لأن مكوّن القيود الصارمة في التكلفة 0/1
+      ولا يكافئ إصلاح أستاذ واحد.
+    - كل نموذج جزئي يُحل بحد زمني قصير، ويُقبل ناتجه إذا حسّن التكلفة (calculate_cost).
+    - حجم النموذج في كل خطوة محدود بحجم الجوار، لا بحجم الدورة.
+    """
+    instance = get_problem_instance(instance, settings, all_professors, duty_patterns, date_map)
+    iterations = int(settings.get('cpsatLnsIterations', 100))
+    step_timelimit = float(settings.get('cpsatLnsStepTimelimit', 5))
+    window_days = max(1, int(settings.get('cpsatLnsWindowDays', 2)))
+    group_size = max(1, int(settings.get('cpsatLnsGroupSize', 30)))
+
+    current_solution = copy.deepcopy(initial_solution)
+    exams = instance.flat_exams(current_solution)
+    exam_ids = [instance.exam_id(exam) for exam in exams]
+    exam_day_idx = [date_map.get(exam['date']) for exam in exams]
+    all_positions = frozenset(range(len(exams)))
+    prof_map = {name: i for i, name in enumerate(all_professors)}
+    num_professors = len(all_professors)
+    num_days = len(sorted_dates)
+    levels = sorted({exam['level'] for exam in exams})
+    partners = defaultdict(set)
+    for pair in settings.get('professorPartnerships', []) or []:
+        if len(pair) == 2 and pair[0] in prof_map and pair[1] in prof_map:
+            partners[prof_map[pair[0]]].add(prof_map[pair[1]])
+            partners[prof_map[pair[1]]].add(prof_map[pair[0]])
+    pattern_max_days = {'one_day_only': 1, 'flexible_2_days': 2, 'flexible_3_days': 3, 'consecutive_strict': 2}
+
+    current_cost = calculate_cost(current_solution, settings, all_professors, duty_patterns, date_map, instance=instance)
+    log_q.put(f"... [CP-SAT LNS] التكلفة الأولية: {format_cost_tuple(current_cost)}")
+
+    def fixed_part_conflicts(p_idx, free_exams, exact=False):
+        """هل تخالف حصص الأستاذ الثابتة (خارج الجوار) قيوده وحدها؟ عندها يُحرَّر بالكامل وإلا صار النموذج غير قابل للحل.
+        exact: فحص كامل الحصص بشروط is_schedule_valid (بما فيها نقص عدد الأيام عن النمط)."""
+        name = all_professors[p_idx]
+        days, slots, total, large = set(), set(), 0, 0
+        for e_pos, exam in enumerate(exams):
+            if e_pos in free_exams or name not in exam['guards']: continue
+            if (exam['date'], exam['time']) in slots or exam['date'] in instance.unavailable_days.get(name, []): return True
+            slots.add((exam['date'], exam['time'])); days.add(exam_day_idx[e_pos])
+            total += 1; large += instance.exam_is_large[exam_ids[e_pos]]
+        pattern = duty_patterns.get(name)
+        if pattern in pattern_max_days and len(days) > pattern_max_days[pattern]: return True
+        if pattern == 'consecutive_strict' and len(days) == 2 and abs(max(days) - min(days)) != 1: return True
+        if exact and days and (pattern in ('consecutive_strict', 'flexible_2_days') and len(days) != 2 or pattern == 'flexible_3_days' and len(days) < 2): return True
+        return total > instance.max_shifts or large > instance.max_large_hall_shifts
+
+    def violating_profs():
+        guard_days = defaultdict(set)
+        for e_pos, exam in enumerate(exams):
+            for g in exam['guards']:
+                if g in prof_map: guard_days[prof_map[g]].add(exam_day_idx[e_pos])
+        return {p_idx for p_idx in range(num_professors)
+                if fixed_part_conflicts(p_idx, frozenset(), exact=True) or any(guard_days[p_idx] != guard_days[q_idx] for q_idx in partners[p_idx])}
+
+    accepted, rejected, infeasible = 0, 0, 0
+    for iteration in range(iterations):
+        if stop_event and stop_event.is_set():
+            log_q.put(f"... [CP-SAT LNS] تم الإيقاف عند الخطوة {iteration}.")
+            break
+        if current_cost == (0, 0, 0, 0): break
+
+        # --- 1. اختيار الجوار ---
+        kind = random.choice(['days', 'profs', 'level', 'repair'] if current_cost[1] else ['days', 'profs', 'level'])
+        if kind == 'repair':
+            free_exams = all_positions
+            free_profs = violating_profs()
+            others = [p_idx for p_idx in range(num_professors) if p_idx not in free_profs]
+            free_profs |= set(random.sample(others, min(max(0, group_size - len(free_profs)), len(others))))
+            label = "إصلاح القيود الصارمة"
+        elif kind == 'days' or not levels:
+            start = random.randrange(max(1, num_days - window_days + 1))
+            window = set(range(start, start + window_days))
+            free_exams = frozenset(e_pos for e_pos in all_positions if exam_day_idx[e_pos] in window)
+            free_profs = set(range(num_professors))
+            label = f"الأيام {start + 1}-{min(start + window_days, num_days)}"
+        elif kind == 'profs':
+            free_exams = all_positions
+            free_profs = set(random.sample(range(num_professors), min(group_size, num_professors)))
+            label = f"{len(free_profs)} أستاذ"
+        else:
+            level = random.choice(levels)
+            touching = sorted({prof_map[g] for exam in exams if exam['level'] == level for g in exam['guards'] if g in prof_map})
+            free_profs = set(random.sample(touching, min(group_size, len(touching))))
+            free_exams = all_positions
+            label = f"المستوى {level}"
+        for p_idx in list(free_profs): free_profs |= partners[p_idx]
+        free_exams_by_prof = {p_idx: free_exams for p_idx in free_profs}
+        if free_exams is not all_positions:
+            for p_idx in free_profs:
+                if fixed_part_conflicts(p_idx, free_exams) or any(fixed_part_conflicts(q_idx, free_exams) for q_idx in partners[p_idx]):
+                    free_exams_by_prof[p_idx] = all_positions
+
+        # --- 2. الحراس الثابتون: كل حارس خارج الجوار، والتعيينات المقفلة ---
+        fixed_guards = []
+        for e_pos, exam in enumerate(exams):
+            fixed_guards.append([g for g in exam['guards'] if g != "**نقص**" and (
+                (exam['uuid'], g) in locked_guards or prof_map.get(g) not in free_exams_by_prof or e_pos not in free_exams_by_prof[prof_map[g]])])
+
+        # --- 3. النموذج الجزئي بتلميح من الحل الحالي ---
+        model, y, shortage = _build_guard_cp_model(exams, settings, all_professors, sorted_dates, duty_patterns, date_map, instance, free_exams_by_prof=free_exams_by_prof, fixed_guards=fixed_guards)
+        hinted_by_exam = Counter()
+        for (p_idx, e_pos), var in y.items():
+            in_current = all_professors[p_idx] in exams[e_pos]['guards']
+            model.AddHint(var, in_current)
+            hinted_by_exam[e_pos] += in_current
+        for e_pos, var in shortage.items():
+            model.AddHint(var, max(0, instance.exam_demand[exam_ids[e_pos]] - len(fixed_guards[e_pos]) - hinted_by_exam[e_pos]))
+        solver = cp_model.CpSolver()
+        _configure_cp_solver(solver, settings, step_timelimit)
+        status = solver.Solve(model)
+        if status not in (cp_model.OPTIMAL, cp_model.FEASIBLE):
+            infeasible += 1
+            continue
+
+        # --- 4. تطبيق الناتج على الامتحانات التي تغيرت، ثم القبول أو التراجع ---
+        chosen = defaultdict(list)
+        for (p_idx, e_pos), var in sorted(y.items(), key=lambda item: (item[0][1], item[0][0])):
+            if solver.Value(var): chosen[e_pos].append(all_professors[p_idx])
+        touched = {e_pos for e_pos in all_positions if len(fixed_guards[e_pos]) != sum(1 for g in exams[e_pos]['guards'] if g != "**نقص**")}
+        touched |= set(chosen) | set(shortage)
+        previous_guards = {e_pos: exams[e_pos]['guards'] for e_pos in touched}
+        for e_pos in touched:
+            guards = fixed_guards[e_pos] + chosen[e_pos]
+            exams[e_pos]['guards'] = guards + ["**نقص**"] * (instance.exam_demand[exam_ids[e_pos]] - len(guards))
+        new_cost = calculate_cost(current_solution, settings, all_professors, duty_patterns, date_map, instance=instance)
+        if new_cost < current_cost:
+            accepted += 1
+            current_cost = new_cost
+            log_q.put(f"... [CP-SAT LNS] خطوة {iteration + 1} ({label}، {len(y)} متغير): تحسن إلى {format_cost_tuple(current_cost)}")
+        else:
+            rejected += 1
+            for e_pos, guards in previous_guards.items(): exams[e_pos]['guards'] = guards
+        report_progress(log_q, int(((iteration + 1) / iterations) * 100), phase='CP-SAT LNS', iteration=iteration + 1, best_cost=current_cost)
+
+    log_q.put(f"✓ [CP-SAT LNS] انتهى: {accepted} تحسين، {rejected} بلا تحسن، {infeasible} جوار بلا حل. التكلفة النهائية: {format_cost_tuple(current_cost)}")
+    return current_solution, True
+
 # =====================================================================
 # START: HYPER-HEURISTIC FRAMEWORK (CORRECTED & ENHANCED FOR PROJECT 2)
 # =====================================================================
 def run_hyper_heuristic(
     log_q, initial_schedule, settings, all_professors, assignments, all_levels_list, all_subjects,
     duty_patterns, date_map, all_halls, exam_schedule_settings, level_hall_assignments,
-    locked_guards=set(), stop_event=None
+    locked_guards=set(), stop_event=None, instance=None
 ):
     log_q.put("--- بدء تشغيل النظام الخبير (Hyper-Heuristic) ---")
+    instance = get_problem_instance(instance, settings, all_professors, duty_patterns, date_map)
 
     # --- 1. استخلاص إعدادات النظام الخبير ---
     hyper_settings = settings.get('hyperHeuristicSettings', {})
@@ -2370,10 +3957,10 @@ def run_hyper_heuristic(
     # ✅ تصحيح: استخدام المتغير `initial_schedule` الذي تم تمريره
     current_solution = complete_schedule_with_guards(
         initial_schedule, settings, all_professors, assignments,
-        all_levels_list, duty_patterns, date_map, all_subjects, locked_guards
+        all_levels_list, duty_patterns, date_map, all_subjects, locked_guards, instance=instance
     )
     
-    current_cost = calculate_cost(current_solution, settings, all_professors, duty_patterns, date_map)
+    current_cost = calculate_cost(current_solution, settings, all_professors, duty_patterns, date_map, instance=instance)
     best_cost_so_far = current_cost
     best_solution_so_far = copy.deepcopy(current_solution)
     log_q.put(f"   - الحل المبدئي: التكلفة = {format_cost_tuple(current_cost)}")
@@ -2414,20 +4001,20 @@ def run_hyper_heuristic(
             for day in schedule_without_guards.values():
                 for slot in day.values():
                     for exam in slot: exam['guards'] = []
-            new_solution, _ = run_unified_lns_optimizer(schedule_without_guards, settings, all_professors, assignments, duty_patterns, date_map, all_subjects, log_q, all_levels_list, locked_guards)
+            new_solution, _ = run_unified_lns_optimizer(schedule_without_guards, settings, all_professors, assignments, duty_patterns, date_map, all_subjects, log_q, all_levels_list, locked_guards, instance=instance)
         else:
             if action_to_run == "tabu_search":
-                new_solution, _, _, _ = run_tabu_search(initial_solution_for_llh, settings, all_professors, duty_patterns, date_map, log_q, locked_guards)
+                new_solution, _, _, _ = run_tabu_search(initial_solution_for_llh, settings, all_professors, duty_patterns, date_map, log_q, locked_guards, instance=instance)
             elif action_to_run == "lns":
-                new_solution, _, _, _ = run_large_neighborhood_search(initial_solution_for_llh, settings, all_professors, duty_patterns, date_map, log_q, locked_guards)
+                new_solution, _, _, _ = run_large_neighborhood_search(initial_solution_for_llh, settings, all_professors, duty_patterns, date_map, log_q, locked_guards, instance=instance)
             elif action_to_run == "vns":
-                new_solution, _, _, _ = run_variable_neighborhood_search(initial_solution_for_llh, settings, all_professors, duty_patterns, date_map, log_q, locked_guards)
+                new_solution, _, _, _ = run_variable_neighborhood_search(initial_solution_for_llh, settings, all_professors, duty_patterns, date_map, log_q, locked_guards, instance=instance)
         
         if not new_solution:
             log_q.put(f"   - تحذير: خوارزمية '{action_to_run}' لم ترجع حلاً.")
             continue
             
-        new_cost = calculate_cost(new_solution, settings, all_professors, duty_patterns, date_map)
+        new_cost = calculate_cost(new_solution, settings, all_professors, duty_patterns, date_map, instance=instance)
         reward = calculate_reward_from_cost(current_cost, new_cost)
         
         new_failures_list = []
@@ -2541,9 +4128,341 @@ def _run_initial_subject_placement(settings, all_subjects, all_levels_list, subj
     return base_subject_schedule
 
 # ================== الواجهة الرئيسية لتشغيل الخوارزمية ==================
+# ===================================================================
+# --- START: محاولة البحث الواحدة وتوزيع المحاولات على عمليات متوازية ---
+# ===================================================================
+def _run_single_search_attempt(context, log_q, stop_event, instance=None):
+    """
+    تنفذ محاولة واحدة من البحث المكثف: توزيع المواد ثم جولات التحسين التكراري للحراسة.
+    تُرجع أفضل جدول وجدته المحاولة أو None. لا تعتمد على أي حالة عامة، لذا يمكن تشغيلها داخل عملية مستقلة.
+    """
+    settings = context['settings']
+    all_professors = context['all_professors']
+    all_levels_list = context['all_levels_list']
+    all_subjects = context['all_subjects']
+    all_halls = context['all_halls']
+    assignments = context['assignments']
+    subject_owners = context['subject_owners']
+    pinned_schedule_value = context['pinned_schedule_value']
+    date_map = context['date_map']
+    sorted_dates = sorted(date_map, key=date_map.get)
+
+    exam_schedule_settings = copy.deepcopy(settings.get('examSchedule', {}))
+    balancing_strategy = settings.get('balancingStrategy', 'advanced')
+    swap_attempts = int(settings.get('swapAttempts', 50))
+    level_hall_assignments = settings.get('levelHallAssignments', {})
+    duty_patterns = settings.get('dutyPatterns', {})
+    assign_owner_as_guard = settings.get('assignOwnerAsGuard', False)
+    last_day_restriction = settings.get('lastDayRestriction', 'none')
+    unavailable_days = settings.get('unavailableDays', {})
+    instance = get_problem_instance(instance, settings, all_professors, duty_patterns, date_map)
+
+    best_schedule_from_refinement = None
+    best_cost_from_refinement = (float('inf'), float('inf'), float('inf'), float('inf'))
+    
+    # --- ✨ الخطوة 1: تحديد جدول المواد المبدئي ---
+    optimized_subject_schedule = None
+    if pinned_schedule_value:
+        log_q.put("--- تم العثور على جدول مواد مثبت، سيتم استخدامه كنقطة بداية. ---")
+        optimized_subject_schedule = json.loads(pinned_schedule_value)
+        # مسح الجدول المثبت بعد استخدامه لضمان عدم استخدامه في المحاولة التالية للبحث المكثف
+        # conn_temp = get_db_connection()
+        # conn_temp.execute("DELETE FROM settings WHERE key = 'pinned_subject_schedule'")
+        # conn_temp.commit()
+        # conn_temp.close()
+    else:
+        log_q.put(">>> بدء المرحلة الأولى (توزيع المواد الأولي التلقائي)...")
+        # نستدعي الدالة المستقلة التي أنشأناها
+        optimized_subject_schedule = _run_initial_subject_placement(settings, all_subjects, all_levels_list, subject_owners, all_halls)
+        log_q.put("✓ انتهى توزيع المواد الأولي.")
+
+    # --- ✨ الخطوة 2: بدء حلقة تحسين الحراسة (refinement pass) ---
+    # (هذا الجزء كان مفقوداً جزئياً في الكود الذي أرسلته وهو مهم جداً)
+    ideal_guard_days = defaultdict(set)
+    group_mappings = {}
+    for date in sorted_dates:
+         for s in exam_schedule_settings.get(date, []):
+             if s.get('type') == 'primary':
+                 for level in s.get('levels', []): 
+                     group_mappings[level] = s.get('time')
+    refinement_passes = int(settings.get('refinementPasses', 3))
+
+    for refinement_pass in range(refinement_passes):
+        if stop_event.is_set():
+            log_q.put(f"... [Refinement Pass {refinement_pass + 1}] تم الإيقاف قبل بدء الجولة.")
+            break
+        log_q.put(f"--- بدء جولة التحسين التكراري رقم {refinement_pass + 1}/{refinement_passes} ---")
+        
+        # الخطوة 2: تحسين جدول المواد (يعمل على نسخته الخاصة)
+        if settings.get('groupSubjects', False):
+            optimized_subject_schedule = run_subject_optimization_phase(
+                optimized_subject_schedule, assignments, all_levels_list, subject_owners, settings, log_q, group_mappings, ideal_guard_days, stop_event=stop_event
+            )
+        
+        # الخطوة 3: تشغيل خوارزمية الحراسة على نسخة نظيفة من جدول المواد المحسن
+
+        # الخطوة 01: تشغيل خوارزمية الحراسة على نسخة نظيفة من جدول المواد المحسن
+        schedule_for_this_pass = copy.deepcopy(optimized_subject_schedule)
+        
+        # الخطوة 02: تجهيز الجدول وإعطاء معرفات فريدة للامتحانات (مهم للقفل)
+        all_exams_in_pass = [exam for day in schedule_for_this_pass.values() for slot in day.values() for exam in slot]
+        for exam in all_exams_in_pass:
+            if 'uuid' not in exam: exam['uuid'] = str(uuid.uuid4())
+
+        # الخطوة 03: حساب التعيينات المقفلة بشكل مركزي قبل أي استراتيجية
+        locked_guards = set()
+        if assign_owner_as_guard:
+            log_q.put("... تطبيق قيد تعيين أستاذ المادة (قفل)...")
+            prof_last_exam = {}
+            for exam in all_exams_in_pass:
+                owner = subject_owners.get((clean_string_for_matching(exam['subject']), clean_string_for_matching(exam['level'])))
+                if owner:
+                    exam_date_time_str = f"{exam['date']} {exam['time'].split('-')[0]}"
+                    if owner not in prof_last_exam or exam_date_time_str > prof_last_exam[owner]['datetime_str']:
+                        prof_last_exam[owner] = {'exam': exam, 'datetime_str': exam_date_time_str}
+            
+            for owner, data in prof_last_exam.items():
+                exam_to_lock = data['exam']
+                if exam_to_lock['date'] not in unavailable_days.get(owner, []):
+                    locked_guards.add((exam_to_lock['uuid'], owner))
+                    log_q.put(f"    - قفل: الأستاذ '{owner}' في امتحان '{exam_to_lock['subject']}'")
+
+        # الخطوة 04: الآن قم بتشغيل الاستراتيجية المختارة مع تمرير القيد
+        temp_schedule = None
+        strategy_success = False
+        # الحل المبدئي لاستراتيجيات البحث المحلي: التوزيع الجشع أو التدفق الأدنى تكلفة
+        initial_guard_filler = run_min_cost_flow_assignment if settings.get('flowInitialSolution', False) else complete_schedule_with_guards
+
+        if balancing_strategy == 'hyper_heuristic':
+            log_q.put(">>> [جولة تحسين] تشغيل النظام الخبير (Hyper-Heuristic)...")
+            # ✅ تصحيح: النظام الخبير يحتاج جدول المواد (قبل توزيع الحراس)
+            # `schedule_for_this_pass` هو المتغير الصحيح هنا
+            temp_schedule, strategy_success = run_hyper_heuristic(
+                log_q, schedule_for_this_pass, settings, all_professors, assignments, 
+                all_levels_list, all_subjects, duty_patterns, date_map, all_halls, 
+                exam_schedule_settings, level_hall_assignments, locked_guards=locked_guards, stop_event=stop_event, instance=instance
+            )
+        
+
+        elif balancing_strategy == 'unified_lns':
+            log_q.put(">>> [جولة تحسين] تشغيل مُحسِّن LNS التشخيصي ...")
+            temp_schedule, strategy_success = run_unified_lns_optimizer(
+                schedule_for_this_pass, settings, all_professors, assignments,
+                duty_patterns, date_map, all_subjects, log_q, all_levels_list,
+                locked_guards=locked_guards, stop_event=stop_event, instance=instance
+            )
+        
+        elif balancing_strategy == 'genetic':
+            log_q.put(">>> [جولة تحسين] تشغيل خوارزمية الجينات...")
+            temp_schedule, strategy_success = run_genetic_algorithm(schedule_for_this_pass, settings, all_professors, assignments, all_levels_list, all_halls, exam_schedule_settings, all_subjects, level_hall_assignments, date_map, log_q, stop_event=stop_event, instance=instance)
+
+        elif balancing_strategy == 'genetic_islands':
+            log_q.put(">>> [جولة تحسين] تشغيل خوارزمية الجينات (نموذج الجزر)...")
+            temp_schedule, strategy_success = run_genetic_islands(schedule_for_this_pass, settings, all_professors, assignments, all_levels_list, all_halls, exam_schedule_settings, all_subjects, level_hall_assignments, date_map, log_q, stop_event=stop_event, instance=instance)
+        
+        elif balancing_strategy == 'constraint_solver':
+            log_q.put(">>> [جولة تحسين] تشغيل البرمجة بالقيود...")
+            # نقطة البداية: الحل الجشع لهذه الجولة، أو أفضل حل من الجولات السابقة إن كان أقل تكلفة
+            hint_schedule = complete_schedule_with_guards(schedule_for_this_pass, settings, all_professors, assignments, all_levels_list, duty_patterns, date_map, all_subjects, locked_guards=locked_guards, stop_event=stop_event, instance=instance)
+            if best_schedule_from_refinement and best_cost_from_refinement < calculate_cost(hint_schedule, settings, all_professors, duty_patterns, date_map, instance=instance):
+                hint_schedule = best_schedule_from_refinement
+            temp_schedule, strategy_success = run_constraint_solver(schedule_for_this_pass, settings, all_professors, assignments, all_levels_list, subject_owners, last_day_restriction, sorted_dates, duty_patterns, date_map, log_q, stop_event=stop_event, instance=instance, hint_schedule=hint_schedule)
+
+        elif balancing_strategy == 'cpsat_lns':
+            log_q.put(">>> [جولة تحسين] تشغيل بحث الجوار الواسع بالبرمجة بالقيود (CP-SAT LNS)...")
+            initial_solution = initial_guard_filler(schedule_for_this_pass, settings, all_professors, assignments, all_levels_list, duty_patterns, date_map, all_subjects, locked_guards=locked_guards, stop_event=stop_event, log_q=log_q, instance=instance)
+            temp_schedule, strategy_success = run_cpsat_lns(initial_solution, settings, all_professors, duty_patterns, date_map, sorted_dates, log_q, locked_guards, stop_event=stop_event, instance=instance)
+
+        elif balancing_strategy in ['lns', 'vns', 'tabu_search']:
+            log_q.put(f">>> [جولة تحسين] بدء استراتيجية ({balancing_strategy.upper()})...")
+            
+            initial_solution = initial_guard_filler(schedule_for_this_pass, settings, all_professors, assignments, all_levels_list, duty_patterns, date_map, all_subjects, locked_guards=locked_guards, stop_event=stop_event, log_q=log_q, instance=instance)
+            
+            if balancing_strategy == 'lns':
+                temp_schedule, _, _, _ = run_large_neighborhood_search(initial_solution, settings, all_professors, duty_patterns, date_map, log_q, locked_guards, stop_event=stop_event, instance=instance)
+            elif balancing_strategy == 'vns':
+                temp_schedule, _, _, _ = run_variable_neighborhood_search(initial_solution, settings, all_professors, duty_patterns, date_map, log_q, locked_guards, stop_event=stop_event, instance=instance)
+            elif balancing_strategy == 'tabu_search':
+                temp_schedule, _, _, _ = run_tabu_search(initial_solution, settings, all_professors, duty_patterns, date_map, log_q, locked_guards, stop_event=stop_event, instance=instance)
+            
+            strategy_success = True
+        
+        else: # Fallback for simple strategies (advanced, phased, etc.)
+            log_q.put(f">>> [جولة تحسين] تشغيل استراتيجية: {balancing_strategy}...")
+            
+            guard_filler = run_min_cost_flow_assignment if balancing_strategy == 'flow' else complete_schedule_with_guards
+            temp_schedule = guard_filler(
+                schedule_for_this_pass, settings, all_professors, assignments, 
+                all_levels_list, duty_patterns, date_map, all_subjects, locked_guards=locked_guards, stop_event=stop_event, log_q=log_q, instance=instance
+            )
+            
+            if balancing_strategy == 'advanced':
+                log_q.put("... تطبيق مرحلة الصقل والتحسين (استراتيجية متقدمة)...")
+                
+                # --- بداية التعديل V4: استراتيجية المرحلتين (انحراف ثم قيود مرنة) ---
+                if settings.get('enableCustomTargets', False) and settings.get('customTargetPatterns', []):
+                    # المرحلة 1: موازنة الانحراف
+                    balanced_schedule = run_simulated_annealing_balancer(
+                        temp_schedule, settings, all_professors, duty_patterns, date_map,
+                        locked_guards=locked_guards, stop_event=stop_event, log_q=log_q, instance=instance
+                    )
+                    # المرحلة 2: صقل القيود المرنة
+                    temp_schedule = run_advanced_polisher(
+                        balanced_schedule, settings, all_professors, duty_patterns, date_map,
+                        locked_guards=locked_guards, stop_event=stop_event, log_q=log_q, instance=instance
+                    )
+                else:
+                    # إذا لم تكن مفعلة، استخدم الخوارزمية القديمة التي توازن العبء العام
+                    log_q.put("... (أهداف مخصصة غير مفعلة، سيتم استخدام موازنة العبء العام)...")
+                    temp_schedule, _, _, _ = run_post_processing_swaps(
+                        temp_schedule, defaultdict(list), defaultdict(float), defaultdict(int), 
+                        settings, all_professors, date_map, swap_attempts, locked_guards=locked_guards, stop_event=stop_event, log_q=log_q, instance=instance
+                    )
+
+
+            strategy_success = True
+        # =========================================================
+
+        # الخطوة 4: التقييم والتغذية الراجعة
+        if temp_schedule:
+            # أولاً، احسب تكلفة الحل الذي تم العثور عليه في هذه الجولة الحالية
+            final_cost_tuple = calculate_cost(temp_schedule, settings, all_professors, duty_patterns, date_map, instance=instance)
+            log_q.put(f"--- نهاية الجولة {refinement_pass + 1}: التكلفة = {format_cost_tuple(final_cost_tuple)}")
+
+            # الآن، قارن التكلفة الجديدة بأفضل تكلفة تم العثور عليها حتى الآن
+            if final_cost_tuple < best_cost_from_refinement:
+                best_cost_from_refinement = final_cost_tuple
+                # قم بتحديث أفضل جدول تم العثور عليه
+                best_schedule_from_refinement = copy.deepcopy(temp_schedule)
+                log_q.put("^^^ تم العثور على أفضل حل شامل حتى الآن في هذه الجولة.")
+
+            # تجهيز التغذية الراجعة للجولة القادمة (هذا الجزء مهم ويجب أن يبقى)
+            ideal_guard_days.clear()
+            all_exams_in_pass = [exam for day in temp_schedule.values() for slot in day.values() for exam in slot]
+            for exam in all_exams_in_pass:
+                for guard in exam.get('guards',[]):
+                    if guard != "**نقص**":
+                        ideal_guard_days[guard].add(exam['date'])
+        else:
+            log_q.put(f"!!! فشلت خوارزمية الحراسة في إرجاع جدول في الجولة {refinement_pass + 1}")
+
+    # في نهاية الجولة، الحل الذي سيتم تمريره للمرحلة التالية هو أفضل حل تم العثور عليه
+    return best_schedule_from_refinement
+    # =====================================================================================
+    # --- END: حلقة التحسين التكراري ---
+    # =====================================================================================
+
+
+class _PrefixedLogQueue:
+    """يمرر رسائل عملية مستقلة (محاولة بحث، جزيرة جينية...) إلى الطابور المشترك مسبوقة بمعرّفها."""
+    def __init__(self, shared_q, prefix, forward_progress=False):
+        self.shared_q = shared_q
+        self.prefix = prefix
+        # نسبة التقدم الإجمالية تحسبها العملية الرئيسية، إلا إذا كُلِّفت هذه العملية بتمريرها
+        self.progress = ProgressReporter(shared_q.put) if forward_progress else None
+
+    def put(self, message):
+        if isinstance(message, str) and message.startswith("PROGRESS:"):
+            if self.progress is not None:
+                self.progress.update_from_message(message)
+            return
+        if self.progress is not None:
+            self.progress.flush()
+        self.shared_q.put(f"{self.prefix} {message}")
+
+
+def _run_search_attempt_in_worker(attempt_index, seed, context, shared_log_q, shared_stop_event):
+    """نقطة دخول العملية المستقلة: بذرة عشوائية خاصة بالمحاولة ثم تشغيل المحاولة وإرجاع أفضل جدول وتكلفته."""
+    random.seed(seed)
+    np.random.seed(seed % (2 ** 32))
+    settings = context['settings']
+    duty_patterns = settings.get('dutyPatterns', {})
+    instance = ProblemInstance(settings, context['all_professors'], duty_patterns, context['date_map'])
+    log_q = _PrefixedLogQueue(shared_log_q, f"[محاولة {attempt_index + 1}]")
+    schedule = _run_single_search_attempt(context, log_q, shared_stop_event, instance=instance)
+    if not schedule:
+        return attempt_index, None, None
+    cost = calculate_cost(schedule, settings, context['all_professors'], duty_patterns, context['date_map'], instance=instance)
+    log_q.put(f"✓ انتهت المحاولة بتكلفة: {format_cost_tuple(cost)}")
+    # تحويل إلى قواميس عادية (بعض الاستراتيجيات تُرجع defaultdict بدوال lambda لا يمكن نقلها بين العمليات)
+    return attempt_index, json.loads(json.dumps(schedule, ensure_ascii=False)), cost
+
+
+_ATTEMPT_WORKERS_LOCK = threading.Lock()
+_RUNNING_ATTEMPT_WORKERS = 0
+
+def _track_attempt_workers(delta):
+    global _RUNNING_ATTEMPT_WORKERS
+    with _ATTEMPT_WORKERS_LOCK:
+        _RUNNING_ATTEMPT_WORKERS += delta
+
+def running_attempt_workers():
+    """عدد عمليات محاولات البحث الجارية حالياً في كل المهام (لتقليص المجمعات الأخرى بحسب الأنوية الحرة)."""
+    with _ATTEMPT_WORKERS_LOCK:
+        return _RUNNING_ATTEMPT_WORKERS
+
+
+def _drain_shared_log_queue(shared_log_q, log_q):
+    while True:
+        try:
+            log_q.put(shared_log_q.get_nowait())
+        except queue.Empty:
+            return
+
+
+def _run_search_attempts_in_process_pool(context, num_iterations, num_workers, log_q, stop_event):
+    """
+    توزع محاولات البحث المكثف على ProcessPoolExecutor وتُرجع (رقم المحاولة، الجدول) لكل محاولة فور انتهائها.
+    رسائل كل العمليات تُدمج في طابور السجل، وإشارة التوقف تُنقل إليها عبر حدث مشترك.
+    المحاولة التي ترفع استثناءً تُسجَّل كفاشلة وتُرجع بجدول None.
+    """
+    base_seed = random.randrange(2 ** 32)
+    mp_context = multiprocessing.get_context('spawn')
+    _track_attempt_workers(num_workers)
+    try:
+        with mp_context.Manager() as manager:
+            shared_log_q = manager.Queue()
+            shared_stop_event = manager.Event()
+            with ProcessPoolExecutor(max_workers=num_workers, mp_context=mp_context) as pool:
+                attempt_of = {
+                    pool.submit(_run_search_attempt_in_worker, i, base_seed + i, context, shared_log_q, shared_stop_event): i
+                    for i in range(num_iterations)
+                }
+                pending = set(attempt_of)
+                completed = 0
+                while pending:
+                    done, pending = wait(pending, timeout=0.2, return_when=FIRST_COMPLETED)
+                    _drain_shared_log_queue(shared_log_q, log_q)
+
+                    if stop_event.is_set() and not shared_stop_event.is_set():
+                        log_q.put("... تم اكتشاف إشارة توقف. إيقاف المحاولات الجارية وإلغاء المتبقية.")
+                        shared_stop_event.set()
+                        for future in pending:
+                            future.cancel()
+
+                    for future in done:
+                        if future.cancelled():
+                            continue
+                        try:
+                            attempt_index, schedule, _ = future.result()
+                        except Exception as e:
+                            # محاولة فاشلة (استثناء أو عملية انهارت) تُعامل كمحاولة بلا جدول ولا توقف بقية المحاولات
+                            attempt_index, schedule = attempt_of[future], None
+                            log_q.put(f"[محاولة {attempt_index + 1}] فشلت: {type(e).__name__}: {e}")
+                        completed += 1
+                        report_progress(log_q, int(completed / num_iterations * 100), phase='Attempts', iteration=completed)
+                        yield attempt_index, schedule
+            _drain_shared_log_queue(shared_log_q, log_q)
+    finally:
+        _track_attempt_workers(-num_workers)
+# ===================================================================
+# --- END: محاولة البحث الواحدة وتوزيع المحاولات على عمليات متوازية ---
+# ===================================================================
+
+
 def _run_schedule_logic_in_background(settings, log_q, stop_event):
+    instance = None
     try:
-        stop_event.clear()
         # --- تحميل البيانات الأساسية (نفس السابق) ---
         conn = get_db_connection()
         all_levels_list = [row['name'] for row in conn.execute("SELECT name FROM levels").fetchall()]
@@ -2567,21 +4486,17 @@ def _run_schedule_logic_in_background(settings, log_q, stop_event):
         if not intensive_search:
             num_iterations = 1
         
-        best_result = {'schedule': None, 'failures': [], 'scheduling_report': [], 'unfilled_slots': float('inf'), 'unscheduled_subjects': [], 'detailed_error': None, 'prof_report': [], 'chart_data': {}, 'balance_report': {}, 'stats_dashboard': {}, 'best_cost_tuple': (float('inf'), float('inf'), float('inf'), float('inf'))}
+        best_result = {'schedule': None, 'failures': [], 'scheduling_report': [], 'unfilled_slots': float('inf'), 'unscheduled_subjects': [], 'detailed_error': None, 'prof_report': [], 'chart_data': {}, 'balance_report': {}, 'stats_dashboard': {}, 'best_cost_tuple': (float('inf'), float('inf'), float('inf'), float('inf')), 'attempt_index': float('inf')}
         
         exam_schedule_settings = copy.deepcopy(settings.get('examSchedule', {}))
         
         balancing_strategy = settings.get('balancingStrategy', 'advanced')
-        swap_attempts = int(settings.get('swapAttempts', 50))
         solver_timelimit = int(settings.get('solverTimelimit', 30))
         
-        level_hall_assignments = settings.get('levelHallAssignments', {})
         duty_patterns = settings.get('dutyPatterns', {})
-        assign_owner_as_guard = settings.get('assignOwnerAsGuard', False)
         max_shifts_str = settings.get('maxShifts', '0')
         max_shifts = int(max_shifts_str) if max_shifts_str != '0' else float('inf')
         last_day_restriction = settings.get('lastDayRestriction', 'none')
-        unavailable_days = settings.get('unavailableDays', {})
         max_large_hall_shifts_str = settings.get('maxLargeHallShifts', '2')
         max_large_hall_shifts = int(max_large_hall_shifts_str) if max_large_hall_shifts_str != '0' else float('inf')
         enable_custom_targets = settings.get('enableCustomTargets', False)
@@ -2599,6 +4514,8 @@ def _run_schedule_logic_in_background(settings, log_q, stop_event):
             return
 
         date_map = {date: i for i, date in enumerate(sorted_dates)}
+        # النسخة المُجمَّعة من المسألة: تُبنى مرة واحدة وتُمرَّر لكل الاستراتيجيات
+        instance = ProblemInstance(settings, all_professors, duty_patterns, date_map)
         
         last_exam_day = sorted_dates[-1] if sorted_dates else None
         restricted_slots_on_last_day = []
@@ -2617,191 +4534,41 @@ def _run_schedule_logic_in_background(settings, log_q, stop_event):
             assignments[row['prof_name']].append(f"{row['subj_name']} ({row['level_name']})")
         subject_owners = { (clean_string_for_matching(s['name']), clean_string_for_matching(s['level'])): clean_string_for_matching(prof) for prof, uids in assignments.items() for uid in uids for s in all_subjects if f"{s['name']} ({s['level']})" == uid }
         
-        for i in range(num_iterations):
-            if stop_event.is_set():
-                log_q.put(f"... [محاولة {i+1}] تم اكتشاف إشارة توقف. إنهاء البحث المكثف.")
-                break
-            
-            log_q.put(f">>> [Iteration {i+1}/{num_iterations}] بدء محاولة جديدة...")
+        # سياق المحاولة: كل ما تحتاجه محاولة واحدة، قابل للنقل (pickle) إلى عملية مستقلة
+        attempt_context = {
+            'settings': settings,
+            'all_professors': all_professors,
+            'all_levels_list': all_levels_list,
+            'all_subjects': all_subjects,
+            'all_halls': all_halls,
+            'assignments': assignments,
+            'subject_owners': subject_owners,
+            'pinned_schedule_value': pinned_schedule_row['value'] if pinned_schedule_row else None,
+            'date_map': date_map,
+        }
 
-            best_schedule_from_refinement = None
-            best_cost_from_refinement = (float('inf'), float('inf'), float('inf'), float('inf'))
-            
-            # --- ✨ الخطوة 1: تحديد جدول المواد المبدئي ---
-            optimized_subject_schedule = None
-            if pinned_schedule_row and pinned_schedule_row['value']:
-                log_q.put("--- تم العثور على جدول مواد مثبت، سيتم استخدامه كنقطة بداية. ---")
-                optimized_subject_schedule = json.loads(pinned_schedule_row['value'])
-                # مسح الجدول المثبت بعد استخدامه لضمان عدم استخدامه في المحاولة التالية للبحث المكثف
-                # conn_temp = get_db_connection()
-                # conn_temp.execute("DELETE FROM settings WHERE key = 'pinned_subject_schedule'")
-                # conn_temp.commit()
-                # conn_temp.close()
-            else:
-                log_q.put(">>> بدء المرحلة الأولى (توزيع المواد الأولي التلقائي)...")
-                # نستدعي الدالة المستقلة التي أنشأناها
-                optimized_subject_schedule = _run_initial_subject_placement(settings, all_subjects, all_levels_list, subject_owners, all_halls)
-                log_q.put("✓ انتهى توزيع المواد الأولي.")
-
-            # --- ✨ الخطوة 2: بدء حلقة تحسين الحراسة (refinement pass) ---
-            # (هذا الجزء كان مفقوداً جزئياً في الكود الذي أرسلته وهو مهم جداً)
-            ideal_guard_days = defaultdict(set)
-            group_mappings = {}
-            for date in sorted_dates:
-                 for s in exam_schedule_settings.get(date, []):
-                     if s.get('type') == 'primary':
-                         for level in s.get('levels', []): 
-                             group_mappings[level] = s.get('time')
-            refinement_passes = int(settings.get('refinementPasses', 3))
-
-            for refinement_pass in range(refinement_passes):
+        try:
+            num_workers = int(settings.get('intensiveWorkers', 1))
+        except (ValueError, TypeError):
+            num_workers = 1
+        num_workers = max(1, min(num_workers, num_iterations, os.cpu_count() or 1))
+
+        def _sequential_attempts():
+            for i in range(num_iterations):
                 if stop_event.is_set():
-                    log_q.put(f"... [Refinement Pass {refinement_pass + 1}] تم الإيقاف قبل بدء الجولة.")
+                    log_q.put(f"... [محاولة {i+1}] تم اكتشاف إشارة توقف. إنهاء البحث المكثف.")
                     break
-                log_q.put(f"--- بدء جولة التحسين التكراري رقم {refinement_pass + 1}/{refinement_passes} ---")
-                
-                # الخطوة 2: تحسين جدول المواد (يعمل على نسخته الخاصة)
-                if settings.get('groupSubjects', False):
-                    optimized_subject_schedule = run_subject_optimization_phase(
-                        optimized_subject_schedule, assignments, all_levels_list, subject_owners, settings, log_q, group_mappings, ideal_guard_days, stop_event=stop_event
-                    )
-                
-                # الخطوة 3: تشغيل خوارزمية الحراسة على نسخة نظيفة من جدول المواد المحسن
-
-                # الخطوة 01: تشغيل خوارزمية الحراسة على نسخة نظيفة من جدول المواد المحسن
-                schedule_for_this_pass = copy.deepcopy(optimized_subject_schedule)
-                
-                # الخطوة 02: تجهيز الجدول وإعطاء معرفات فريدة للامتحانات (مهم للقفل)
-                all_exams_in_pass = [exam for day in schedule_for_this_pass.values() for slot in day.values() for exam in slot]
-                for exam in all_exams_in_pass:
-                    if 'uuid' not in exam: exam['uuid'] = str(uuid.uuid4())
-
-                # الخطوة 03: حساب التعيينات المقفلة بشكل مركزي قبل أي استراتيجية
-                locked_guards = set()
-                if assign_owner_as_guard:
-                    log_q.put("... تطبيق قيد تعيين أستاذ المادة (قفل)...")
-                    prof_last_exam = {}
-                    for exam in all_exams_in_pass:
-                        owner = subject_owners.get((clean_string_for_matching(exam['subject']), clean_string_for_matching(exam['level'])))
-                        if owner:
-                            exam_date_time_str = f"{exam['date']} {exam['time'].split('-')[0]}"
-                            if owner not in prof_last_exam or exam_date_time_str > prof_last_exam[owner]['datetime_str']:
-                                prof_last_exam[owner] = {'exam': exam, 'datetime_str': exam_date_time_str}
-                    
-                    for owner, data in prof_last_exam.items():
-                        exam_to_lock = data['exam']
-                        if exam_to_lock['date'] not in unavailable_days.get(owner, []):
-                            locked_guards.add((exam_to_lock['uuid'], owner))
-                            log_q.put(f"    - قفل: الأستاذ '{owner}' في امتحان '{exam_to_lock['subject']}'")
-
-                # الخطوة 04: الآن قم بتشغيل الاستراتيجية المختارة مع تمرير القيد
-                temp_schedule = None
-                strategy_success = False
-
-                if balancing_strategy == 'hyper_heuristic':
-                    log_q.put(">>> [جولة تحسين] تشغيل النظام الخبير (Hyper-Heuristic)...")
-                    # ✅ تصحيح: النظام الخبير يحتاج جدول المواد (قبل توزيع الحراس)
-                    # `schedule_for_this_pass` هو المتغير الصحيح هنا
-                    temp_schedule, strategy_success = run_hyper_heuristic(
-                        log_q, schedule_for_this_pass, settings, all_professors, assignments, 
-                        all_levels_list, all_subjects, duty_patterns, date_map, all_halls, 
-                        exam_schedule_settings, level_hall_assignments, locked_guards=locked_guards, stop_event=stop_event
-                    )
-                
 
-                elif balancing_strategy == 'unified_lns':
-                    log_q.put(">>> [جولة تحسين] تشغيل مُحسِّن LNS التشخيصي ...")
-                    temp_schedule, strategy_success = run_unified_lns_optimizer(
-                        schedule_for_this_pass, settings, all_professors, assignments,
-                        duty_patterns, date_map, all_subjects, log_q, all_levels_list,
-                        locked_guards=locked_guards, stop_event=stop_event
-                    )
-                
-                elif balancing_strategy == 'genetic':
-                    log_q.put(">>> [جولة تحسين] تشغيل خوارزمية الجينات...")
-                    temp_schedule, strategy_success = run_genetic_algorithm(schedule_for_this_pass, settings, all_professors, assignments, all_levels_list, all_halls, exam_schedule_settings, all_subjects, level_hall_assignments, date_map, log_q, stop_event=stop_event)
-                
-                elif balancing_strategy == 'constraint_solver':
-                    log_q.put(">>> [جولة تحسين] تشغيل البرمجة بالقيود...")
-                    temp_schedule, strategy_success = run_constraint_solver(schedule_for_this_pass, settings, all_professors, assignments, all_levels_list, subject_owners, last_day_restriction, sorted_dates, duty_patterns, date_map, log_q, stop_event=stop_event)
+                log_q.put(f">>> [Iteration {i+1}/{num_iterations}] بدء محاولة جديدة...")
+                yield i, _run_single_search_attempt(attempt_context, log_q, stop_event, instance=instance)
 
-                elif balancing_strategy in ['lns', 'vns', 'tabu_search']:
-                    log_q.put(f">>> [جولة تحسين] بدء استراتيجية ({balancing_strategy.upper()})...")
-                    
-                    initial_solution = complete_schedule_with_guards(schedule_for_this_pass, settings, all_professors, assignments, all_levels_list, duty_patterns, date_map, all_subjects, locked_guards=locked_guards, stop_event=stop_event)
-                    
-                    if balancing_strategy == 'lns':
-                        temp_schedule, _, _, _ = run_large_neighborhood_search(initial_solution, settings, all_professors, duty_patterns, date_map, log_q, locked_guards, stop_event=stop_event)
-                    elif balancing_strategy == 'vns':
-                        temp_schedule, _, _, _ = run_variable_neighborhood_search(initial_solution, settings, all_professors, duty_patterns, date_map, log_q, locked_guards, stop_event=stop_event)
-                    elif balancing_strategy == 'tabu_search':
-                        temp_schedule, _, _, _ = run_tabu_search(initial_solution, settings, all_professors, duty_patterns, date_map, log_q, locked_guards, stop_event=stop_event)
-                    
-                    strategy_success = True
-                
-                else: # Fallback for simple strategies (advanced, phased, etc.)
-                    log_q.put(f">>> [جولة تحسين] تشغيل استراتيجية: {balancing_strategy}...")
-                    
-                    temp_schedule = complete_schedule_with_guards(
-                        schedule_for_this_pass, settings, all_professors, assignments, 
-                        all_levels_list, duty_patterns, date_map, all_subjects, locked_guards=locked_guards, stop_event=stop_event
-                    )
-                    
-                    if balancing_strategy == 'advanced':
-                        log_q.put("... تطبيق مرحلة الصقل والتحسين (استراتيجية متقدمة)...")
-                        
-                        # --- بداية التعديل V4: استراتيجية المرحلتين (انحراف ثم قيود مرنة) ---
-                        if settings.get('enableCustomTargets', False) and settings.get('customTargetPatterns', []):
-                            # المرحلة 1: موازنة الانحراف
-                            balanced_schedule = run_simulated_annealing_balancer(
-                                temp_schedule, settings, all_professors, duty_patterns, date_map,
-                                locked_guards=locked_guards, stop_event=stop_event, log_q=log_q
-                            )
-                            # المرحلة 2: صقل القيود المرنة
-                            temp_schedule = run_advanced_polisher(
-                                balanced_schedule, settings, all_professors, duty_patterns, date_map,
-                                locked_guards=locked_guards, stop_event=stop_event, log_q=log_q
-                            )
-                        else:
-                            # إذا لم تكن مفعلة، استخدم الخوارزمية القديمة التي توازن العبء العام
-                            log_q.put("... (أهداف مخصصة غير مفعلة، سيتم استخدام موازنة العبء العام)...")
-                            temp_schedule, _, _, _ = run_post_processing_swaps(
-                                temp_schedule, defaultdict(list), defaultdict(float), defaultdict(int), 
-                                settings, all_professors, date_map, swap_attempts, locked_guards=locked_guards, stop_event=stop_event, log_q=log_q
-                            )
-
-
-                    strategy_success = True
-                # =========================================================
-
-                # الخطوة 4: التقييم والتغذية الراجعة
-                if temp_schedule:
-                    # أولاً، احسب تكلفة الحل الذي تم العثور عليه في هذه الجولة الحالية
-                    final_cost_tuple = calculate_cost(temp_schedule, settings, all_professors, duty_patterns, date_map)
-                    log_q.put(f"--- نهاية الجولة {refinement_pass + 1}: التكلفة = {format_cost_tuple(final_cost_tuple)}")
-
-                    # الآن، قارن التكلفة الجديدة بأفضل تكلفة تم العثور عليها حتى الآن
-                    if final_cost_tuple < best_cost_from_refinement:
-                        best_cost_from_refinement = final_cost_tuple
-                        # قم بتحديث أفضل جدول تم العثور عليه
-                        best_schedule_from_refinement = copy.deepcopy(temp_schedule)
-                        log_q.put("^^^ تم العثور على أفضل حل شامل حتى الآن في هذه الجولة.")
-
-                    # تجهيز التغذية الراجعة للجولة القادمة (هذا الجزء مهم ويجب أن يبقى)
-                    ideal_guard_days.clear()
-                    all_exams_in_pass = [exam for day in temp_schedule.values() for slot in day.values() for exam in slot]
-                    for exam in all_exams_in_pass:
-                        for guard in exam.get('guards',[]):
-                            if guard != "**نقص**":
-                                ideal_guard_days[guard].add(exam['date'])
-                else:
-                    log_q.put(f"!!! فشلت خوارزمية الحراسة في إرجاع جدول في الجولة {refinement_pass + 1}")
+        if num_workers > 1:
+            log_q.put(f">>> توزيع {num_iterations} محاولة بحث على {num_workers} عمليات متوازية...")
+            attempt_results = _run_search_attempts_in_process_pool(attempt_context, num_iterations, num_workers, log_q, stop_event)
+        else:
+            attempt_results = _sequential_attempts()
 
-            # في نهاية الجولة، الحل الذي سيتم تمريره للمرحلة التالية هو أفضل حل تم العثور عليه
-            final_schedule_from_strategy = best_schedule_from_refinement
-            # =====================================================================================
-            # --- END: حلقة التحسين التكراري ---
-            # =====================================================================================
+        for i, final_schedule_from_strategy in attempt_results:
 
             if not final_schedule_from_strategy:
                 if stop_event.is_set():
@@ -2863,15 +4630,17 @@ def _run_schedule_logic_in_background(settings, log_q, stop_event):
 
             # الشرط المحدث لمقارنة أفضل الحلول (بدون المتغير المحذوف)
             if final_schedule_from_strategy:
-                current_cost_tuple = calculate_cost(final_schedule_from_strategy, settings, all_professors, duty_patterns, date_map)
+                current_cost_tuple = calculate_cost(final_schedule_from_strategy, settings, all_professors, duty_patterns, date_map, instance=instance)
 
                 # نقارن التكلفة الحالية بأفضل تكلفة وجدناها حتى الآن في كل المحاولات
-                if best_result['schedule'] is None or current_cost_tuple < best_result['best_cost_tuple']:
+                # (عند التعادل تفوز المحاولة ذات الرقم الأصغر، فتبقى النتيجة ثابتة مهما كان ترتيب انتهاء العمليات المتوازية)
+                if best_result['schedule'] is None or (current_cost_tuple, i) < (best_result['best_cost_tuple'], best_result['attempt_index']):
                     log_q.put(f"✓ [Iteration {i+1}] Found a better overall solution! Cost: {format_cost_tuple(current_cost_tuple)}")
 
                     # تحديث أفضل نتيجة تم العثور عليها
                     best_result['schedule'] = copy.deepcopy(final_schedule_from_strategy)
                     best_result['best_cost_tuple'] = current_cost_tuple
+                    best_result['attempt_index'] = i
 
                     # --- START: إعادة حساب كل التقارير بناءً على الحل الأفضل الجديد ---
                     all_exams_in_final_schedule_flat = [exam for date_exams in best_result['schedule'].values() for time_slots_in_day in date_exams.values() for exam in time_slots_in_day]
@@ -3015,7 +4784,8 @@ def _run_schedule_logic_in_background(settings, log_q, stop_event):
             "prof_report": best_result.get('prof_report', []),
             "chart_data": best_result.get('chart_data', {}),
             "balance_report": best_result.get('balance_report', {}),
-            "stats_dashboard": best_result.get('stats_dashboard', {})
+            "stats_dashboard": best_result.get('stats_dashboard', {}),
+            "cost": [float(c) for c in best_result['best_cost_tuple']]
         }, ensure_ascii=False))
 
     except Exception as e:
@@ -3026,9 +4796,187 @@ def _run_schedule_logic_in_background(settings, log_q, stop_event):
         log_q.put("DONE" + json.dumps({"success": False, "message": f"خطأ فادح: {e}"}))
 
     finally:
-        stop_event.clear()
+        # عمليات تقييم البحث المحظور تعيش بطول المهمة فقط
+        if instance is not None and instance.tabu_scoring_pool is not None:
+            instance.tabu_scoring_pool.shutdown()
+
+
+
+
+# ===================================================================
+# --- START: مدير المهام (عدة عمليات إنشاء جداول في نفس الوقت) ---
+# ===================================================================
+class JobEventLog:
+    """
+    سجل أحداث مهمة واحدة في مخزن دائري محدود؛ لكل رسالة معرف متزايد.
+    القراءة لا تستهلك الرسائل: عدة مشاهدين يتابعون نفس المهمة، ومن أعاد الاتصال يستأنف بعد آخر معرف استلمه.
+    رسالة DONE هي الأخيرة دائماً فلا تُحذف من المخزن.
+    """
+    def __init__(self, job, max_events=JOB_EVENT_BUFFER_SIZE):
+        self.job = job
+        self.events = deque(maxlen=max_events)
+        self.next_id = 1
+        self.condition = threading.Condition()
+        self.progress = ProgressReporter(self._append)
+
+    def put(self, item):
+        if isinstance(item, str) and item.startswith("PROGRESS:"):
+            self.progress.update_from_message(item)
+            return
+        # آخر حالة تقدم معلقة تُرسل قبل أي رسالة أخرى حتى لا تضيع (خصوصاً قبل DONE)
+        self.progress.flush()
+        if isinstance(item, str) and item.startswith("DONE"):
+            item = self.job.record_done(item)
+        self._append(item)
+
+    def _append(self, item):
+        with self.condition:
+            self.events.append((self.next_id, item))
+            self.next_id += 1
+            self.condition.notify_all()
+
+    def read_after(self, last_id, timeout=None):
+        """يعيد (عدد الرسائل المفقودة، الرسائل التي معرفها أكبر من last_id)، وينتظر حتى timeout إذا لم يوجد جديد."""
+        with self.condition:
+            if self.next_id - 1 <= last_id:
+                self.condition.wait_for(lambda: self.next_id - 1 > last_id, timeout)
+            if not self.events:
+                return 0, []
+            first_id = self.events[0][0]
+            skipped = max(0, first_id - last_id - 1)
+            return skipped, [event for event in self.events if event[0] > last_id]
+
+
+class Job:
+    """عملية إنشاء جدول واحدة: معرف، إعدادات، طابور أحداث وإشارة توقف خاصة بها."""
+    def __init__(self, settings):
+        self.id = uuid.uuid4().hex
+        self.settings = settings
+        self.strategy = (settings or {}).get('balancingStrategy')
+        self.fingerprint = settings_fingerprint(settings)
+        self.log_q = JobEventLog(self)
+        self.stop_event = threading.Event()
+        self.status = 'queued' # queued | running | done | failed | cancelled
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.success = None
+        self.message = None
+        self.run_saved = False
+        self.future = None
+
+    def record_done(self, done_message):
+        """
+        يحدّث نتيجة المهمة من رسالة DONE ويحفظها في جدول runs، ويعيد رسالة DONE التي تُرسل للمتصفح:
+        runId يُضاف إليها فقط بعد نجاح الحفظ، فلا يطلب المتصفح عملية غير موجودة.
+        """
+        try:
+            payload = json.loads(done_message[4:] or '{}')
+        except ValueError:
+            payload = {}
+        self.success = bool(payload.get('success'))
+        self.message = payload.get('message')
+        if self.started_at is None:
+            return done_message # أُلغيت قبل أن تبدأ: لا نتيجة لحفظها
+        # الحفظ قبل إرسال DONE للمتصفح، حتى يجد /api/runs/<id> النتيجة فور استلامها
+        status = 'done' if self.success else ('cancelled' if self.stop_event.is_set() else 'failed')
+        try:
+            save_run(self.id, self.created_at, self.started_at, status, self.strategy, self.fingerprint, payload)
+        except sqlite3.Error as e:
+            self.log_q.put(f"⚠️ تعذر حفظ نتيجة العملية في قاعدة البيانات ({e}). التصدير سيستخدم الجدول المعروض في المتصفح.")
+            return done_message
+        self.run_saved = True
+        return "DONE" + json.dumps(dict(payload, runId=self.id), ensure_ascii=False)
+
+    def to_dict(self, queue_position=None):
+        return {
+            "jobId": self.id, "status": self.status, "queuePosition": queue_position,
+            "createdAt": self.created_at, "startedAt": self.started_at, "finishedAt": self.finished_at,
+            "success": self.success, "message": self.message, "runId": self.id if self.run_saved else None,
+        }
+
+
+class JobManager:
+    """
+    يعطي كل عملية إنشاء جدول معرفاً وطابور أحداث وإشارة توقف خاصة بها، ويشغلها على عدد محدود من الخانات.
+    - ThreadPoolExecutor يقبل المهام بالترتيب (FIFO): الزائدة عن الخانات تنتظر دورها.
+    - إلغاء مهمة منتظرة يحذفها من الطابور، وإلغاء مهمة جارية يرسل لها إشارة التوقف فقط.
+    - يُحتفظ بآخر max_finished مهمة منتهية فقط.
+    """
+    def __init__(self, max_concurrent=1, max_finished=50):
+        self.max_concurrent = max_concurrent
+        self.max_finished = max_finished
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrent)
+        self.jobs = {}
+        self.lock = threading.Lock()
+
+    def submit(self, settings):
+        job = Job(settings)
+        with self.lock:
+            self.jobs[job.id] = job
+            self._prune()
+            position = self._queue_position(job)
+        job.log_q.put("بدء عملية إنشاء الجدول في الخلفية...")
+        if position:
+            job.log_q.put(f"... المهمة في طابور الانتظار (الترتيب {position})، تعمل حالياً {self.max_concurrent} مهمة.")
+        job.future = self.executor.submit(self._run, job)
+        return job
+
+    def get(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def describe(self, job):
+        with self.lock:
+            return job.to_dict(self._queue_position(job))
+
+    def cancel(self, job_id):
+        job = self.get(job_id)
+        if job is None:
+            return None
+        job.stop_event.set()
+        if job.future is not None and job.future.cancel():
+            # لم تبدأ بعد: لن تُشغَّل أبداً، فنُنهيها هنا
+            job.log_q.put("DONE" + json.dumps({"success": False, "message": "تم إلغاء المهمة قبل بدئها."}))
+            self._finish(job, 'cancelled')
+        elif job.status == 'running':
+            job.log_q.put("--- [إشارة توقف] تم استلام طلب الإيقاف من المستخدم. جاري إنهاء العملية... ---")
+        return job
+
+    def shutdown(self):
+        for job in list(self.jobs.values()):
+            job.stop_event.set()
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def _run(self, job):
+        job.status, job.started_at = 'running', time.time()
+        try:
+            _run_schedule_logic_in_background(job.settings, job.log_q, job.stop_event)
+        finally:
+            self._finish(job, 'done' if job.success else ('cancelled' if job.stop_event.is_set() else 'failed'))
+
+    def _finish(self, job, status):
+        job.status, job.finished_at = status, time.time()
+        job.settings = None # الإعدادات قد تكون كبيرة ولم تعد لازمة
 
+    def _queue_position(self, job):
+        if job.status != 'queued':
+            return None
+        running = sum(1 for other in self.jobs.values() if other.status == 'running')
+        ahead = sum(1 for other in self.jobs.values() if other.status == 'queued' and other.created_at <= job.created_at)
+        position = ahead - max(0, self.max_concurrent - running)
+        return position if position > 0 else None
 
+    def _prune(self):
+        finished = [job for job in self.jobs.values() if job.finished_at is not None]
+        for job in sorted(finished, key=lambda j: j.finished_at)[:max(0, len(finished) - self.max_finished)]:
+            del self.jobs[job.id]
+
+
+job_manager = JobManager(max_concurrent=MAX_CONCURRENT_JOBS)
+# ===================================================================
+# --- END: مدير المهام ---
+# ===================================================================
 
 
 # يمكن إضافتها بعد دوال الخوارزمية وقبل مسارات API
@@ -3501,10 +5449,26 @@ def build_schedule_table_for_level(ws, start_row, level, all_dates, all_times, d
         ws.column_dimensions[get_column_letter(i)].width = 35
     return current_row
 
+def _schedule_from_request():
+    """
+    الجدول المطلوب تصديره: من عملية محفوظة (runId في الرابط أو في الجسم) أو الجدول المرسل في الجسم كما في السابق.
+    يعيد (الجدول، استجابة خطأ أو None)؛ العملية غير الموجودة تعطي 404 ليعيد المتصفح الإرسال بالجدول كاملاً.
+    """
+    data = request.get_json(silent=True)
+    run_id = request.args.get('runId') or (data.get('runId') if isinstance(data, dict) else None)
+    if run_id:
+        schedule_data = load_run_schedule(run_id)
+        if not schedule_data:
+            return None, (jsonify({"error": "العملية غير موجودة أو بلا جدول محفوظ."}), 404)
+        return schedule_data, None
+    if not data:
+        return None, (jsonify({"error": "No schedule data provided"}), 400)
+    return data, None
+
 @app.route('/api/export-schedule', methods=['POST'])
 def export_schedule():
-    schedule_data = request.get_json()
-    if not schedule_data: return jsonify({"error": "No schedule data provided"}), 400
+    schedule_data, error_response = _schedule_from_request()
+    if error_response: return error_response
     conn = get_db_connection()
     settings_row = conn.execute("SELECT value FROM settings WHERE key = 'main_settings'").fetchone()
     conn.close()
@@ -3537,8 +5501,8 @@ def export_schedule():
 
 @app.route('/api/export-prof-schedules', methods=['POST'])
 def export_prof_schedules():
-    schedule_data = request.get_json()
-    if not schedule_data: return jsonify({"error": "No schedule data provided"}), 400
+    schedule_data, error_response = _schedule_from_request()
+    if error_response: return error_response
     conn = get_db_connection()
     all_professors = sorted([p['name'] for p in conn.execute("SELECT name FROM professors").fetchall()])
     assignments_rows = conn.execute('SELECT p.name as prof_name, s.name as subj_name, l.name as level_name FROM assignments a JOIN professors p ON a.professor_id = p.id JOIN subjects s ON a.subject_id = s.id JOIN levels l ON s.level_id = l.id').fetchall()
@@ -3704,30 +5668,78 @@ def import_data_from_file():
     except Exception as e:
         return jsonify({"error": f"فشل تحليل الملف. تأكد من أن أسماء الأوراق والأعمدة متطابقة مع القالب. الخطأ: {e}"}), 500
 
-@app.route('/api/generate-guard-schedule', methods=['POST'])
-def generate_guard_schedule():
+@app.route('/api/jobs', methods=['POST'])
+def create_job():
     settings = request.get_json()
-    log_queue.put("بدء عملية إنشاء الجدول في الخلفية...")
-    executor.submit(_run_schedule_logic_in_background, settings, log_queue, STOP_EVENT)
-    return jsonify({"success": True, "message": "بدأت عملية إنشاء الجدول. يرجى متابعة السجل الحي."})
-
-@app.route('/stream-logs')
-def stream_logs():
-    def generate():
+    job = job_manager.submit(settings)
+    return jsonify({"success": True, "message": "بدأت عملية إنشاء الجدول. يرجى متابعة السجل الحي.", **job_manager.describe(job)}), 202
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    job = job_manager.get(job_id)
+    if job is None:
+        return jsonify({"error": "المهمة غير موجودة."}), 404
+    return jsonify(job_manager.describe(job))
+
+@app.route('/api/jobs/<job_id>', methods=['DELETE'])
+def cancel_job(job_id):
+    job = job_manager.cancel(job_id)
+    if job is None:
+        return jsonify({"error": "المهمة غير موجودة."}), 404
+    return jsonify({"success": True, "message": "تم إرسال إشارة الإيقاف بنجاح.", **job_manager.describe(job)})
+
+def _format_sse(data, event_id=None):
+    """رسالة SSE واحدة؛ الأسطر المتعددة تُرسل كحقول data متتالية يجمعها المتصفح."""
+    lines = [f"id: {event_id}"] if event_id is not None else []
+    lines += [f"data: {line}" for line in str(data).split("\n")]
+    return "\n".join(lines) + "\n\n"
+
+@app.route('/api/jobs/<job_id>/events')
+def stream_job_events(job_id):
+    job = job_manager.get(job_id)
+    if job is None:
+        return jsonify({"error": "المهمة غير موجودة."}), 404
+    try:
+        last_id = int(request.headers.get('Last-Event-ID') or request.args.get('lastEventId') or 0)
+    except ValueError:
+        last_id = 0
+    def generate(last_id):
+        yield "retry: 3000\n\n"
         while True:
-            message = log_queue.get()
-            if "DONE" in message: 
-                yield f"data: {message}\n\n"
-                break
-            yield f"data: {message}\n\n"
-    return Response(stream_with_context(generate()), mimetype='text/event-stream')
+            skipped, events = job.log_q.read_after(last_id, timeout=15)
+            if not events:
+                if job.finished_at is not None:
+                    return
+                yield ": keep-alive\n\n"
+                continue
+            if skipped:
+                yield _format_sse(f"... تم تجاوز {skipped} رسالة قديمة لم تعد محفوظة في السجل ...")
+            for event_id, message in events:
+                yield _format_sse(message, event_id)
+                last_id = event_id
+                if isinstance(message, str) and message.startswith("DONE"):
+                    return
+    return Response(stream_with_context(generate(last_id)), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/api/runs', methods=['GET'])
+def get_runs():
+    limit = request.args.get('limit', 50, type=int)
+    return jsonify(list_runs(max(1, min(limit, 500))))
+
+@app.route('/api/runs/<run_id>', methods=['GET'])
+def get_run(run_id):
+    run = load_run(run_id)
+    if run is None:
+        return jsonify({"error": "العملية غير موجودة."}), 404
+    return jsonify(run)
 
 @app.route('/shutdown', methods=['POST'])
 def shutdown():
     def do_shutdown():
         time.sleep(1)
         print("Shutdown request received. Terminating server.")
-        executor.shutdown(wait=False, cancel_futures=True) 
+        job_manager.shutdown()
         os.kill(os.getpid(), signal.SIGINT)
     threading.Thread(target=do_shutdown).start()
     return jsonify({"success": True, "message": "Shutdown signal sent."})
@@ -3739,8 +5751,8 @@ def shutdown():
 # استبدل هذه الدالة بالكامل في ملف app.py
 @app.route('/api/export/word/all-exams', methods=['POST'])
 def export_exams_word():
-    schedule_data = request.get_json()
-    if not schedule_data: return jsonify({"error": "No schedule data provided"}), 400
+    schedule_data, error_response = _schedule_from_request()
+    if error_response: return error_response
     
     conn = get_db_connection()
     assignments_rows = conn.execute('SELECT s.name as subj_name, l.name as level_name, p.name as prof_name FROM assignments a JOIN subjects s ON a.subject_id = s.id JOIN levels l ON s.level_id = l.id JOIN professors p ON a.professor_id = p.id').fetchall()
@@ -3812,8 +5824,8 @@ def export_exams_word():
 # استبدل هذه الدالة بالكامل في ملف app.py
 @app.route('/api/export/word/all-profs', methods=['POST'])
 def export_profs_word():
-    schedule_data = request.get_json()
-    if not schedule_data: return jsonify({"error": "No schedule data provided"}), 400
+    schedule_data, error_response = _schedule_from_request()
+    if error_response: return error_response
 
     conn = get_db_connection()
     all_professors = sorted([p['name'] for p in conn.execute("SELECT name FROM professors").fetchall()])
@@ -3924,8 +5936,8 @@ def export_profs_word():
 # أضف هذه الدالة الجديدة بالكامل في نهاية ملف app.py
 @app.route('/api/export/word/all-profs-anonymous', methods=['POST'])
 def export_profs_anonymous_word():
-    schedule_data = request.get_json()
-    if not schedule_data: return jsonify({"error": "No schedule data provided"}), 400
+    schedule_data, error_response = _schedule_from_request()
+    if error_response: return error_response
 
     conn = get_db_connection()
     all_professors = sorted([p['name'] for p in conn.execute("SELECT name FROM professors").fetchall()])
@@ -4179,14 +6191,9 @@ def clear_manual_distribution():
     except Exception as e:
         return jsonify({"error": f"حدث خطأ أثناء المسح: {e}"}), 500
 
-@app.route('/api/stop-algorithm', methods=['POST'])
-def stop_algorithm():
-    log_queue.put("--- [إشارة توقف] تم استلام طلب الإيقاف من المستخدم. جاري إنهاء العملية... ---")
-    STOP_EVENT.set()
-    return jsonify({"success": True, "message": "تم إرسال إشارة الإيقاف بنجاح."})
-
 # ================== الجزء الرابع: تشغيل البرنامج ==================
 if __name__ == '__main__':
+    multiprocessing.freeze_support()
     init_db()
     def open_browser():
           webbrowser.open_new("http://127.0.0.1:5000")
@@ -3,6 +3,7 @@
 // =================================================================================
 
 let eventSource = null;
+let currentJobId = null;
 let selectedProfessorForAssign = null;
 let selectedSubjectsForAssign = [];
 let availableLevels = [];
@@ -11,6 +12,7 @@ let availableProfessors = [];
 let availableSubjects = [];
 let examDayCounter = 0;
 let lastGeneratedSchedule = null;
+let lastRunId = null; // معرف العملية المحفوظة على الخادم: التصدير يرسله بدل الجدول كاملاً
 let workloadChartInstance = null;
 let customTargetPatterns = []; 
 
@@ -45,6 +47,7 @@ document.addEventListener('DOMContentLoaded', () => {
     setupBalancingStrategyListener(); 
     setupManualDistributionListeners();
     setupStopButtonListener();
+    resumeRunningJob();
 });
 
 function setupHeaderButtons() {
@@ -95,6 +98,8 @@ function setupBalancingStrategyListener() {
     const advancedSwapLabel = document.getElementById('swap-attempts-label');
     const solverTimelimitLabel = document.getElementById('solver-timelimit-label');
     const geneticParamsLabel = document.getElementById('genetic-params-label');
+    const geneticIslandsParamsLabel = document.getElementById('genetic-islands-params-label');
+    const cpsatLnsParamsLabel = document.getElementById('cpsat-lns-params-label');
     const tabuParamsLabel = document.getElementById('tabu-params-label');
     const lnsParamsLabel = document.getElementById('lns-params-label');
     const vnsParamsLabel = document.getElementById('vns-params-label');
@@ -107,6 +112,8 @@ function setupBalancingStrategyListener() {
         advancedSwapLabel.style.display = 'none';
         solverTimelimitLabel.style.display = 'none';
         geneticParamsLabel.style.display = 'none';
+        geneticIslandsParamsLabel.style.display = 'none';
+        cpsatLnsParamsLabel.style.display = 'none';
         tabuParamsLabel.style.display = 'none';
         lnsParamsLabel.style.display = 'none';
         vnsParamsLabel.style.display = 'none';
@@ -118,8 +125,13 @@ function setupBalancingStrategyListener() {
             advancedSwapLabel.style.display = 'block';
         } else if (strategy === 'constraint_solver') {
             solverTimelimitLabel.style.display = 'block';
+        } else if (strategy === 'cpsat_lns') {
+            cpsatLnsParamsLabel.style.display = 'block';
         } else if (strategy === 'genetic') { // <<< إضافة جديدة
             geneticParamsLabel.style.display = 'block';
+        } else if (strategy === 'genetic_islands') {
+            geneticParamsLabel.style.display = 'block';
+            geneticIslandsParamsLabel.style.display = 'block';
         } else if (strategy === 'tabu_search') {
             tabuParamsLabel.style.display = 'block';
         } else if (strategy === 'lns') {
@@ -801,6 +813,7 @@ function collectAllData() {
     const intensiveSearch = document.getElementById('intensive-search-checkbox').checked;
     const groupSubjects = document.getElementById('group-subjects-checkbox').checked;
     const iterations = document.getElementById('iterations-count').value;
+    const intensiveWorkers = document.getElementById('intensive-workers-count').value;
     const largeHallWeight = document.getElementById('large-hall-weight').value;
     const otherHallWeight = document.getElementById('other-hall-weight').value;
     const guardsLargeHall = document.getElementById('guards-large-hall').value;
@@ -813,21 +826,33 @@ function collectAllData() {
     const enableCustomTargets = document.getElementById('enable-custom-targets-checkbox').checked;
     
     const solverTimelimit = document.getElementById('solver-timelimit').value;
+    const solverWorkers = document.getElementById('solver-workers').value;
+    const solverLogSearch = document.getElementById('solver-log-search').checked;
+    const solverSoftShortage = document.getElementById('solver-soft-shortage').checked;
+    const cpsatLnsIterations = document.getElementById('cpsat-lns-iterations').value;
+    const cpsatLnsStepTimelimit = document.getElementById('cpsat-lns-step-timelimit').value;
+    const cpsatLnsWindowDays = document.getElementById('cpsat-lns-window-days').value;
+    const cpsatLnsGroupSize = document.getElementById('cpsat-lns-group-size').value;
 
     // --- الجزء الذي تم تصحيحه ---
     const geneticPopulation = document.getElementById('genetic-population').value;
     const geneticGenerations = document.getElementById('genetic-generations').value;
     const geneticElitism = document.getElementById('genetic-elitism').value; // <-- السطر الجديد
     const geneticMutation = document.getElementById('genetic-mutation').value;
+    const geneticIslands = document.getElementById('genetic-islands').value;
+    const geneticMigrationInterval = document.getElementById('genetic-migration-interval').value;
+    const geneticMigrants = document.getElementById('genetic-migrants').value;
     const tabuIterations = document.getElementById('tabu-iterations').value;
     const tabuTenure = document.getElementById('tabu-tenure').value;
     const tabuNeighborhoodSize = document.getElementById('tabu-neighborhood-size').value;
+    const tabuWorkers = document.getElementById('tabu-workers').value;
     const professorPartnerships = currentProfessorPartnerships;
     const lnsIterations = document.getElementById('lns-iterations').value;
     const lnsDestroyFraction = document.getElementById('lns-destroy-fraction').value;
     const vnsIterations = document.getElementById('vns-iterations').value;
     const vnsMaxK = document.getElementById('vns-max-k').value;
     const refinementPasses = parseInt(document.getElementById('refinement-passes').value) || 3;
+    const flowInitialSolution = document.getElementById('flow-initial-solution').checked;
     const lnsUnifiedIterations = document.getElementById('lns-unified-iterations').value;
     const lnsUnifiedDestroyFraction = document.getElementById('lns-unified-destroy-fraction').value;
     const hhIterations = document.getElementById('hh-iterations').value;
@@ -844,26 +869,38 @@ function collectAllData() {
 
     return { 
         dutyPatterns, levelHallAssignments, examSchedule, unavailableDays,
-        assignOwnerAsGuard, maxShifts, maxLargeHallShifts, intensiveSearch, groupSubjects, iterations,
+        assignOwnerAsGuard, maxShifts, maxLargeHallShifts, intensiveSearch, groupSubjects, iterations, intensiveWorkers,
         lastDayRestriction,
         largeHallWeight, otherHallWeight, guardsLargeHall,
         guardsMediumHall, guardsSmallHall, enableCustomTargets, customTargetPatterns,
         balancingStrategy,
         swapAttempts,
         solverTimelimit,
+        solverWorkers,
+        solverLogSearch,
+        solverSoftShortage,
+        cpsatLnsIterations,
+        cpsatLnsStepTimelimit,
+        cpsatLnsWindowDays,
+        cpsatLnsGroupSize,
         geneticPopulation,
         geneticGenerations,
         geneticElitism,
         geneticMutation,
+        geneticIslands,
+        geneticMigrationInterval,
+        geneticMigrants,
         tabuIterations,
         tabuTenure,
         tabuNeighborhoodSize,
+        tabuWorkers,
         professorPartnerships,
         lnsIterations,
         lnsDestroyFraction,
         vnsIterations,
         vnsMaxK,
         refinementPasses,
+        flowInitialSolution,
         lnsUnifiedIterations,
         lnsUnifiedDestroyFraction,
         hyperHeuristicSettings
@@ -899,65 +936,38 @@ async function autoSaveSettings() {
     }
 }
 
-// في ملف script.js، استبدل هذه الدالة بالكامل
-
-// في ملف script.js، استبدل هذه الدالة بالكامل
-async function collectAndSendData() {
-    await autoSaveSettings();
+// كل عملية إنشاء جدول هي مهمة مستقلة على الخادم لها سجلها الحي الخاص
+function openJobEvents(jobId) {
     const resultsContainer = document.getElementById('results-container');
     const generateBtn = document.getElementById('generate-schedule-button');
     const stopBtn = document.getElementById('stop-algorithm-btn');
-    const logContainer = document.getElementById('live-log-container');
     const logOutput = document.getElementById('live-log-output');
-
-    // --- إضافة جديدة: جلب عناصر شريط التقدم ---
     const progressBarContainer = document.getElementById('progress-bar-container');
     const progressBarInner = document.getElementById('progress-bar-inner');
 
-    if (eventSource && eventSource.readyState !== EventSource.CLOSED) {
-        eventSource.close();
-    }
+    currentJobId = jobId;
+    sessionStorage.setItem('currentJobId', jobId);
+    // المتصفح يعيد الاتصال تلقائياً ويرسل Last-Event-ID، فيعيد الخادم فقط ما فاتنا من رسائل
+    eventSource = new EventSource(`/api/jobs/${jobId}/events`);
 
-    generateBtn.style.display = 'none';
-    stopBtn.style.display = 'inline-block';
-
-    logContainer.classList.remove('hidden');
-    // --- إضافة جديدة: إظهار شريط التقدم وإعادة تعيينه ---
-    progressBarContainer.classList.remove('hidden');
-    progressBarInner.style.width = '0%';
-    progressBarInner.textContent = '0%';
-
-    logOutput.textContent = 'بدء الاتصال بالخادم...\n';
-    resultsContainer.style.display = 'block';
-    resultsContainer.innerHTML = '<h3>جاري إنشاء الجدول، يرجى الانتظار...</h3>';
-    generateBtn.disabled = true;
-    generateBtn.textContent = '... جاري البحث عن حل';
-
-    const allSettings = collectAllData();
-    if (Object.keys(allSettings.examSchedule).length === 0) {
-        alert('الرجاء إعداد جدول الامتحانات أولاً.');
-        resultsContainer.innerHTML = '';
-        generateBtn.disabled = false;
-        generateBtn.textContent = '🚀 إنشاء جدول الحراسة الآن';
-        logContainer.classList.add('hidden');
-        // --- إضافة جديدة: إخفاء شريط التقدم عند الخطأ ---
-        progressBarContainer.classList.add('hidden');
-        return;
-    }
-
-    eventSource = new EventSource('/stream-logs');
-    
     eventSource.onmessage = function(event) {
         // --- تعديل مهم: التحقق من نوع الرسالة ---
         if (event.data.startsWith("PROGRESS:")) {
-            const progress = event.data.split(':')[1];
-            progressBarInner.style.width = progress + '%';
-            progressBarInner.textContent = progress + '%';
+            // رسالة منظمة: {percent, phase, iteration, bestCost, elapsed} يرسلها الخادم بمعدل محدود
+            const progress = JSON.parse(event.data.substring("PROGRESS:".length));
+            const percent = typeof progress === 'object' ? progress.percent : progress;
+            progressBarInner.style.width = percent + '%';
+            progressBarInner.textContent = progress.phase ? `${progress.phase} — ${percent}%` : percent + '%';
+            if (progress.bestCost) {
+                const [shortage, hard, deviation, soft] = progress.bestCost;
+                progressBarInner.title = `التكرار ${progress.iteration ?? '-'} | ${progress.elapsed} ث | نقص: ${shortage}, قيود صارمة: ${hard}, انحراف: ${deviation === null ? '-' : deviation.toFixed(2)}, قيود مرنة: ${soft}`;
+            }
             return; // لا تطبع رسالة التقدم في الصندوق الأسود
         }
-        
+    
         if (event.data.startsWith("DONE")) {
             eventSource.close();
+            sessionStorage.removeItem('currentJobId');
             generateBtn.style.display = 'inline-block';
             stopBtn.style.display = 'none';
             stopBtn.disabled = false;
@@ -966,12 +976,13 @@ async function collectAndSendData() {
             progressBarContainer.classList.add('hidden');
 
             const jsonString = event.data.substring(4); 
-            
+        
             if (jsonString) {
                 try {
                     const finalData = JSON.parse(jsonString);
                     if (finalData.success) {
                         lastGeneratedSchedule = finalData.schedule; 
+                        lastRunId = finalData.runId || null; // لا يوجد إذا فشل حفظ النتيجة على الخادم
                         displayResults(finalData.schedule);
                         displayReports(finalData);
                         if (finalData.chart_data) displayWorkloadChart(finalData.chart_data);
@@ -992,14 +1003,18 @@ async function collectAndSendData() {
             generateBtn.textContent = '🚀 إنشاء جدول الحراسة الآن';
             return;
         }
-        
+    
         logOutput.textContent += event.data + '\n';
         logOutput.scrollTop = logOutput.scrollHeight;
     };
 
     eventSource.onerror = function(err) {
+        if (eventSource.readyState !== EventSource.CLOSED) {
+            logOutput.textContent += 'انقطع الاتصال بالخادم، جاري إعادة الاتصال...\n';
+            return;
+        }
         logOutput.textContent += 'انقطع الاتصال بالخادم.\n';
-        eventSource.close();
+        sessionStorage.removeItem('currentJobId');
         generateBtn.disabled = false;
         generateBtn.textContent = '🚀 إنشاء جدول الحراسة الآن';
         generateBtn.style.display = 'inline-block';
@@ -1009,8 +1024,78 @@ async function collectAndSendData() {
         // --- إضافة جديدة: إخفاء شريط التقدم عند الخطأ ---
         progressBarContainer.classList.add('hidden');
     };
+}
+
+// بعد تحديث الصفحة: إذا كانت هناك مهمة قيد التنفيذ، نعيد الاشتراك في سجلها من البداية
+function resumeRunningJob() {
+    const jobId = sessionStorage.getItem('currentJobId');
+    if (!jobId) return;
+    fetch(`/api/jobs/${jobId}`)
+        .then(response => {
+            if (!response.ok) throw new Error('المهمة غير موجودة.');
+            return response.json();
+        })
+        .then(() => {
+            document.getElementById('generate-schedule-button').style.display = 'none';
+            document.getElementById('stop-algorithm-btn').style.display = 'inline-block';
+            document.getElementById('live-log-container').classList.remove('hidden');
+            document.getElementById('progress-bar-container').classList.remove('hidden');
+            document.getElementById('live-log-output').textContent = '';
+            const resultsContainer = document.getElementById('results-container');
+            resultsContainer.style.display = 'block';
+            resultsContainer.innerHTML = '<h3>جاري إنشاء الجدول، يرجى الانتظار...</h3>';
+            openJobEvents(jobId);
+        })
+        .catch(() => sessionStorage.removeItem('currentJobId'));
+}
+
+// في ملف script.js، استبدل هذه الدالة بالكامل
+
+// في ملف script.js، استبدل هذه الدالة بالكامل
+async function collectAndSendData() {
+    await autoSaveSettings();
+    const resultsContainer = document.getElementById('results-container');
+    const generateBtn = document.getElementById('generate-schedule-button');
+    const stopBtn = document.getElementById('stop-algorithm-btn');
+    const logContainer = document.getElementById('live-log-container');
+    const logOutput = document.getElementById('live-log-output');
+
+    // --- إضافة جديدة: جلب عناصر شريط التقدم ---
+    const progressBarContainer = document.getElementById('progress-bar-container');
+    const progressBarInner = document.getElementById('progress-bar-inner');
+
+    if (eventSource && eventSource.readyState !== EventSource.CLOSED) {
+        eventSource.close();
+    }
+
+    generateBtn.style.display = 'none';
+    stopBtn.style.display = 'inline-block';
+
+    logContainer.classList.remove('hidden');
+    // --- إضافة جديدة: إظهار شريط التقدم وإعادة تعيينه ---
+    progressBarContainer.classList.remove('hidden');
+    progressBarInner.style.width = '0%';
+    progressBarInner.textContent = '0%';
 
-    fetch('/api/generate-guard-schedule', {
+    logOutput.textContent = 'بدء الاتصال بالخادم...\n';
+    resultsContainer.style.display = 'block';
+    resultsContainer.innerHTML = '<h3>جاري إنشاء الجدول، يرجى الانتظار...</h3>';
+    generateBtn.disabled = true;
+    generateBtn.textContent = '... جاري البحث عن حل';
+
+    const allSettings = collectAllData();
+    if (Object.keys(allSettings.examSchedule).length === 0) {
+        alert('الرجاء إعداد جدول الامتحانات أولاً.');
+        resultsContainer.innerHTML = '';
+        generateBtn.disabled = false;
+        generateBtn.textContent = '🚀 إنشاء جدول الحراسة الآن';
+        logContainer.classList.add('hidden');
+        // --- إضافة جديدة: إخفاء شريط التقدم عند الخطأ ---
+        progressBarContainer.classList.add('hidden');
+        return;
+    }
+
+    fetch('/api/jobs', {
         method: 'POST',
         headers: { 'Content-Type': 'application/json' },
         body: JSON.stringify(allSettings),
@@ -1019,7 +1104,11 @@ async function collectAndSendData() {
         if (!response.ok) {
            throw new Error('فشل الخادم في بدء عملية إنشاء الجدول.');
         }
-        console.log("تم إرسال طلب إنشاء الجدول بنجاح.");
+        return response.json();
+    })
+    .then(job => {
+        console.log("تم إرسال طلب إنشاء الجدول بنجاح. معرف المهمة:", job.jobId);
+        openJobEvents(job.jobId);
     })
     .catch(error => {
         resultsContainer.innerHTML = `<p class="failure-message">حدث خطأ في الاتصال الأولي بالخادم. الرجاء التأكد من أن الخادم يعمل.</p>`;
@@ -1252,6 +1341,24 @@ function displayResults(schedule) {
     }
 }
 
+// التصدير يرسل معرف العملية المحفوظة فقط؛ إذا لم يجدها الخادم يُرسل الجدول كاملاً كما في السابق
+async function postScheduleForExport(url) {
+    if (lastRunId) {
+        const response = await fetch(url, {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ runId: lastRunId })
+        });
+        if (response.status !== 404) return response;
+        lastRunId = null;
+    }
+    return fetch(url, {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify(lastGeneratedSchedule)
+    });
+}
+
 async function exportSchedule() {
     if (!lastGeneratedSchedule) {
         alert("يرجى إنشاء جدول أولاً قبل التصدير.");
@@ -1262,11 +1369,7 @@ async function exportSchedule() {
     button.textContent = 'جاري التصدير...';
 
     try {
-        const response = await fetch('/api/export-schedule', {
-            method: 'POST',
-            headers: { 'Content-Type': 'application/json' },
-            body: JSON.stringify(lastGeneratedSchedule)
-        });
+        const response = await postScheduleForExport('/api/export-schedule');
 
         if (!response.ok) throw new Error('فشل التصدير من الخادم');
 
@@ -1300,11 +1403,7 @@ async function exportProfSchedule() {
     button.textContent = 'جاري التصدير...';
 
     try {
-        const response = await fetch('/api/export-prof-schedules', {
-            method: 'POST',
-            headers: { 'Content-Type': 'application/json' },
-            body: JSON.stringify(lastGeneratedSchedule)
-        });
+        const response = await postScheduleForExport('/api/export-prof-schedules');
 
         if (!response.ok) throw new Error('فشل التصدير من الخادم');
 
@@ -1416,6 +1515,7 @@ function populateUIWithSettings(settings) {
     if (settings.otherHallWeight !== undefined) document.getElementById('other-hall-weight').value = settings.otherHallWeight;
     if (settings.intensiveSearch !== undefined) document.getElementById('intensive-search-checkbox').checked = settings.intensiveSearch;
     if (settings.iterations !== undefined) document.getElementById('iterations-count').value = settings.iterations;
+    if (settings.intensiveWorkers !== undefined) document.getElementById('intensive-workers-count').value = settings.intensiveWorkers;
 
     // --- هذا هو التعديل الجديد ---
     if (settings.lastDayRestriction) {
@@ -1442,6 +1542,27 @@ function populateUIWithSettings(settings) {
     if (settings.solverTimelimit !== undefined) {
         document.getElementById('solver-timelimit').value = settings.solverTimelimit;
     }
+    if (settings.solverWorkers !== undefined) {
+        document.getElementById('solver-workers').value = settings.solverWorkers;
+    }
+    if (settings.solverLogSearch !== undefined) {
+        document.getElementById('solver-log-search').checked = settings.solverLogSearch;
+    }
+    if (settings.solverSoftShortage !== undefined) {
+        document.getElementById('solver-soft-shortage').checked = settings.solverSoftShortage;
+    }
+    if (settings.cpsatLnsIterations !== undefined) {
+        document.getElementById('cpsat-lns-iterations').value = settings.cpsatLnsIterations;
+    }
+    if (settings.cpsatLnsStepTimelimit !== undefined) {
+        document.getElementById('cpsat-lns-step-timelimit').value = settings.cpsatLnsStepTimelimit;
+    }
+    if (settings.cpsatLnsWindowDays !== undefined) {
+        document.getElementById('cpsat-lns-window-days').value = settings.cpsatLnsWindowDays;
+    }
+    if (settings.cpsatLnsGroupSize !== undefined) {
+        document.getElementById('cpsat-lns-group-size').value = settings.cpsatLnsGroupSize;
+    }
     if (settings.geneticPopulation !== undefined) {
         document.getElementById('genetic-population').value = settings.geneticPopulation;
     }
@@ -1454,6 +1575,15 @@ function populateUIWithSettings(settings) {
     if (settings.geneticMutation !== undefined) {
         document.getElementById('genetic-mutation').value = settings.geneticMutation;
     }
+    if (settings.geneticIslands !== undefined) {
+        document.getElementById('genetic-islands').value = settings.geneticIslands;
+    }
+    if (settings.geneticMigrationInterval !== undefined) {
+        document.getElementById('genetic-migration-interval').value = settings.geneticMigrationInterval;
+    }
+    if (settings.geneticMigrants !== undefined) {
+        document.getElementById('genetic-migrants').value = settings.geneticMigrants;
+    }
 
     if (settings.enableCustomTargets) {
         document.getElementById('enable-custom-targets-checkbox').checked = true;
@@ -1472,6 +1602,9 @@ function populateUIWithSettings(settings) {
     if (settings.tabuNeighborhoodSize !== undefined) {
         document.getElementById('tabu-neighborhood-size').value = settings.tabuNeighborhoodSize;
     }
+    if (settings.tabuWorkers !== undefined) {
+        document.getElementById('tabu-workers').value = settings.tabuWorkers;
+    }
     if (settings.lnsIterations !== undefined) {
         document.getElementById('lns-iterations').value = settings.lnsIterations;
     }
@@ -1487,6 +1620,9 @@ function populateUIWithSettings(settings) {
     if (settings.refinementPasses !== undefined) {
         document.getElementById('refinement-passes').value = settings.refinementPasses;
     }
+    if (settings.flowInitialSolution !== undefined) {
+        document.getElementById('flow-initial-solution').checked = settings.flowInitialSolution;
+    }
     if (settings.lnsUnifiedIterations !== undefined) {
     document.getElementById('lns-unified-iterations').value = settings.lnsUnifiedIterations;
     }
@@ -2532,11 +2668,7 @@ async function exportScheduleWord() {
     button.textContent = 'جاري التصدير...';
 
     try {
-        const response = await fetch('/api/export/word/all-exams', {
-            method: 'POST',
-            headers: { 'Content-Type': 'application/json' },
-            body: JSON.stringify(lastGeneratedSchedule)
-        });
+        const response = await postScheduleForExport('/api/export/word/all-exams');
 
         if (!response.ok) throw new Error('فشل التصدير من الخادم');
 
@@ -2570,11 +2702,7 @@ async function exportProfScheduleWord() {
     button.textContent = 'جاري التصدير...';
 
     try {
-        const response = await fetch('/api/export/word/all-profs', {
-            method: 'POST',
-            headers: { 'Content-Type': 'application/json' },
-            body: JSON.stringify(lastGeneratedSchedule)
-        });
+        const response = await postScheduleForExport('/api/export/word/all-profs');
 
         if (!response.ok) throw new Error('فشل التصدير من الخادم');
 
@@ -2608,11 +2736,7 @@ async function exportProfScheduleAnonymous() {
     button.textContent = 'جاري التصدير...';
 
     try {
-        const response = await fetch('/api/export/word/all-profs-anonymous', {
-            method: 'POST',
-            headers: { 'Content-Type': 'application/json' },
-            body: JSON.stringify(lastGeneratedSchedule)
-        });
+        const response = await postScheduleForExport('/api/export/word/all-profs-anonymous');
 
         if (!response.ok) throw new Error('فشل التصدير من الخادم');
 
@@ -2642,10 +2766,11 @@ function setupStopButtonListener() {
     if (!stopBtn) return;
 
     stopBtn.addEventListener('click', () => {
+        if (!currentJobId) return;
         stopBtn.disabled = true;
         stopBtn.textContent = '⏳ جاري الإيقاف...';
 
-        fetch('/api/stop-algorithm', { method: 'POST' })
+        fetch(`/api/jobs/${currentJobId}`, { method: 'DELETE' })
             .then(handleResponse)
             .then(data => {
                 showNotification(data.message, 'success');